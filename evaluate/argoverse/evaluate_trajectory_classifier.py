@@ -0,0 +1,77 @@
+#!/usr/bin/env python3.8
+# -*- coding: utf-8 -*-
+
+## Agreement between the RANSAC (get_non_linear) and vectorized (get_non_linear_batch)
+## straight/curved trajectory classifiers
+
+"""
+Created on Fri Oct 16 10:12:31 2026
+@author: Carlos Gómez-Huélamo
+"""
+
+import numpy as np
+import os
+import sys
+import git
+import time
+import warnings
+
+repo = git.Repo('.', search_parent_directories=True)
+BASE_DIR = repo.working_tree_dir
+sys.path.append(BASE_DIR)
+
+import model.datasets.argoverse.dataset as dataset
+import model.datasets.argoverse.dataset_utils as dataset_utils
+import model.datasets.argoverse.geometric_functions as geometric_functions
+
+warnings.filterwarnings("ignore") # sklearn warnings (RANSAC)
+
+# Load files
+
+dataset_path = "data/datasets/argoverse/motion-forecasting/"
+split = "val"
+data_folder = os.path.join(BASE_DIR, dataset_path + split, "data")
+
+files, num_files = dataset_utils.load_list_from_folder(data_folder)
+file_id_list, root_file_name = dataset_utils.get_sorted_file_id_list(files)
+
+limit = 1000 # -1 to consider the whole split
+if limit != -1:
+    file_id_list = file_id_list[:limit]
+
+print("Num files: ", len(file_id_list))
+
+obs_origin = 20
+obs_len = 20
+pred_len = 30
+
+# Get the complete trajectories (obs + pred) of all objects
+
+trajs = []
+agent_trajs = []
+
+for t,file_id in enumerate(file_id_list):
+    path = os.path.join(root_file_name,str(file_id)+".csv")
+    data = dataset_utils.read_file(path)
+    frames = np.unique(data[:, 0])
+
+    num_objs_considered, _, _, curr_seq, _, _, object_class_list, _, _ = \
+        dataset.process_window_sequence(0, data, frames, obs_len, pred_len, file_id, split, obs_origin,
+                                        trajectory_classifier="vectorized")
+
+    trajs.append(curr_seq[:num_objs_considered])
+    agent_trajs.append(curr_seq[:num_objs_considered][object_class_list[:num_objs_considered] == 1])
+
+trajs = np.concatenate(trajs, axis=0)
+agent_trajs = np.concatenate(agent_trajs, axis=0)
+
+# Compare the labels
+
+for name, seqs in [("All objects", trajs), ("AGENT", agent_trajs)]:
+    start = time.time()
+    report = geometric_functions.get_non_linear_agreement(seqs, threshold=2)
+    end = time.time()
+
+    print(f"{name}: {report['num_trajs']} trajectories. Agreement: {round(100*report['agreement'],2)} %. \
+            Straight -> curved: {report['straight_to_curved']}. Curved -> straight: {report['curved_to_straight']}. \
+            Time: {round(end-start,2)} s")
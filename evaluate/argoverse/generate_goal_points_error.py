@@ -117,16 +117,13 @@ for t,file_id in enumerate(file_id_list):
 
     # 1. Get past observations
 
-    frames = np.unique(data[:, 0]).tolist() 
-    frame_data = []
-    for frame in frames:
-        frame_data.append(data[frame == data[:, 0], :]) # save info for each frame
+    frames = np.unique(data[:, 0]) 
 
     idx = 0
 
     num_objs_considered, _non_linear_obj, curr_loss_mask, curr_seq, \
     curr_seq_rel, id_frame_list, object_class_list, city_id, map_origin = \
-        dataset.process_window_sequence(idx, frame_data, frames, \
+        dataset.process_window_sequence(idx, data, frames, \
                                         obs_len, pred_len, file_id, split, obs_origin)
 
     # 2. Get AGENT information
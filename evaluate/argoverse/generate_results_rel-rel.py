@@ -46,13 +46,12 @@ import model.datasets.argoverse.plot_functions as plot_functions
 import model.datasets.argoverse.dataset_utils as dataset_utils
 import model.datasets.argoverse.data_augmentation_functions as data_augmentation_functions
 
-from model.datasets.argoverse.map_functions import MapFeaturesUtils
+from model.datasets.argoverse.map_functions import MapFeaturesUtils, get_argoverse_map
 from model.datasets.argoverse.dataset import ArgoverseMotionForecastingDataset, seq_collate
 from model.utils.checkpoint_data import get_generator
 from model.trainers.trainer_mapfe4mp import cal_ade_multimodal, cal_fde_multimodal
 
 from argoverse.evaluation.competition_util import generate_forecasting_h5
-from argoverse.map_representation.map_api import ArgoverseMap
 
 #######################################
 
@@ -65,7 +64,7 @@ parser.add_argument("--split", required=True, default="val", type=str)
 parser.add_argument("--batch_size", required=True, default=1, type=int)
 
 map_features_utils_instance = MapFeaturesUtils()
-avm = ArgoverseMap()
+avm = get_argoverse_map() # Memory-mapped (built the first time)
 
 LIMIT_FILES = -1 # From 1 to num_files.
                  # -1 by default to analyze all files of the specified split percentage
@@ -329,6 +328,26 @@ def evaluate(loader, generator, config, split, current_cuda, pred_len, results_p
             non_linear_obj = non_linear_obj.cpu()
             object_cls = object_cls.cpu()
             
+            if config.dataset.apply_rotation: # We have to counter-rotate in order to have again the original sequences
+                                              # (whole batch at once)
+                R = data_augmentation_functions.get_target_frame_rotation(target_agent_orientation, inverse=True)
+                object_seq = torch.repeat_interleave(torch.arange(len(num_seq)), 
+                                                     (seq_start_end[:,1]-seq_start_end[:,0]).cpu())
+
+                obs_traj = data_augmentation_functions.rotate_traj_batch(obs_traj.permute(1,0,2), R, 
+                                                                         index=object_seq).permute(1,0,2)
+                pred_traj_gt = data_augmentation_functions.rotate_traj_batch(pred_traj_gt.permute(1,0,2), R, 
+                                                                             index=object_seq).permute(1,0,2)
+                pred_traj_fake = data_augmentation_functions.rotate_traj_batch(pred_traj_fake, R)
+                map_origin = data_augmentation_functions.rotate_traj_batch(map_origin, R)
+
+                if config.hyperparameters.physical_context == "social":
+                    relevant_centerlines = torch.tensor([])
+                else:
+                    relevant_centerlines = data_augmentation_functions.rotate_traj_batch(relevant_centerlines, R)
+
+                pred_traj_fake_global = pred_traj_fake + map_origin.unsqueeze(1).unsqueeze(1)
+
             for i in range(len(num_seq)):
             # OBS: We cannot iterate always over batch_size length, since at the
             # end our batch will usually have less elements than batch_size (e.g. 560 vs 1024)
@@ -353,23 +372,6 @@ def evaluate(loader, generator, config, split, current_cuda, pred_len, results_p
                 
                 ade_min, fde_min = None, None
             
-                if config.dataset.apply_rotation: # We have to counter-rotate in order to have again the original sequence
-                    yaw_aux = (math.pi/2 - target_agent_orientation[i]) 
-                    c, s = torch.cos(yaw_aux), torch.sin(yaw_aux)
-                    R = torch.tensor([[c,-s],  # Rot around the map z-axis
-                                      [s, c]])
-
-                    obs_traj[:,start_seq:end_seq,:] = data_augmentation_functions.rotate_traj(obs_traj[:,start_seq:end_seq,:],R)
-                    pred_traj_gt[:,start_seq:end_seq,:] = data_augmentation_functions.rotate_traj(pred_traj_gt[:,start_seq:end_seq,:],R)
-                    pred_traj_fake[i] = data_augmentation_functions.rotate_traj(pred_traj_fake[i],R)
-                    map_origin[i] = data_augmentation_functions.rotate_traj(map_origin[i],R)
-                    
-                    if config.hyperparameters.physical_context == "social":
-                        relevant_centerlines = torch.tensor([])
-                    relevant_centerlines[i] = data_augmentation_functions.rotate_traj(relevant_centerlines[i],R)
-
-                    pred_traj_fake_global[i] = pred_traj_fake[i] + map_origin[i]
-                
                 if COMPUTE_METRICS and split != "test":
                     agent_pred_gt = pred_traj_gt[:,agent_idx[i],:] # pred_len (30) x 1 (agent) x data_dim (2) -> "Abs" coordinates (around 0,0)
                     agent_pred_gt = agent_pred_gt.unsqueeze(0).permute(1,0,2) # pred_len x batch_size x data_dim
@@ -450,11 +452,9 @@ def evaluate(loader, generator, config, split, current_cuda, pred_len, results_p
                                 relevant_centerlines_aux = []
                             
                             elif "raw_centerlines" in plot_type:
-                                df = pd.read_csv(seq_path, dtype={"TIMESTAMP": str})
-
                                 # Get social and map features for the agent
 
-                                agent_track = df[df["OBJECT_TYPE"] == "AGENT"].values
+                                agent_track = dataset_utils.read_agent_track(seq_path)
                                 city_name = agent_track[0,RAW_DATA_FORMAT["CITY_NAME"]]
                                 agent_xy = agent_track[:,[RAW_DATA_FORMAT["X"],RAW_DATA_FORMAT["Y"]]].astype("float")
 
@@ -593,6 +593,7 @@ def main(args):
                                                    hard_mining=config.dataset.hard_mining,
                                                    obs_origin=config.hyperparameters.obs_origin,
                                                    apply_rotation=config.dataset.apply_rotation,
+                                                   rotated_data=config.dataset.get("rotated_data",False),
                                                    physical_context=config.hyperparameters.physical_context,
                                                    extra_data_train=config.dataset.extra_data_train,
                                                    preprocess_data=config.dataset.preprocess_data,
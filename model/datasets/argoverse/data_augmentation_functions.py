@@ -156,4 +156,134 @@ def rotate_traj(traj,R):
     if traj.size()[0] > 0:
         return np.matmul(traj,R).float()
     else: # Empty tensor
-        return traj
\ No newline at end of file
+        return traj
+
+def get_target_frame_rotation(target_agent_orientation, inverse=False):
+    """
+    target_agent_orientation: torch.tensor (batch_size) in radians
+    Return the rotation matrices (batch_size x 2 x 2) that align the last observation of the target 
+    agent with the Y-axis (traj @ R, as rotate_traj). If inverse, the counter-rotation (back to the
+    map frame)
+    """
+
+    yaw_aux = math.pi/2 - target_agent_orientation
+    if not inverse:
+        yaw_aux = - yaw_aux
+    c, s = torch.cos(yaw_aux), torch.sin(yaw_aux)
+
+    return torch.stack((torch.stack((c,-s),dim=-1),  # Rot around the map z-axis
+                        torch.stack((s, c),dim=-1)),dim=-2)
+
+def rotate_traj_batch(traj, R, index=None):
+    """
+    Rotate all the sequences of the batch at once (traj @ R, as rotate_traj)
+    traj: torch.tensor batch_size x ... x 2 (or num_objects x ... x 2, see index)
+    R: torch.tensor batch_size x 2 x 2 (one rotation per sequence)
+    index: sequence of each element of traj, if traj does not have one element per sequence 
+    (e.g. objects)
+    """
+
+    if index is not None:
+        R = R[index]
+    R = R.view(R.shape[0], *[1]*(traj.dim()-2), 2, 2)
+
+    return torch.matmul(traj.unsqueeze(-2), R).squeeze(-2)
+
+def get_pairs_batch(num_trajs,percentage,num_obs,start_from=1,device=None):
+    """
+    Vectorized get_pairs: round(percentage*num_obs) non-consecutive indeces in the range 
+    (start_from,num_obs-1) for each trajectory (num_trajs x num_indeces). Sample k indeces from
+    range(num_obs-start_from-(k-1)) without replacement, sort them and add 0,1,...,k-1 (gap >= 2)
+    """
+
+    num_indeces = round(percentage*num_obs)
+    num_candidates = num_obs - start_from - (num_indeces - 1)
+    assert num_candidates >= num_indeces, "Too many non-consecutive indeces (percentage <= 0.4)"
+
+    indeces = torch.rand((num_trajs,num_candidates),device=device).argsort(dim=1)[:,:num_indeces]
+    indeces = indeces.sort(dim=1).values
+
+    return indeces + torch.arange(num_indeces,device=device) + start_from
+
+def augment_trajectories(obs_traj, pred_traj_gt, seq_start_end, phy_info=None, 
+                         dropout_prob=0.0, swap_prob=0.0, noise_prob=0.0, rotation_prob=0.0,
+                         percentage=0.2, mu=0, sigma=0.5, 
+                         rotation_angles=[90,180,270], rotation_angles_prob=[0.33,0.33,0.34]):
+    """
+    Data augmentation of the whole batch at once. All the masks and noise are drawn in the device
+    of the tensors, so it can be applied in seq_collate or once the batch is in the training device
+    Input:
+        - obs_traj: obs_len x num_agents x 2
+        - pred_traj_gt: pred_len x num_agents x 2
+        - seq_start_end: batch_size x 2
+        - phy_info: (Optional) batch_size x ... x 2 (e.g. centerlines around the origin), rotated 
+          with the trajectories of the sequence
+        - dropout_prob, swap_prob, noise_prob: Probability to apply dropout (x(i) = x(i-1)), 
+          swapping (x(i) <-> x(i-1)) of round(percentage*obs_len) non-consecutive observations 
+          and gaussian noise (mu, sigma) to each agent
+        - rotation_prob: Probability to rotate each sequence (observations, ground-truth and
+          phy_info) around the origin with one of the rotation_angles (degrees)
+    Output:
+        - obs_traj, obs_traj_rel, pred_traj_gt, pred_traj_gt_rel, phy_info. The relative
+          displacements are computed again from the whole augmented trajectories (obs + pred)
+    """
+
+    obs_len, num_agents, data_dim = obs_traj.shape
+    device = obs_traj.device
+    batch_size = seq_start_end.shape[0]
+    agent_index = torch.arange(num_agents,device=device).unsqueeze(1)
+
+    # Dropout and swapping (index of the observation that will be placed at each position)
+
+    src = torch.arange(obs_len,device=device).repeat(num_agents,1) # num_agents x obs_len
+
+    apply_dropout = torch.rand(num_agents,device=device) < dropout_prob
+    if apply_dropout.any():
+        pairs = get_pairs_batch(num_agents,percentage,obs_len,device=device)
+        pairs_src = torch.where(apply_dropout.unsqueeze(1), pairs-1, pairs)
+        src[agent_index,pairs] = pairs_src
+
+    apply_swap = torch.rand(num_agents,device=device) < swap_prob
+    if apply_swap.any():
+        pairs = get_pairs_batch(num_agents,percentage,obs_len,device=device)
+        swapped_src = src.clone()
+        swapped_src[agent_index,pairs] = src[agent_index,pairs-1]
+        swapped_src[agent_index,pairs-1] = src[agent_index,pairs]
+        src = torch.where(apply_swap.unsqueeze(1), swapped_src, src)
+
+    obs_traj = obs_traj.gather(0, src.t().unsqueeze(2).expand(-1,-1,data_dim))
+
+    # Gaussian noise
+
+    apply_noise = torch.rand(num_agents,device=device) < noise_prob
+    if apply_noise.any():
+        offset = torch.normal(mu,sigma,size=obs_traj.shape,device=device)
+        obs_traj = obs_traj + offset * apply_noise.view(1,-1,1)
+
+    # Rotation (whole sequence)
+
+    apply_rotation = torch.rand(batch_size,device=device) < rotation_prob
+    if apply_rotation.any():
+        angles = torch.tensor(rotation_angles,dtype=obs_traj.dtype,device=device) * math.pi/180
+        probs = torch.tensor(rotation_angles_prob,dtype=torch.float,device=device)
+        yaw = angles[torch.multinomial(probs,batch_size,replacement=True)] * apply_rotation
+
+        c, s = torch.cos(yaw), torch.sin(yaw)
+        R = torch.stack((torch.stack((c,-s),dim=-1),
+                         torch.stack((s, c),dim=-1)),dim=-2)
+
+        num_agents_per_seq = (seq_start_end[:,1] - seq_start_end[:,0]).to(device)
+        agent_seq = torch.repeat_interleave(torch.arange(batch_size,device=device), num_agents_per_seq)
+
+        obs_traj = rotate_traj_batch(obs_traj.permute(1,0,2), R, index=agent_seq).permute(1,0,2)
+        pred_traj_gt = rotate_traj_batch(pred_traj_gt.permute(1,0,2), R, index=agent_seq).permute(1,0,2)
+        if phy_info is not None:
+            phy_info = rotate_traj_batch(phy_info, R)
+
+    # Relative displacements (whole sequence)
+
+    traj = torch.cat((obs_traj,pred_traj_gt),dim=0)
+    traj_rel = torch.zeros_like(traj)
+    traj_rel[1:] = traj[1:] - traj[:-1]
+
+    return obs_traj, traj_rel[:obs_len], pred_traj_gt, traj_rel[obs_len:], phy_info
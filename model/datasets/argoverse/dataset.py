@@ -16,6 +16,8 @@ import os
 import time
 import operator
 import copy
+import functools
+import glob
 import pdb
 import sys
 
@@ -25,7 +27,7 @@ import pandas as pd
 import numpy as np
 import torch
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 # Custom imports
 
@@ -36,6 +38,7 @@ import model.datasets.argoverse.plot_functions as plot_functions
 import model.datasets.argoverse.goal_points_functions as goal_points_functions
 
 DEBUG_DATA_AUGMENTATION = False
+PREPROCESS_CHUNK_SIZE = 100 # Sequences per chunk of the preprocessing job (checkpoint granularity)
 
 #######################################
 
@@ -45,15 +48,17 @@ DEBUG_DATA_AUGMENTATION = False
 
 APPLY_DATA_AUGMENTATION = False
 APPLY_DATA_ROTATION = False
+TARGET_AGENT_FRAME = False # Sequences aligned with the target agent (rotated in seq_collate or preprocessed)
 
 if DEBUG_DATA_AUGMENTATION:
-    from argoverse.map_representation.map_api import ArgoverseMap
-    avm = ArgoverseMap()
+    import model.datasets.argoverse.map_functions as map_functions
+    avm = map_functions.get_argoverse_map()
     
 decision = [0,1] # Not apply/apply
 dropout_prob = [0.3,0.7] # Not applied/applied probability
+swap_prob = [0.7,0.3]
 gaussian_noise_prob = [0.2,0.8]
-rotation_prob = [0.3,0.7]
+rotation_prob = [0.3,0.7] # Only if the sequences are not aligned with the target agent (apply_rotation)
 
 points_dropout_percentage = 0.3
 mu_noise,std_noise = 0,0.25
@@ -69,10 +74,28 @@ PHYSICAL_CONTEXT = "dummy" # dummy, visual, oracle, goals, plausible_centerlines
 dist_around = 40
 dist_rasterized_map = [-dist_around, dist_around, -dist_around, dist_around]
 
+ROTATABLE_PHYSICAL_CONTEXTS = ["oracle","plausible_centerlines","plausible_centerlines+feasible_area"] # phy_info: batch_size x ... x 2
+
 #######################################
 
 # Main dataset functions
 
+def get_augmentation_parameters(apply_rotation, physical_context):
+    """
+    Parameters of data_augmentation_functions.augment_trajectories (applied in seq_collate or, 
+    with augmentation_on_device, by the trainer once the batch is in the training device).
+    The rotation augmentation is not applied if the sequences are aligned with the target agent
+    (apply_rotation) or the physical context cannot be rotated (e.g. images)
+    """
+
+    rotate = not apply_rotation and (physical_context in ROTATABLE_PHYSICAL_CONTEXTS 
+                                     or physical_context == "social")
+
+    return dict(dropout_prob=dropout_prob[1], swap_prob=swap_prob[1], noise_prob=gaussian_noise_prob[1],
+                rotation_prob=rotation_prob[1] if rotate else 0.0,
+                percentage=points_dropout_percentage, mu=mu_noise, sigma=std_noise,
+                rotation_angles=rotation_angles, rotation_angles_prob=rotation_angles_prob)
+
 def seq_collate(data):
     """
     This function takes the output of __getitem__ and returns a specific format
@@ -89,35 +112,67 @@ def seq_collate(data):
     start_seq_collate = time.time()
 
     start_load_batch = time.time()
-    (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel,
-     non_linear_obj, loss_mask, seq_id_list, object_class_id_list, 
-     object_id_list, city_id, map_origin, num_seq_list, norm, target_agent_orientation, 
-     oracle_centerlines, relevant_centerlines, split_hm) = zip(*data)
-
-    _len = [len(seq) for seq in obs_traj]
-    cum_start_idx = [0] + np.cumsum(_len).tolist()
-    seq_start_end = [[start, end] for start, end in zip(cum_start_idx, cum_start_idx[1:])]
-
-    obs_traj = torch.cat(obs_traj, dim=0).permute(2, 0, 1) # Past Observations x Num_agents · batch_size x 2                                                          
-    pred_traj_gt = torch.cat(pred_traj_gt, dim=0).permute(2, 0, 1)
-    obs_traj_rel = torch.cat(obs_traj_rel, dim=0).permute(2, 0, 1)
-    pred_traj_gt_rel = torch.cat(pred_traj_gt_rel, dim=0).permute(2, 0, 1)
-    non_linear_obj = torch.cat(non_linear_obj)
-    loss_mask = torch.cat(loss_mask, dim=0)
-    seq_start_end = torch.LongTensor(seq_start_end) # This variable represents the number of agents per 
-                                                    # sequence in the batch, i.e. if this variable = [[0,3],[4,10]],
-                                                    # that means that obs_traj = 20 x 10 x 2, with batch_size = 2, and
-                                                    # there are 3 agents in the first element of the batch and 7 agents in 
-                                                    # the second element of the batch
-
-    object_cls = torch.cat(object_class_id_list, dim=0)
-    obj_id = torch.cat(object_id_list, dim=0)
-    map_origin = torch.stack(map_origin)
-    city_id = torch.stack(city_id)
-    target_agent_orientation = torch.stack(target_agent_orientation)
-
-    num_seq_list = torch.stack(num_seq_list)
-    norm = torch.stack(norm)
+
+    if isinstance(data, dict): # Batch already gathered by the dataset (get_batch), 
+                               # each field is a single tensor
+        seq_start_end = data["seq_start_end"]
+        split_hm = data["split_hm"]
+
+        obs_traj = data["obs_traj"].permute(2, 0, 1) # Past Observations x Num_agents · batch_size x 2
+        pred_traj_gt = data["pred_traj_gt"].permute(2, 0, 1)
+        obs_traj_rel = data["obs_traj_rel"].permute(2, 0, 1)
+        pred_traj_gt_rel = data["pred_traj_gt_rel"].permute(2, 0, 1)
+        non_linear_obj = data["non_linear_obj"]
+        loss_mask = data["loss_mask"]
+
+        object_cls = data["object_class_id_list"]
+        obj_id = data["object_id_list"]
+        map_origin = data["map_origin"]
+        city_id = data["city_id"]
+        target_agent_orientation = data["target_agent_orientation"]
+
+        num_seq_list = data["num_seq_list"]
+        norm = data["norm"]
+
+        oracle_centerlines = data["oracle_centerlines"]
+        relevant_centerlines = data["relevant_centerlines"]
+
+        # Object classes per sequence (views, required by load_physical_information)
+
+        object_class_id_list = torch.split(object_cls, (seq_start_end[:,1]-seq_start_end[:,0]).tolist())
+    else:
+        (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel,
+         non_linear_obj, loss_mask, seq_id_list, object_class_id_list, 
+         object_id_list, city_id, map_origin, num_seq_list, norm, target_agent_orientation, 
+         oracle_centerlines, relevant_centerlines, split_hm) = zip(*data)
+
+        _len = [len(seq) for seq in obs_traj]
+        cum_start_idx = [0] + np.cumsum(_len).tolist()
+        seq_start_end = [[start, end] for start, end in zip(cum_start_idx, cum_start_idx[1:])]
+
+        obs_traj = torch.cat(obs_traj, dim=0).permute(2, 0, 1) # Past Observations x Num_agents · batch_size x 2                                                          
+        pred_traj_gt = torch.cat(pred_traj_gt, dim=0).permute(2, 0, 1)
+        obs_traj_rel = torch.cat(obs_traj_rel, dim=0).permute(2, 0, 1)
+        pred_traj_gt_rel = torch.cat(pred_traj_gt_rel, dim=0).permute(2, 0, 1)
+        non_linear_obj = torch.cat(non_linear_obj)
+        loss_mask = torch.cat(loss_mask, dim=0)
+        seq_start_end = torch.LongTensor(seq_start_end) # This variable represents the number of agents per 
+                                                        # sequence in the batch, i.e. if this variable = [[0,3],[4,10]],
+                                                        # that means that obs_traj = 20 x 10 x 2, with batch_size = 2, and
+                                                        # there are 3 agents in the first element of the batch and 7 agents in 
+                                                        # the second element of the batch
+
+        object_cls = torch.cat(object_class_id_list, dim=0)
+        obj_id = torch.cat(object_id_list, dim=0)
+        map_origin = torch.stack(map_origin)
+        city_id = torch.stack(city_id)
+        target_agent_orientation = torch.stack(target_agent_orientation)
+
+        num_seq_list = torch.stack(num_seq_list)
+        norm = torch.stack(norm)
+
+        oracle_centerlines = torch.stack(oracle_centerlines, dim=0)
+        relevant_centerlines = torch.stack(relevant_centerlines, dim=0)
 
     obs_len = obs_traj.shape[0]
     batch_size = map_origin.shape[0]
@@ -145,7 +200,6 @@ def seq_collate(data):
     elif PHYSICAL_CONTEXT == "plausible_centerlines" or PHYSICAL_CONTEXT == "plausible_centerlines+feasible_area":
         # Relevant centerlines from global (map) coordinates to absolute (around origin) coordinates
 
-        relevant_centerlines = torch.stack(relevant_centerlines, dim=0)
         _, max_centerlines, points_per_centerline, data_dim = relevant_centerlines.shape
         rows,cols,_ = torch.where(relevant_centerlines[:,:,:,0] == 0.0) # identify padded centerlines
  
@@ -168,7 +222,6 @@ def seq_collate(data):
     elif PHYSICAL_CONTEXT == "oracle":
         # Oracle centerlines from global (map) coordinates to absolute (around origin) coordinates
 
-        oracle_centerlines = torch.stack(oracle_centerlines, dim=0)
         _, points_per_centerline, data_dim = oracle_centerlines.shape
 
         # if APPLY_DATA_AUGMENTATION and CURRENT_SPLIT == "train":
@@ -195,21 +248,15 @@ def seq_collate(data):
     
     if APPLY_DATA_AUGMENTATION and CURRENT_SPLIT == "train":
         start_data_aug = time.time()
+
+        augmentation_parameters = get_augmentation_parameters(TARGET_AGENT_FRAME, PHYSICAL_CONTEXT)
+        rotate_phy_info = PHYSICAL_CONTEXT in ROTATABLE_PHYSICAL_CONTEXTS
         
-        num_global_obstacles = obs_traj.shape[1]
-        apply_dropout = torch.tensor(np.random.choice(decision,num_global_obstacles,p=dropout_prob)) # For each obstacle of the sequence
-        apply_gaussian_noise = torch.tensor(np.random.choice(decision,num_global_obstacles,p=gaussian_noise_prob)) # For each obstacle of the sequence
-        apply_rotation = torch.tensor(np.random.choice(decision,1,p=rotation_prob)) # To the whole sequence
-        
-        obs_traj = data_augmentation_functions.add_gaussian_noise(obs_traj,
-                                                                      apply_gaussian_noise,
-                                                                      num_global_obstacles,
-                                                                      num_obs=obs_len,
-                                                                      mu=mu_noise,sigma=std_noise)
-
-        obs_traj_rel = torch.zeros((obs_traj_rel.shape))
-        obs_traj_rel[1:,:,:] = torch.sub(obs_traj_rel[1:,:,:],
-                                             obs_traj_rel[:-1,:,:])
+        obs_traj, obs_traj_rel, pred_traj_gt, pred_traj_gt_rel, aug_phy_info = \
+            data_augmentation_functions.augment_trajectories(obs_traj, pred_traj_gt, seq_start_end,
+                                                             phy_info=phy_info if rotate_phy_info else None,
+                                                             **augmentation_parameters)
+        if rotate_phy_info: phy_info = aug_phy_info
         
         obs_traj_aux = torch.clone(obs_traj)
         
@@ -374,23 +421,26 @@ def seq_collate(data):
 
     return tuple(out)
 
-def process_window_sequence(idx, frame_data, frames, obs_len, 
-                            pred_len, file_id, split, obs_origin):
+def process_window_sequence(idx, data, frames, obs_len, 
+                            pred_len, file_id, split, obs_origin, trajectory_classifier="ransac"):
     """
     Input:
         idx (int): AV id
-        frame_data array (n, 6):
+        data array (n, 6):
             - timestamp (int)
             - id (int) -> previously need to be converted. Original data is string
             - type (int) -> need to be converted from string to int
             - x (float) -> x position (global, hdmap)
             - y (float) -> y position (global, hdmap)
             - city_name (int)
+        frames (np.array): sorted unique timestamps of data
         obs_len (int)
         pred_len (int)
         threshold (float)
         file_id (int)
         split (str: "train", "val", "test") 
+        trajectory_classifier (str: "ransac", "vectorized"): get_non_linear (per object) or 
+                                                             get_non_linear_batch (all objects at once)
     Output:
         num_objs_considered, _non_linear_obj, curr_loss_mask, curr_seq, curr_seq_rel, 
         id_frame_list, object_class_list, city_id, map_origin
@@ -398,10 +448,17 @@ def process_window_sequence(idx, frame_data, frames, obs_len,
 
     seq_len = obs_len + pred_len
 
-    # Prepare current sequence and get unique obstacles
+    # Prepare current sequence (rows of the window sorted by frame) and get unique obstacles
+
+    frame_index = np.searchsorted(frames, data[:, 0]) - idx
+    in_window = np.where((frame_index >= 0) & (frame_index < seq_len))[0]
+    in_window = in_window[np.argsort(frame_index[in_window], kind="stable")]
 
-    curr_seq_data = np.concatenate(frame_data[idx:idx + seq_len], axis=0)
-    objs_in_curr_seq = np.unique(curr_seq_data[:, 1]) # Unique IDs in the sequence
+    curr_seq_data = data[in_window, :]
+    curr_frame_index = frame_index[in_window]
+    objs_in_curr_seq, obj_index, obj_count = np.unique(curr_seq_data[:, 1], 
+                                                       return_inverse=True, 
+                                                       return_counts=True) # Unique IDs in the sequence
 
     # Initialize variables
 
@@ -414,7 +471,6 @@ def process_window_sequence(idx, frame_data, frames, obs_len,
     object_class_list = np.zeros(len(objs_in_curr_seq)) 
     id_frame_list  = np.zeros((len(objs_in_curr_seq), 3, tensors_len))
 
-    num_objs_considered = 0
     _non_linear_obj = []
     city_id = curr_seq_data[0,5]
 
@@ -426,72 +482,175 @@ def process_window_sequence(idx, frame_data, frames, obs_len,
     aux_seq = curr_seq_data[curr_seq_data[:, 2] == 1, :] # curr_seq_data[:, 2] represents the type. 1 == AGENT
     map_origin = aux_seq[obs_origin-1, 3:5] # x,y 
 
-    # Iterate over all unique objects
+    # Group the rows by object (ordered by ID, each group keeps the frame order)
 
-    for _, obj_id in enumerate(objs_in_curr_seq):
-        curr_obj_seq = curr_seq_data[curr_seq_data[:, 1] == obj_id, :]
+    obj_order = np.argsort(obj_index, kind="stable")
+    obj_start = np.cumsum(obj_count) - obj_count
 
-        # If the object has less than "seq_len" observations, discard.
-        # If we are processing the "test" set, we only have the observations, not the predictions
-                                                                                 
-        pad_front = frames.index(curr_obj_seq[0, 0]) - idx
-        pad_end = frames.index(curr_obj_seq[-1, 0]) - idx + 1
+    # If the object has less than "seq_len" observations, discard.
+    # If we are processing the "test" set, we only have the observations, not the predictions
 
-        # print("ID: ", curr_obj_seq[0,2])
-        # print("Front End: ", pad_front, pad_end)
-        if ((pad_end - pad_front != tensors_len) or (curr_obj_seq.shape[0] != tensors_len)):
-            continue
+    pad_front = curr_frame_index[obj_order[obj_start]]
+    pad_end = curr_frame_index[obj_order[obj_start + obj_count - 1]] + 1
+    considered = np.where((pad_end - pad_front == tensors_len) & (obj_count == tensors_len))[0]
+    num_objs_considered = len(considered)
 
-        object_class_list[num_objs_considered] = curr_obj_seq[0,2] # 0 == AV, 1 == AGENT, 2 == OTHER
+    # A considered object covers the whole window, so its rows fill the tensors from pad_front = 0
 
-        # Record timestamp, object ID and file_id information (for each object)
-        # id_frame_list represents a single sequence, so the second dimension indicates the object ID
-        # in that sequence
+    obj_rows = obj_order[obj_start[considered,np.newaxis] + np.arange(tensors_len)] # num_objs_considered x tensors_len
+    obj_seq = curr_seq_data[obj_rows, :] # num_objs_considered x tensors_len x 6
 
-        cache_tmp = np.transpose(curr_obj_seq[:,:2])
-        id_frame_list[num_objs_considered, :2, :] = cache_tmp
-        id_frame_list[num_objs_considered,  2, :] = file_id
+    object_class_list[:num_objs_considered] = obj_seq[:,0,2] # 0 == AV, 1 == AGENT, 2 == OTHER
 
-        # Get x-y data (w.r.t the map origin, so they are absolute 
-        # coordinates but in the local frame, not map (global) frame)
-        
-        curr_obj_seq = np.transpose(curr_obj_seq[:, 3:5])
-        curr_obj_seq = curr_obj_seq - map_origin.reshape(-1,1)
+    # Record timestamp, object ID and file_id information (for each object)
+    # id_frame_list represents a single sequence, so the second dimension indicates the object ID
+    # in that sequence
 
-        # Make coordinates relative (relative here means displacements between consecutive steps)
+    id_frame_list[:num_objs_considered, :2, :] = np.transpose(obj_seq[:,:,:2], (0,2,1))
+    id_frame_list[:num_objs_considered,  2, :] = file_id
 
-        rel_curr_obj_seq = np.zeros(curr_obj_seq.shape) 
-        rel_curr_obj_seq[:, 1:] = curr_obj_seq[:, 1:] - curr_obj_seq[:, :-1] # Get displacements between consecutive steps
-        
-        _idx = num_objs_considered
-        curr_seq[_idx, :, pad_front:pad_end] = curr_obj_seq
-        curr_seq_rel[_idx, :, pad_front:pad_end] = rel_curr_obj_seq
+    # Get x-y data (w.r.t the map origin, so they are absolute 
+    # coordinates but in the local frame, not map (global) frame)
 
-        # Linear vs Non-Linear Trajectory
+    curr_seq[:num_objs_considered] = np.transpose(obj_seq[:,:,3:5], (0,2,1)) - map_origin.reshape(1,-1,1)
 
-        if split != 'test':
+    # Make coordinates relative (relative here means displacements between consecutive steps)
+
+    curr_seq_rel[:num_objs_considered, :, 1:] = curr_seq[:num_objs_considered, :, 1:] - \
+                                                curr_seq[:num_objs_considered, :, :-1]
+    curr_loss_mask[:num_objs_considered] = 1
+
+    # Linear vs Non-Linear Trajectory
+
+    if split != 'test' and trajectory_classifier == "vectorized":
+        _non_linear_obj = geometric_functions.get_non_linear_batch(curr_seq[:num_objs_considered], 
+                                                                   threshold=2).tolist()
+    elif split != 'test':
+        for _idx in range(num_objs_considered):
             try:
-                non_linear = geometric_functions.get_non_linear(file_id, curr_seq, idx=_idx, obj_kind=curr_obj_seq[0,2],
+                non_linear = geometric_functions.get_non_linear(file_id, curr_seq, idx=_idx, obj_kind=object_class_list[_idx],
                                                                 threshold=2, debug_trajectory_classifier=False)
             except: # E.g. All max_trials iterations were skipped because each randomly chosen sub-sample 
                     # failed the passing criteria. Return non-linear because RANSAC could not fit a model
                 non_linear = 1.0
             _non_linear_obj.append(non_linear)
-        curr_loss_mask[_idx, pad_front:pad_end] = 1
 
-        # Add num_objs_considered
+    return num_objs_considered, _non_linear_obj, curr_loss_mask, curr_seq, curr_seq_rel, \
+           id_frame_list, object_class_list, city_id, map_origin
+
+def process_sequence_file(file_id, root_file_name, obs_len, pred_len, split, obs_origin, class_balance,
+                          cache_folder=None, trajectory_classifier="ransac"):
+    """
+    Read a single sequence (.csv) and compute its social information.
+    If class_balance >= 0.0, also classify the AGENT trajectory as straight (0.0) or curved (1.0),
+    otherwise non_linear is None
+    """
+
+    path = os.path.join(root_file_name,str(file_id)+".csv")
+    data = dataset_utils.read_file(path, cache_folder=cache_folder)
+
+    frames = np.unique(data[:, 0]) # Get unique timestamps (50 in this case)
+
+    idx = 0
+
+    num_objs_considered, _non_linear_obj, curr_loss_mask, curr_seq, \
+    curr_seq_rel, id_frame_list, object_class_list, city_id, ego_origin = \
+        process_window_sequence(idx, data, frames,
+                                obs_len, pred_len,
+                                file_id, split, obs_origin,
+                                trajectory_classifier=trajectory_classifier)
 
-        num_objs_considered += 1
+    # Check if the current AGENT trajectory can be considered as a curve or straight trajectory
+    # (so for further training we can focus on the most difficult samples -> sequences in which
+    # the AGENT is performing a curved trajectory)
+
+    non_linear = None
+
+    if class_balance >= 0.0:
+        agent_idx = np.where(object_class_list==1)[0].item()
+
+        if trajectory_classifier == "vectorized":
+            non_linear = geometric_functions.get_non_linear_batch(curr_seq[agent_idx:agent_idx+1], 
+                                                                  threshold=2)[0]
+        else:
+            try:
+                non_linear = geometric_functions.get_non_linear(file_id, curr_seq, idx=agent_idx, obj_kind=1,
+                                                                threshold=2, debug_trajectory_classifier=False)
+            except: # E.g. All max_trials iterations were skipped because each randomly chosen sub-sample
+                    # failed the passing criteria. Return non-linear because RANSAC could not fit a model
+                non_linear = 1.0
 
     return num_objs_considered, _non_linear_obj, curr_loss_mask, curr_seq, curr_seq_rel, \
-           id_frame_list, object_class_list, city_id, map_origin
-           
+           id_frame_list, object_class_list, city_id, ego_origin, non_linear
+
+def get_social_outputs(obs_len, pred_len, split):
+    """
+    Variables of the social information (key -> (dtype, row_shape)), declared beforehand so they
+    keep their shapes even if no sequence has been considered (e.g. an empty chunk)
+    """
+
+    tensors_len = obs_len + pred_len if split != "test" else obs_len
+
+    return dict(seq_list=(np.float64,(2,tensors_len)), # Absolute coordinates (obs+pred) around 0.0 
+                                                       # (center of the local map). Objects x 2 x seq_len
+                seq_list_rel=(np.float64,(2,tensors_len)), # Relative displacements (obs+pred)
+                loss_mask_list=(np.float64,(tensors_len,)),
+                non_linear_obj=(np.float64,()), # Object with non-linear trajectory
+                num_objs_in_seq=(np.int64,()),
+                seq_id_list=(np.float64,(3,tensors_len)),
+                object_class_id_list=(np.float64,()), # 0 = AV, 1 = AGENT, 2 = DUMMY
+                object_id_list=(np.float64,()),
+                ego_vehicle_origin=(np.float64,(2,)), # Origin of the AGENT (TODO: ego_vehicle_origin 
+                                                      # is a WRONG nomenclature)
+                num_seq_list=(np.int64,()), # ID of the current sequence
+                straight_trajectories_list=(np.int64,()),
+                curved_trajectories_list=(np.int64,()),
+                city_id=(np.float64,()))
+
+def get_sequence_social_rows(index, file_id, root_file_name, obs_len, pred_len, split, obs_origin,
+                             class_balance, min_objs=2, cache_folder=None, trajectory_classifier="ransac"):
+    """
+    Rows of the social information (see get_social_outputs) of a sequence (.csv)
+    """
+
+    sequence_data = dict(num_seq_list=[file_id])
+
+    num_objs_considered, _non_linear_obj, curr_loss_mask, curr_seq, \
+    curr_seq_rel, id_frame_list, object_class_list, city_id, ego_origin, non_linear = \
+        process_sequence_file(file_id, root_file_name, obs_len, pred_len, split, obs_origin, class_balance,
+                              cache_folder=cache_folder, trajectory_classifier=trajectory_classifier)
+
+    if num_objs_considered >= min_objs:
+        sequence_data["non_linear_obj"] = _non_linear_obj
+        sequence_data["seq_list"] = curr_seq[:num_objs_considered] # Remove dummies
+        sequence_data["seq_list_rel"] = curr_seq_rel[:num_objs_considered]
+        sequence_data["num_objs_in_seq"] = [num_objs_considered]
+        sequence_data["loss_mask_list"] = curr_loss_mask[:num_objs_considered]
+        ###################################################################
+        sequence_data["seq_id_list"] = id_frame_list[:num_objs_considered] # (timestamp, id, file_id)
+        sequence_data["object_class_id_list"] = object_class_list[:num_objs_considered] # obj_class (-1 0 1 2 2 2 2 ...)
+        sequence_data["object_id_list"] = id_frame_list[:num_objs_considered,1,0]
+        ###################################################################
+        sequence_data["city_id"] = [city_id]
+        sequence_data["ego_vehicle_origin"] = ego_origin
+        ###################################################################
+        if class_balance >= 0.0:
+            if non_linear == 1.0:
+                sequence_data["curved_trajectories_list"] = [file_id]
+            else:
+                sequence_data["straight_trajectories_list"] = [file_id]
+
+    return sequence_data
+
 class ArgoverseMotionForecastingDataset(Dataset):
     """Dataloder for the Trajectory datasets"""
     def __init__(self, dataset_name, root_folder, imgs_folder, obs_len=20, pred_len=30, distance_threshold=30,
                  split='train', split_percentage=0.1, start_from_percentage=0.0, 
                  batch_size=16, class_balance=-1.0, obs_origin=1, data_augmentation=False, apply_rotation=False, 
-                 physical_context="dummy", extra_data_train=-1.0, hard_mining=-1.0, preprocess_data=False, save_data=False):
+                 physical_context="dummy", extra_data_train=-1.0, hard_mining=-1.0, preprocess_data=False, save_data=False,
+                 preprocess_workers=1, raw_data_cache=False, trajectory_classifier="ransac", memory_mapping=False,
+                 data_container=False, incremental_preprocessing=False, rotated_data=False,
+                 augmentation_on_device=False, physical_context_cache=0):
         super(ArgoverseMotionForecastingDataset, self).__init__()
 
         # Initialize class variables
@@ -507,13 +666,27 @@ class ArgoverseMotionForecastingDataset(Dataset):
         self.class_balance = class_balance
         self.obs_origin = obs_origin
         self.min_objs = 2 # Minimum number of objects to include the scene (AV and AGENT)
-        self.cont_seqs = 0
-        self.cont_curved_trajs = 0
         self.data_augmentation = data_augmentation
         self.apply_rotation = apply_rotation
         self.physical_context = physical_context
         self.extra_data_train = extra_data_train
         self.hard_mining = hard_mining
+        self.preprocess_workers = preprocess_workers # If > 1, preprocess the raw .csvs in parallel (job chunks)
+        self.raw_data_cache = raw_data_cache # If True, keep a binary copy of the raw .csvs (faster re-preprocessing)
+        self.trajectory_classifier = trajectory_classifier # "ransac" or "vectorized" (straight/curved labels)
+        self.memory_mapping = memory_mapping # If True, memory-map the processed .npy files (final dtype, no copies)
+        self.data_container = data_container # If True, use a single .h5 container per split instead of .npy files
+        self.incremental_preprocessing = incremental_preprocessing # If True, only process new or modified .csvs
+        self.rotated_data = rotated_data # If True, load the data already rotated (preprocess/rotate_processed_data.py)
+        self.augmentation_on_device = augmentation_on_device # If True, the trainer applies the data augmentation
+                                                             # once the batch is in the training device
+        self.physical_context_cache = physical_context_cache # Number of decoded physical context assets (images)
+                                                             # kept in memory, shared by the DataLoader workers
+        
+        assert not (self.incremental_preprocessing and not self.data_container), \
+            "Incremental preprocessing requires the data container (manifest)"
+        assert not (self.rotated_data and not self.apply_rotation), \
+            "The rotated data requires apply_rotation (the predictions must be counter-rotated)"
         
         self.dataset_name = dataset_name
         self.root_folder = root_folder
@@ -521,11 +694,13 @@ class ArgoverseMotionForecastingDataset(Dataset):
         self.data_processed_folder = os.path.join(root_folder,
                                                   self.split,
                                                   f"data_processed_{str(int(split_percentage*100))}_percent")
+        self.data_container_filename = self.data_processed_folder + ".h5"
                                              
         if self.extra_data_train != -1.0 or self.hard_mining != -1.0:
             self.extra_data_processed_folder = os.path.join(root_folder,
                                                             "val",
                                                             f"data_processed_{str(int(split_percentage*100))}_percent")
+            self.extra_data_container_filename = self.extra_data_processed_folder + ".h5"
             self.class_balance = -1.0 # TODO: If we merge data from validation and train, then the stored variables
                                         # to do class balance are useless. Check this
             if self.split == "val":
@@ -559,108 +734,68 @@ class ArgoverseMotionForecastingDataset(Dataset):
                                                                                 # (in order to avoid unwanted overwriting, just in case ...)
     
 
-            seq_list = [] # Absolute coordinates (obs+pred) around 0.0 (center of the local map)
-            seq_list_rel = [] # Relative displacements (obs+pred)
-            num_objs_in_seq = [] 
-            loss_mask_list = []
-            non_linear_obj = [] # Object with non-linear trajectory
-            seq_id_list = []
-            object_class_id_list = [] # 0 = AV, 1 = AGENT, 2 = DUMMY 
-            object_id_list = [] 
-            num_seq_list = [] # ID of the current sequence
-            straight_trajectories_list = []
-            curved_trajectories_list = []
-            ego_vehicle_origin = [] # Origin of the AGENT (TODO: ego_vehicle_origin is a WRONG nomenclature)
-            city_ids = []
-
             print("Start Dataset")
             # TODO: Speed-up dataloading, avoiding objects further than X distance
 
-            time_per_iteration = float(0)
-            aux_time = float(0)
-
             t0 = time.time()
-            for i, file_id in enumerate(self.file_id_list):
-                start = time.time()
 
-                print(f"File {file_id} -> {i+1}/{len(self.file_id_list)}")
-                files_remaining = len(self.file_id_list) - (i+1)
-
-                num_seq_list.append(file_id)
-                path = os.path.join(root_file_name,str(file_id)+".csv")
-                data = dataset_utils.read_file(path) 
-            
-                frames = np.unique(data[:, 0]).tolist() # Get unique timestamps (50 in this case)
-                frame_data = []
-                for frame in frames:
-                    frame_data.append(data[frame == data[:, 0], :]) # save info for each frame
-
-                idx = 0
-
-                num_objs_considered, _non_linear_obj, curr_loss_mask, curr_seq, \
-                curr_seq_rel, id_frame_list, object_class_list, city_id, ego_origin = \
-                    process_window_sequence(idx, frame_data, frames,
-                                            self.obs_len, self.pred_len, 
-                                            file_id, self.split, self.obs_origin)
-
-                # Check if the current AGENT trajectory can be considered as a curve or straight trajectory
-                # (so for further training we can focus on the most difficult samples -> sequences in which
-                # the AGENT is performing a curved trajectory)
- 
-                if self.class_balance >= 0.0:
-                    agent_idx = int(np.where(object_class_list==1)[0])
-
-                    try:
-                        non_linear = geometric_functions.get_non_linear(file_id, curr_seq, idx=agent_idx, obj_kind=1,
-                                                                  threshold=2, debug_trajectory_classifier=False)
-                    except: # E.g. All max_trials iterations were skipped because each randomly chosen sub-sample 
-                            # failed the passing criteria. Return non-linear because RANSAC could not fit a model
-                        non_linear = 1.0
-
-                if num_objs_considered >= self.min_objs:
-                    non_linear_obj += _non_linear_obj
-                    seq_list.append(curr_seq[:num_objs_considered]) # Remove dummies
-                    seq_list_rel.append(curr_seq_rel[:num_objs_considered])
-                    num_objs_in_seq.append(num_objs_considered)
-                    loss_mask_list.append(curr_loss_mask[:num_objs_considered])
-                    ###################################################################
-                    seq_id_list.append(id_frame_list[:num_objs_considered]) # (timestamp, id, file_id)
-                    object_class_id_list.append(object_class_list[:num_objs_considered]) # obj_class (-1 0 1 2 2 2 2 ...)
-                    object_id_list.append(id_frame_list[:num_objs_considered,1,0])
-                    ###################################################################
-                    city_ids.append(city_id)
-                    ego_vehicle_origin.append(ego_origin)
-                    ###################################################################
-                    if self.class_balance >= 0.0:
-                        if non_linear == 1.0:
-                            curved_trajectories_list.append(file_id)
-                        else:
-                            straight_trajectories_list.append(file_id)
-
-                end = time.time()
-                aux_time += (end-start)
-                time_per_iteration = aux_time/(i+1)
-
-
-                print(f"Time per iteration: {time_per_iteration} s. \n \
-                        Estimated time to finish ({files_remaining} files): {round(time_per_iteration*files_remaining/60)} min")
+            cache_folder = os.path.join(root_folder,self.split,"data_cache") if self.raw_data_cache else None
+            params = dict(split=self.split, split_percentage=split_percentage, obs_len=self.obs_len,
+                          pred_len=self.pred_len, obs_origin=self.obs_origin, min_objs=self.min_objs,
+                          class_balance=self.class_balance, trajectory_classifier=self.trajectory_classifier)
+
+            # Incremental preprocessing: only process the new or modified files (w.r.t. the manifest
+            # of the container), as long as the container was generated with the same parameters
+
+            file_id_list = self.file_id_list
+            manifest, old_data = None, None
+
+            if self.incremental_preprocessing:
+                manifest, old_data, old_params = dataset_utils.load_manifest_from_h5(self.data_container_filename)
+                if old_params is not None and any(old_params.get(key) != value for key, value in params.items()):
+                    print("The preprocessing parameters changed. Process the whole split")
+                    manifest, old_data = None, None
+
+                manifest, file_id_list = dataset_utils.get_files_manifest(self.file_id_list, root_file_name, 
+                                                                          manifest=manifest)
+                if old_data is None: 
+                    file_id_list = self.file_id_list
+                print(f"Incremental preprocessing: {len(file_id_list)} new or modified files")
+
+            # Resumable job (checkpoints in job_folder). The processed sequences are streamed to job_folder
+            # (memory-mapped .npy files), so the memory does not depend on the size of the split, and an
+            # interrupted preprocessing resumes from its last checkpoint (the rows written after it are 
+            # discarded). The sequences that raise an exception are quarantined (not included)
+
+            job_folder = self.data_processed_folder + "_job"
+            job = dataset_utils.PreprocessingJob(job_folder, file_id_list,
+                                                 functools.partial(get_sequence_social_rows, root_file_name=root_file_name,
+                                                                   obs_len=self.obs_len, pred_len=self.pred_len,
+                                                                   split=self.split, obs_origin=self.obs_origin,
+                                                                   class_balance=self.class_balance,
+                                                                   min_objs=self.min_objs, cache_folder=cache_folder,
+                                                                   trajectory_classifier=self.trajectory_classifier),
+                                                 outputs=get_social_outputs(self.obs_len, self.pred_len, self.split),
+                                                 params=params, num_workers=self.preprocess_workers,
+                                                 chunk_size=PREPROCESS_CHUNK_SIZE)
+            social_data, quarantine = job.run()
+
+            if len(quarantine) > 0:
+                print(f"WARNING: {len(quarantine)} quarantined sequences (not included): ", 
+                      [file_id for file_id, _ in quarantine])
+
+            if old_data is not None:
+                social_data = dataset_utils.merge_processed_data(old_data, social_data,
+                                                                 self.file_id_list, file_id_list)
 
             print("Dataset time: ", time.time() - t0)
 
-            self.num_seq = len(seq_list)
-            
-            seq_list = np.concatenate(seq_list, axis=0) # Objects x 2 x seq_len
-            seq_list_rel = np.concatenate(seq_list_rel, axis=0)
-            loss_mask_list = np.concatenate(loss_mask_list, axis=0)
-            non_linear_obj = np.asarray(non_linear_obj)
-            seq_id_list = np.concatenate(seq_id_list, axis=0)
-            object_class_id_list = np.concatenate(object_class_id_list, axis=0)
-            object_id_list = np.concatenate(object_id_list)
-            num_seq_list = np.concatenate([num_seq_list])
-            curved_trajectories_list = np.concatenate([curved_trajectories_list])
-            straight_trajectories_list = np.concatenate([straight_trajectories_list])
-            ego_vehicle_origin = np.asarray(ego_vehicle_origin)
-            city_ids = np.asarray(city_ids)
+            seq_list, seq_list_rel, loss_mask_list, non_linear_obj, num_objs_in_seq, \
+            seq_id_list, object_class_id_list, object_id_list, ego_vehicle_origin, num_seq_list, \
+            straight_trajectories_list, curved_trajectories_list, city_ids = \
+                operator.itemgetter(*social_variables_names[:-2])(social_data)
+
+            self.num_seq = len(num_objs_in_seq)
 
             # Normalize abs and relative data ((your_vale - min) / (max - min))
 
@@ -677,43 +812,80 @@ class ArgoverseMotionForecastingDataset(Dataset):
             preprocess_data_dict = dataset_utils.create_dictionary_from_variable_list(social_variables_list, 
                                                                                       social_variables_names)
 
+            if self.incremental_preprocessing: # Keep the manifest and the physical information (merged)
+                preprocess_data_dict.update(manifest)
+                preprocess_data_dict.update({key: value for key, value in social_data.items()
+                                             if key not in preprocess_data_dict})
+                if "physical_data_valid" not in preprocess_data_dict:
+                    preprocess_data_dict["physical_data_valid"] = np.zeros(self.num_seq, dtype=np.int8)
+
             if save_data:
                 # Save numpy objects as npy 
 
-                print("Saving np data structures as .npy files ...")
-                dataset_utils.save_processed_data_as_npy(self.data_processed_folder, 
-                                                         preprocess_data_dict,
-                                                         split_percentage)
+                if not self.data_container:
+                    print("Saving np data structures as .npy files ...")
+                    dataset_utils.save_processed_data_as_npy(self.data_processed_folder, 
+                                                             preprocess_data_dict,
+                                                             split_percentage,
+                                                             streamed_folder=job_folder)
+                else: # New container (the physical information must be computed again, except for the
+                      # sequences with physical_data_valid = 1 in incremental preprocessing)
+                    print(f"Saving np data structures in {self.data_container_filename} ...")
+                    dataset_utils.save_processed_data_as_h5(self.data_container_filename,
+                                                            preprocess_data_dict,
+                                                            params=params, mode="w")
                 # assert 1 == 0 # Uncomment this if you want to stop after preprocessing and save
+
+            # The streamed files that have not been moved and the checkpoint are no longer needed (the 
+            # memory-mapped arrays remain valid until they are released)
+
+            job.cleanup()
         else:
             print("Loading .npy files as np data structures ...")
 
             required_variables_name_list = social_variables_names + physical_variables_names
 
-            preprocess_data_dict = dataset_utils.load_processed_files_from_npy(self.data_processed_folder, required_variables_name_list)
+            # Rotated data: load rotated_<name> instead of the variables that seq_collate would rotate
+
+            variables_to_load = [f"rotated_{key}" if self.rotated_data and key in dataset_utils.ROTATED_VARIABLES 
+                                 else key for key in required_variables_name_list]
+            def get_required_variables(data_dict):
+                return operator.itemgetter(*variables_to_load)(data_dict)
+
+            if self.data_container:
+                preprocess_data_dict = dataset_utils.load_processed_data_from_h5(self.data_container_filename, variables_to_load)
+            elif self.memory_mapping:
+                preprocess_data_dict = dataset_utils.load_processed_files_as_memmap(self.data_processed_folder, variables_to_load)
+            else:
+                preprocess_data_dict = dataset_utils.load_processed_files_from_npy(self.data_processed_folder, variables_to_load)
         
             seq_list, seq_list_rel, loss_mask_list, non_linear_obj, num_objs_in_seq, \
             seq_id_list, object_class_id_list, object_id_list, ego_vehicle_origin, num_seq_list, \
             straight_trajectories_list, curved_trajectories_list, city_ids, norm, target_agent_orientation, \
             oracle_centerlines, relevant_centerlines  = \
-                operator.itemgetter(*required_variables_name_list)(preprocess_data_dict)
+                get_required_variables(preprocess_data_dict)
             
             # TODO: Correct this for train and val. Map origin should be N x 2, not N x 1 x 2
             if self.split != "test":
-                ego_vehicle_origin = ego_vehicle_origin.squeeze(1)
+                ego_vehicle_origin = ego_vehicle_origin.reshape(-1,2) # N x 1 x 2 (old files) or N x 2
                 
             if self.extra_data_train != -1 or self.hard_mining != -1.0:
-                extra_preprocess_data_dict = dataset_utils.load_processed_files_from_npy(self.extra_data_processed_folder, required_variables_name_list)
+                if self.data_container:
+                    extra_preprocess_data_dict = dataset_utils.load_processed_data_from_h5(self.extra_data_container_filename, variables_to_load)
+                elif self.memory_mapping:
+                    extra_preprocess_data_dict = dataset_utils.load_processed_files_as_memmap(self.extra_data_processed_folder, variables_to_load)
+                else:
+                    extra_preprocess_data_dict = dataset_utils.load_processed_files_from_npy(self.extra_data_processed_folder, variables_to_load)
         
                 ex_seq_list, ex_seq_list_rel, ex_loss_mask_list, ex_non_linear_obj, ex_num_objs_in_seq, \
                 ex_seq_id_list, ex_object_class_id_list, ex_object_id_list, ex_ego_vehicle_origin, ex_num_seq_list, \
                 ex_straight_trajectories_list, ex_curved_trajectories_list, ex_city_ids, ex_norm, ex_target_agent_orientation, \
                 ex_oracle_centerlines, ex_relevant_centerlines  = \
-                    operator.itemgetter(*required_variables_name_list)(extra_preprocess_data_dict)
+                    get_required_variables(extra_preprocess_data_dict)
 
                 # TODO: Correct this for train and val. Map origin should be N x 2, not N x 1 x 2
                 if self.split != "test":
-                    ex_ego_vehicle_origin = ex_ego_vehicle_origin.squeeze(1)
+                    ex_ego_vehicle_origin = ex_ego_vehicle_origin.reshape(-1,2)
                 
                 num_val_files = len(ex_num_seq_list)
                 ex_cum_start_idx = [0] + np.cumsum(ex_num_objs_in_seq).tolist()
@@ -851,6 +1023,9 @@ class ArgoverseMotionForecastingDataset(Dataset):
         self.non_linear_obj = torch.from_numpy(non_linear_obj).type(torch.float)
         cum_start_idx = [0] + np.cumsum(num_objs_in_seq).tolist()
         self.seq_start_end = [(start, end) for start, end in zip(cum_start_idx, cum_start_idx[1:])]
+        self.seq_start_end_offsets = torch.tensor(cum_start_idx, dtype=torch.long) # num_seq + 1 (objects of 
+                                                                                   # the index-th sequence: 
+                                                                                   # offsets[index]:offsets[index+1])
 
         self.seq_id_list = torch.from_numpy(seq_id_list).type(torch.float)
         self.object_class_id_list = torch.from_numpy(object_class_id_list).type(torch.float)
@@ -863,19 +1038,17 @@ class ArgoverseMotionForecastingDataset(Dataset):
         self.curved_trajectories_list = torch.from_numpy(curved_trajectories_list).type(torch.int)
         self.norm = torch.from_numpy(np.array(norm))
 
-        # Shuffle the straight and curved trajectories
-        
-        self.num_straight_trajs = len(self.straight_trajectories_list)
-        self.num_curve_trajs = len(self.curved_trajectories_list)
-        self.straight_aux_list_random = self.straight_trajectories_list[torch.randperm(self.num_straight_trajs)]
-        self.curved_aux_list_random = self.curved_trajectories_list[torch.randperm(self.num_curve_trajs)]
-        
         self.num_seq_list = torch.from_numpy(num_seq_list).type(torch.int)
         self.num_seq = len(num_seq_list)
         
         self.target_agent_orientation = torch.from_numpy(target_agent_orientation).type(torch.float)
         self.oracle_centerlines = torch.from_numpy(oracle_centerlines).type(torch.float)
         self.relevant_centerlines = torch.from_numpy(relevant_centerlines).type(torch.float)
+
+        # Cache of decoded physical context assets (created here, before the DataLoader workers)
+
+        dataset_utils.init_physical_context_cache(os.path.join(self.root_folder,self.split,self.imgs_folder),
+                                                  self.physical_context, self.physical_context_cache)
         
         # self.map_info # dict with relevant centerlines, oracle centerline, width and height of plausible area, etc.
         # not used at this moment
@@ -891,119 +1064,199 @@ class ArgoverseMotionForecastingDataset(Dataset):
         32 because maybe there are not 34 csvs before this one)
         """
 
-        global APPLY_DATA_AUGMENTATION, APPLY_DATA_ROTATION, PHYSICAL_CONTEXT, DATA_IMGS_FOLDER, CURRENT_SPLIT
+        global APPLY_DATA_AUGMENTATION, APPLY_DATA_ROTATION, TARGET_AGENT_FRAME, PHYSICAL_CONTEXT, DATA_IMGS_FOLDER, CURRENT_SPLIT
 
         if not self.init_global_variables: # Execute only once
-            APPLY_DATA_AUGMENTATION = self.data_augmentation
-            APPLY_DATA_ROTATION = self.apply_rotation
+            APPLY_DATA_AUGMENTATION = self.data_augmentation and not self.augmentation_on_device # Otherwise, trainer
+            APPLY_DATA_ROTATION = self.apply_rotation and not self.rotated_data # Otherwise, already rotated
+            TARGET_AGENT_FRAME = self.apply_rotation
             PHYSICAL_CONTEXT = self.physical_context
             DATA_IMGS_FOLDER = os.path.join(self.root_folder,self.split,self.imgs_folder)
             CURRENT_SPLIT = self.split
 
             self.init_global_variables = True
 
-        DEBUG_TIME = False    
-        start_time = time.time()
-        if self.class_balance >= 0.0 and CURRENT_SPLIT == "train": # Only during training
-
-            if self.cont_seqs % self.batch_size == 0: # Get a new batch
-                self.cont_straight_traj = []
-                self.cont_curved_traj = []
-                self.cont_seqs = 0
+        if isinstance(index, (list, tuple)): # Whole batch (DataLoader with sampler=ArgoverseBatchSampler 
+                                             # and batch_size=None)
+            return self.get_batch(index)
 
-            if self.cont_seqs % self.batch_size == (self.batch_size-1):
-                assert len(self.cont_straight_traj) <= self.class_balance*self.batch_size
+        # N.B. Class balance and hard mining are applied by ArgoverseBatchSampler (it decides the 
+        # dataset indices of each batch), so this function only returns the index-th sequence
 
-            trajectory_index = self.num_seq_list[index]
-            straight_traj = True
-
-            if torch.any(torch.where(self.curved_trajectories_list == trajectory_index)[0]):
-                straight_traj = False
-            
-            if straight_traj:
-                if len(self.cont_straight_traj) >= int(self.class_balance*self.batch_size): # Include curve
-                    aux_index = self.curved_aux_list_random[0] # Number of .csv
-                    index = int(torch.where(self.num_seq_list == aux_index)[0]) # We actually need the number from 0 to N-1
-
-                    self.cont_curved_traj.append(index)
-                    self.curved_aux_list_random = self.curved_aux_list_random[1:] # Remove first element
-                    
-                    if len(self.curved_aux_list_random) == 0: # The tensor is empty
-                        self.curved_aux_list_random = self.curved_trajectories_list[torch.randperm(self.num_curve_trajs)]
-                        
-                else: # Include straight
-                    aux_index = self.straight_aux_list_random[0] # Number of .csv
-                    index = int(torch.where(self.num_seq_list == aux_index)[0]) # We actually need the number from 0 to N-1
-
-                    self.cont_straight_traj.append(index)
-                    self.straight_aux_list_random = self.straight_aux_list_random[1:] # Remove first element
-                    
-                    if len(self.straight_aux_list_random) == 0: # The tensor is empty
-                        self.straight_aux_list_random = self.straight_trajectories_list[torch.randperm(self.num_straight_trajs)]
-            else: # Include curve
-                aux_index = self.curved_aux_list_random[0] # Number of .csv
-                index = int(torch.where(self.num_seq_list == aux_index)[0]) # We actually need the number from 0 to N-1
-
-                self.cont_curved_traj.append(index)
-                self.curved_aux_list_random = self.curved_aux_list_random[1:] # Remove first element
-                
-                if len(self.curved_aux_list_random) == 0: # The tensor is empty
-                    self.curved_aux_list_random = self.curved_trajectories_list[torch.randperm(self.num_curve_trajs)]
-        
-        end_time = time.time()
-        if DEBUG_TIME: print("Time consumed by class balance: ", end_time-start_time)
-            
-        remainder = index % 2
+        msg = f"{self.split}" 
         
-        if self.cont_seqs % self.batch_size == 0: # Get a new batch
-            self.cont_standard_traj = []
-            self.cont_hm_traj = []
-            self.cont_seqs = 0
-        
-        if (self.hard_mining == -1.0 or 
-            self.split_percentage != 1.0 or \
-            (self.hard_mining != -1.0 
-             and remainder == 0 
-             and len(self.cont_standard_traj) < int((1-self.hard_mining)*self.batch_size))):
-              
-            msg = f"{self.split}" 
-            
-            self.cont_standard_traj.append(index)
-            
-            start, end = self.seq_start_end[index]
-            
-            out = [
-                    self.obs_traj[start:end, :, :], self.pred_traj_gt[start:end, :, :],
-                    self.obs_traj_rel[start:end, :, :], self.pred_traj_gt_rel[start:end, :, :],
-                    self.non_linear_obj[start:end], self.loss_mask[start:end, :],
-                    self.seq_id_list[start:end, :, :], self.object_class_id_list[start:end], 
-                    self.object_id_list[start:end], self.city_ids[index], self.ego_vehicle_origin[index,:], 
-                    self.num_seq_list[index], self.norm, self.target_agent_orientation[index],
-                    self.oracle_centerlines[index,:,:], self.relevant_centerlines[index,:,:,:], msg
-                    # self.relevant_centerlines[str(self.file_id_list[index])]
-                ]
-
-        else: # Apply only hard-mining if self.hard_mining != -1.0 and self.split_percentage == 1.0 (whole dataset)         
-            msg = "train:hard_mining" 
-            
-            hm_index = np.random.choice(self.hardest_sequences)
-            hm_start, hm_end = self.seq_start_end[hm_index]
-            
-            out = [
-                self.obs_traj[hm_start:hm_end, :, :], self.pred_traj_gt[hm_start:hm_end, :, :],
-                self.obs_traj_rel[hm_start:hm_end, :, :], self.pred_traj_gt_rel[hm_start:hm_end, :, :],
-                self.non_linear_obj[hm_start:hm_end], self.loss_mask[hm_start:hm_end, :],
-                self.seq_id_list[hm_start:hm_end, :, :], self.object_class_id_list[hm_start:hm_end], 
-                self.object_id_list[hm_start:hm_end], self.city_ids[hm_index], self.ego_vehicle_origin[hm_index,:], 
-                self.num_seq_list[hm_index], self.norm, self.target_agent_orientation[hm_index],
-                self.oracle_centerlines[hm_index,:,:], self.relevant_centerlines[hm_index,:,:,:], msg
-                # self.relevant_centerlines[str(self.file_id_list[hm_index])]
-                  ]
-
-        # Increase file count
+        start, end = self.seq_start_end[index]
         
-        self.cont_seqs += 1
+        out = [
+                self.obs_traj[start:end, :, :], self.pred_traj_gt[start:end, :, :],
+                self.obs_traj_rel[start:end, :, :], self.pred_traj_gt_rel[start:end, :, :],
+                self.non_linear_obj[start:end], self.loss_mask[start:end, :],
+                self.seq_id_list[start:end, :, :], self.object_class_id_list[start:end], 
+                self.object_id_list[start:end], self.city_ids[index], self.ego_vehicle_origin[index,:], 
+                self.num_seq_list[index], self.norm, self.target_agent_orientation[index],
+                self.oracle_centerlines[index,:,:], self.relevant_centerlines[index,:,:,:], msg
+                # self.relevant_centerlines[str(self.file_id_list[index])]
+            ]
             
         return out
 
+    def get_batch(self, indices):
+        """
+        Gather a whole batch (list of dataset indices) with a single index_select per field, using the
+        precomputed offsets of each sequence (seq_start_end_offsets) instead of slicing and concatenating
+        the sequences one by one. The fields are returned already concatenated (objects) or stacked 
+        (sequences), so seq_collate skips the zip/cat of the items
+        """
+
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        batch_size = len(indices)
+
+        # Index of every object of the batch in the contiguous tensors (objects of all sequences)
+
+        starts = self.seq_start_end_offsets[indices]
+        num_objs = self.seq_start_end_offsets[indices+1] - starts
+        batch_offsets = torch.zeros(batch_size+1, dtype=torch.long)
+        batch_offsets[1:] = torch.cumsum(num_objs, dim=0)
+
+        objs = torch.arange(batch_offsets[-1].item()) + torch.repeat_interleave(starts - batch_offsets[:-1], 
+                                                                                 num_objs)
+
+        batch = dict(obs_traj=self.obs_traj.index_select(0, objs),
+                     pred_traj_gt=self.pred_traj_gt.index_select(0, objs),
+                     obs_traj_rel=self.obs_traj_rel.index_select(0, objs),
+                     pred_traj_gt_rel=self.pred_traj_gt_rel.index_select(0, objs),
+                     non_linear_obj=self.non_linear_obj.index_select(0, objs),
+                     loss_mask=self.loss_mask.index_select(0, objs),
+                     seq_id_list=self.seq_id_list.index_select(0, objs),
+                     object_class_id_list=self.object_class_id_list.index_select(0, objs),
+                     object_id_list=self.object_id_list.index_select(0, objs),
+                     city_id=self.city_ids.index_select(0, indices),
+                     map_origin=self.ego_vehicle_origin.index_select(0, indices),
+                     num_seq_list=self.num_seq_list.index_select(0, indices),
+                     norm=self.norm.expand(batch_size, *self.norm.shape),
+                     target_agent_orientation=self.target_agent_orientation.index_select(0, indices),
+                     oracle_centerlines=self.oracle_centerlines.index_select(0, indices),
+                     relevant_centerlines=self.relevant_centerlines.index_select(0, indices),
+                     seq_start_end=torch.stack((batch_offsets[:-1], batch_offsets[1:]), dim=1),
+                     split_hm=[self.split]*batch_size)
+
+        return batch
+
+    def get_city_ids(self, num_seq):
+        """
+        City (dataset_utils.CITY_NAME_CODES) of the sequences num_seq (IDs of the .csv files, as returned
+        by seq_collate), looked up in the sorted IDs of the dataset
+        """
+
+        if not hasattr(self, "num_seq_order"):
+            self.num_seq_order = torch.argsort(self.num_seq_list)
+
+        num_seq = torch.as_tensor(num_seq).cpu().type(self.num_seq_list.dtype).reshape(-1)
+        sorted_num_seq = self.num_seq_list[self.num_seq_order]
+        indices = self.num_seq_order[torch.searchsorted(sorted_num_seq, num_seq).clamp(max=len(sorted_num_seq)-1)]
+        assert torch.equal(self.num_seq_list[indices], num_seq), "Sequences not included in the dataset"
+
+        return self.city_ids[indices]
+
+class ArgoverseBatchSampler(Sampler):
+    """
+    Yield the dataset indices of each batch. The batch composition is decided here, in the main process, 
+    so it is correct with any number of workers. Use it as sampler of the DataLoader with batch_size=None 
+    (the dataset gathers the whole batch at once, see get_batch) or as batch_sampler (item by item):
+
+    - Class balance (train split, class_balance >= 0.0): a sampled straight trajectory is replaced
+      by the next one of a shuffled queue of straight trajectories while the batch has less than 
+      int(class_balance*batch_size) straight trajectories. Otherwise, the sample is replaced by 
+      the next one of a shuffled queue of curved trajectories
+    - Hard mining (hard_mining != -1.0, whole split): the sampled index is kept if it is even and 
+      the batch has less than int((1-hard_mining)*batch_size) standard samples. Otherwise, a random
+      sequence of the hardest ones is included
+
+    The queues are precomputed arrays of dataset indices (reshuffled when exhausted), so the cost 
+    per sample is O(1)
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False):
+        self.num_seq = len(dataset)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+        self.class_balance = dataset.class_balance if dataset.split == "train" else -1.0
+        self.hard_mining = dataset.hard_mining if hasattr(dataset, "hardest_sequences") else -1.0
+
+        if self.class_balance >= 0.0:
+            # Number of .csv -> dataset index (from 0 to N-1)
+
+            num_seq_list = dataset.num_seq_list.numpy()
+            sorter = np.argsort(num_seq_list)
+            get_indices = lambda csv_ids: sorter[np.searchsorted(num_seq_list, csv_ids, sorter=sorter)]
+
+            self.queues = dict(straight=get_indices(dataset.straight_trajectories_list.numpy()),
+                               curved=get_indices(dataset.curved_trajectories_list.numpy()))
+            self.is_curved = np.zeros(self.num_seq, dtype=bool)
+            self.is_curved[self.queues["curved"]] = True
+            self.queues_position = dict(straight=len(self.queues["straight"]), curved=len(self.queues["curved"]))
+            self.queues_random = dict()
+
+        if self.hard_mining != -1.0:
+            self.hardest_sequences = np.asarray(dataset.hardest_sequences)
+
+    def next_from_queue(self, name):
+        """
+        Next dataset index of the straight/curved queue (shuffle the queue when it is exhausted)
+        """
+
+        if self.queues_position[name] == len(self.queues[name]):
+            self.queues_random[name] = self.queues[name][torch.randperm(len(self.queues[name])).numpy()]
+            self.queues_position[name] = 0
+
+        index = self.queues_random[name][self.queues_position[name]]
+        self.queues_position[name] += 1
+
+        return int(index)
+
+    def __iter__(self):
+        order = torch.randperm(self.num_seq).numpy() if self.shuffle else np.arange(self.num_seq)
+
+        for start in range(0, self.num_seq, self.batch_size):
+            sampled_indices = order[start:start+self.batch_size]
+            if self.drop_last and len(sampled_indices) < self.batch_size:
+                break
+
+            batch = []
+
+            if self.class_balance >= 0.0:
+                max_straight_trajs = int(self.class_balance*self.batch_size)
+                num_straight_trajs = 0
+
+                for index in sampled_indices:
+                    if ((not self.is_curved[index] and num_straight_trajs < max_straight_trajs)
+                        or len(self.queues["curved"]) == 0): # Include straight
+                        batch.append(self.next_from_queue("straight"))
+                        num_straight_trajs += 1
+                    else: # Include curve
+                        batch.append(self.next_from_queue("curved"))
+
+            elif self.hard_mining != -1.0:
+                max_standard_trajs = int((1-self.hard_mining)*self.batch_size)
+                num_standard_trajs = 0
+
+                for index in sampled_indices:
+                    if index % 2 == 0 and num_standard_trajs < max_standard_trajs:
+                        batch.append(int(index))
+                        num_standard_trajs += 1
+                    else:
+                        batch.append(int(np.random.choice(self.hardest_sequences)))
+
+            else:
+                batch = sampled_indices.tolist()
+
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_seq // self.batch_size
+        return math.ceil(self.num_seq / self.batch_size)
+
 
@@ -16,6 +16,14 @@ import csv
 import glob, glob2
 import pdb
 import time
+import json
+import zlib
+import hashlib
+import struct
+import shutil
+import math
+import mmap
+import multiprocessing
 
 # DL & Math imports
 
@@ -23,6 +31,7 @@ import numpy as np
 import torch
 import cv2
 import pandas as pd
+import h5py
 
 # Plot imports
 
@@ -31,6 +40,7 @@ import matplotlib.pyplot as plt
 # Custom imports
 
 import model.datasets.argoverse.goal_points_functions as goal_points_functions
+import model.datasets.argoverse.data_augmentation_functions as data_augmentation_functions
 import model.datasets.argoverse.map_functions as map_functions
 
 #######################################
@@ -46,6 +56,66 @@ RAW_DATA_FORMAT = {
     "CITY_NAME": 5,
 }
 
+OBJECT_TYPE_CODES = {
+    "AV": 0,
+    "AGENT": 1,
+    "OTHERS": 2,
+}
+
+CITY_NAME_CODES = {
+    "PIT": 0,
+    "MIA": 1,
+}
+
+# Processed data container (.h5)
+
+PROCESSED_DATA_SCHEMA_VERSION = 1
+
+OBJECT_VARIABLES = ['seq_list','seq_list_rel','loss_mask_list','non_linear_obj',
+                    'seq_id_list','object_class_id_list','object_id_list'] # One row per object
+SEQUENCE_VARIABLES = ['num_objs_in_seq','ego_vehicle_origin','num_seq_list','city_id',
+                      'target_agent_orientation','oracle_centerlines','relevant_centerlines',
+                      'physical_data_valid'] # One row per sequence
+SOCIAL_VARIABLES = OBJECT_VARIABLES + ['num_objs_in_seq','ego_vehicle_origin','num_seq_list','city_id',
+                                       'straight_trajectories_list','curved_trajectories_list','norm']
+MANIFEST_VARIABLES = ['manifest_file_id','manifest_hash','manifest_size','manifest_mtime'] # One row per .csv
+ROTATED_VARIABLES = ['seq_list','seq_list_rel','ego_vehicle_origin',
+                     'oracle_centerlines','relevant_centerlines'] # Stored as rotated_<name> (target agent frame)
+ROTATED_OBJECT_VARIABLES = [f"rotated_{key}" for key in ROTATED_VARIABLES if key in OBJECT_VARIABLES]
+ROTATED_SEQUENCE_VARIABLES = [f"rotated_{key}" for key in ROTATED_VARIABLES if key in SEQUENCE_VARIABLES]
+
+# Final dtype of the processed variables (the one of the torch tensors used by the dataset)
+
+MEMMAP_DTYPES = {
+    "seq_list": np.float32,
+    "seq_list_rel": np.float32,
+    "loss_mask_list": np.float32,
+    "non_linear_obj": np.float32,
+    "seq_id_list": np.float32,
+    "object_class_id_list": np.float32,
+    "object_id_list": np.float32,
+    "ego_vehicle_origin": np.float32,
+    "num_seq_list": np.int32,
+    "straight_trajectories_list": np.int32,
+    "curved_trajectories_list": np.int32,
+    "city_id": np.float32,
+    "target_agent_orientation": np.float32,
+    "oracle_centerlines": np.float32,
+    "relevant_centerlines": np.float32,
+    "rotated_seq_list": np.float32,
+    "rotated_seq_list_rel": np.float32,
+    "rotated_ego_vehicle_origin": np.float32,
+    "rotated_oracle_centerlines": np.float32,
+    "rotated_relevant_centerlines": np.float32,
+}
+
+# Discretized plausible area (preprocess/preprocess_plausible_area.py), stored in the split folder
+
+PLAUSIBLE_AREA_POINTS = 512 # Pixels per sequence
+PLAUSIBLE_AREA_FILES = {"file_ids": "map_features_file_ids.npy", # num_seq (int64)
+                        "points": "map_features_indeces.npy", # num_seq x PLAUSIBLE_AREA_POINTS x 2 (row, column; int16)
+                        "num_points": "map_features_num_points.npy"} # num_seq (int16, -1 if not processed)
+
 # File functions
 
 def isstring(string_test):
@@ -139,41 +209,166 @@ def apply_percentage_startfrom(file_id_list, num_files,
 
     return file_id_list
 
-def read_file(_path):
-    data = csv.DictReader(open(_path))
-    aux = []
-    id_list = []
-
-    num_agent = 0
-    for row in data:
-        values = list(row.values())
-        # object type 
-        values[2] = 0 if values[2] == "AV" else 1 if values[2] == "AGENT" else 2
-        if values[2] == 1:
-            num_agent += 1
-        # city
-        values[-1] = 0 if values[-1] == "PIT" else 1
-        # id
-        id_list.append(values[1])
-        # numpy_sequence
-        aux.append(values)
- 
-    id_list, id_idx = np.unique(id_list, return_inverse=True)
-    data = np.array(aux)
-    data[:, 1] = id_idx
-
-    return data.astype(np.float64)
+def save_npy_atomically(filename, value):
+    """
+    Save value as a .npy file through a temporary file of this process, so other processes (e.g. 
+    workers reading the same sequence) never read a partial file
+    """
 
-def get_origin_and_city(seq,obs_window):
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'wb') as my_file: np.save(my_file, value)
+    os.replace(tmp_filename, filename)
+
+def read_file_columns(_path, cache_folder=None):
     """
+    Parse a whole sequence (.csv) in a columnar way (vectorized) and encode the string
+    columns as integer codes (OBJECT_TYPE -> OBJECT_TYPE_CODES, CITY_NAME -> CITY_NAME_CODES,
+    TRACK_ID -> index in the sorted list of unique track ids).
+
+    If cache_folder is specified, a compact binary copy of the sequence (int16 frame indeces,
+    float32 coordinates w.r.t. a float64 origin) is stored as {file_id}.npy, so the next reads skip
+    the text parsing. N.B. Coordinates read from the cache have float32 precision w.r.t. the first
+    position of the sequence (error < 1e-3 m)
+    Output:
+        columns (dict): TIMESTAMP (float64), FRAME (int), TRACK_ID (int), OBJECT_TYPE (int), X, Y (float64),
+                        CITY_NAME (int) and TRACK_ID_NAMES (str, unique track ids)
     """
 
-    frames = np.unique(seq[:, 0]).tolist() 
-    frame_data = []
-    for frame in frames:
-        frame_data.append(seq[frame == seq[:, 0], :]) # save info for each frame
+    cache_filename = None
+    if cache_folder is not None:
+        file_id = os.path.basename(_path).split('.')[0]
+        cache_filename = os.path.join(cache_folder,file_id + ".npy")
+
+        cache = None
+        if (os.path.isfile(cache_filename)
+            and os.path.getmtime(cache_filename) >= os.path.getmtime(_path)):
+            try:
+                cache = np.load(cache_filename) # Single record (structured np.array), see below
+            except (OSError, ValueError, EOFError) as e: # Corrupted record. Parse the .csv again
+                print(f"{cache_filename} could not be read ({e}). Parsing {_path}")
+
+        if cache is not None:
+            frame = cache["frame"].astype(np.int64)
+            xy = cache["xy_origin"] + cache["xy_offset"].astype(np.float64)
+
+            columns = {
+                "TIMESTAMP": cache["frame_timestamps"][frame],
+                "FRAME": frame,
+                "TRACK_ID": cache["track_id"].astype(np.int64),
+                "OBJECT_TYPE": cache["object_type"].astype(np.int64),
+                "X": xy[:,0],
+                "Y": xy[:,1],
+                "CITY_NAME": np.full(frame.shape[0],int(cache["city_name"]),dtype=np.int64),
+                "TRACK_ID_NAMES": cache["track_id_names"]
+            }
+            return columns
+
+    # Split the whole file at once and convert each column (bytes) with a single numpy cast
+
+    with open(_path, 'rb') as my_file:
+        header, body = my_file.read().split(b'\n', 1)
+    header = header.strip().decode().split(',')
+    body = body.replace(b'\r', b'').strip()
+    fields = np.array(body.replace(b'\n', b',').split(b',') if body else [], dtype=bytes)
+    fields = fields.reshape(-1, len(header))
+    raw_columns = {key: fields[:,index] for index, key in enumerate(header)}
+
+    timestamps = raw_columns["TIMESTAMP"].astype(np.float64)
+    frame_timestamps, frame = np.unique(timestamps, return_inverse=True)
+    track_id_names, track_id = np.unique(raw_columns["TRACK_ID"].astype(str), return_inverse=True)
+
+    object_type = np.full(fields.shape[0],OBJECT_TYPE_CODES["OTHERS"],dtype=np.int64)
+    object_type[raw_columns["OBJECT_TYPE"] == b"AV"] = OBJECT_TYPE_CODES["AV"]
+    object_type[raw_columns["OBJECT_TYPE"] == b"AGENT"] = OBJECT_TYPE_CODES["AGENT"]
+
+    city_name = np.where(raw_columns["CITY_NAME"] == b"PIT",CITY_NAME_CODES["PIT"],CITY_NAME_CODES["MIA"])
+
+    columns = {
+        "TIMESTAMP": timestamps,
+        "FRAME": frame.reshape(-1).astype(np.int64),
+        "TRACK_ID": track_id.reshape(-1).astype(np.int64),
+        "OBJECT_TYPE": object_type,
+        "X": raw_columns["X"].astype(np.float64),
+        "Y": raw_columns["Y"].astype(np.float64),
+        "CITY_NAME": city_name.astype(np.int64),
+        "TRACK_ID_NAMES": track_id_names
+    }
+
+    if cache_filename is not None:
+        if not os.path.exists(cache_folder):
+            print("Create cache folder: ", cache_folder)
+            os.makedirs(cache_folder) # makedirs creates intermediate folders
+
+        num_rows, num_frames, num_tracks = frame.shape[0], frame_timestamps.shape[0], track_id_names.shape[0]
+        xy = np.vstack((columns["X"],columns["Y"])).T
+        xy_origin = xy[0,:] if num_rows > 0 else np.zeros((2))
+
+        # The whole sequence is stored as a single record, so it can be read with a single np.load
+
+        cache_dtype = np.dtype([("frame_timestamps", np.float64, (num_frames,)),
+                                ("frame", np.int16, (num_rows,)),
+                                ("track_id", np.int32, (num_rows,)),
+                                ("object_type", np.int8, (num_rows,)),
+                                ("xy_origin", np.float64, (2,)),
+                                ("xy_offset", np.float32, (num_rows,2)),
+                                ("city_name", np.int8),
+                                ("track_id_names", track_id_names.dtype, (num_tracks,))])
+        cache = np.zeros((), dtype=cache_dtype)
+        cache["frame_timestamps"] = frame_timestamps
+        cache["frame"] = columns["FRAME"]
+        cache["track_id"] = columns["TRACK_ID"]
+        cache["object_type"] = columns["OBJECT_TYPE"]
+        cache["xy_origin"] = xy_origin
+        cache["xy_offset"] = xy - xy_origin
+        cache["city_name"] = city_name[0] if num_rows > 0 else 0
+        cache["track_id_names"] = track_id_names
+
+        save_npy_atomically(cache_filename, cache)
+
+    return columns
+
+def read_file(_path, cache_folder=None):
+    """
+    Read a sequence (.csv) as a float64 np.array (n x 6) following RAW_DATA_FORMAT, where
+    TRACK_ID, OBJECT_TYPE and CITY_NAME are integer codes (see read_file_columns)
+    """
 
-    obs_frame = frame_data[obs_window-1]
+    columns = read_file_columns(_path, cache_folder=cache_folder)
+
+    data = np.zeros((columns["TIMESTAMP"].shape[0],len(RAW_DATA_FORMAT)))
+    for key, index in RAW_DATA_FORMAT.items():
+        data[:,index] = columns[key]
+
+    return data
+
+def read_agent_track(_path, cache_folder=None):
+    """
+    Return the AGENT track as an object np.array (n x 6) following RAW_DATA_FORMAT, with the original
+    strings (TRACK_ID, OBJECT_TYPE and CITY_NAME), i.e. the same format than
+    pd.read_csv(_path)[df["OBJECT_TYPE"] == "AGENT"].values used by MapFeaturesUtils
+    """
+
+    columns = read_file_columns(_path, cache_folder=cache_folder)
+    agent_rows = np.where(columns["OBJECT_TYPE"] == OBJECT_TYPE_CODES["AGENT"])[0]
+
+    city_names = {code: name for name, code in CITY_NAME_CODES.items()}
+
+    agent_track = np.empty((len(agent_rows),len(RAW_DATA_FORMAT)),dtype=object)
+    agent_track[:,RAW_DATA_FORMAT["TIMESTAMP"]] = columns["TIMESTAMP"][agent_rows]
+    agent_track[:,RAW_DATA_FORMAT["TRACK_ID"]] = columns["TRACK_ID_NAMES"][columns["TRACK_ID"][agent_rows]]
+    agent_track[:,RAW_DATA_FORMAT["OBJECT_TYPE"]] = "AGENT"
+    agent_track[:,RAW_DATA_FORMAT["X"]] = columns["X"][agent_rows]
+    agent_track[:,RAW_DATA_FORMAT["Y"]] = columns["Y"][agent_rows]
+    agent_track[:,RAW_DATA_FORMAT["CITY_NAME"]] = [city_names[code] for code in columns["CITY_NAME"][agent_rows]]
+
+    return agent_track
+
+def get_origin_and_city(seq,obs_window):
+    """
+    """
+
+    frames = np.unique(seq[:, 0]) 
+    obs_frame = seq[seq[:, 0] == frames[obs_window-1], :] # info of the last observation frame
 
     try:
         # Get [x,y] of the AGENT (object_class = 1) in the obs window
@@ -201,8 +396,11 @@ def create_dictionary_from_variable_list(variable_list, variable_name_list):
 
 def save_processed_data_as_npy(data_processed_folder, 
                                processed_data_dict,
-                               split_percentage):
+                               split_percentage,
+                               streamed_folder=None):
     """
+    Save each variable as data_processed_folder/<key>.npy. The variables streamed to streamed_folder
+    (ProcessedDataWriter) are moved instead of copied
     """
 
     if not os.path.exists(data_processed_folder):
@@ -211,7 +409,7 @@ def save_processed_data_as_npy(data_processed_folder,
 
     for key, value in processed_data_dict.items():
         filename = data_processed_folder + "/" + key + ".npy"
-        with open(filename, 'wb') as my_file: np.save(my_file, value)
+        save_npy(filename, value, streamed_folder=streamed_folder)
     
     split = data_processed_folder.split('/')[-2]
 
@@ -223,8 +421,9 @@ def save_processed_data_as_npy(data_processed_folder,
     with open(filename, 'wb') as my_file:
         my_file.write(string)
 
-def load_processed_files_from_npy(folder, required_variables_name_list):
+def load_processed_files_from_npy(folder, required_variables_name_list, mmap_mode=None):
     """
+    If mmap_mode is not None (e.g. "r", "c"), the .npy files are memory-mapped instead of read
     """
 
     preprocessed_files, num_files = load_list_from_folder(folder)
@@ -253,7 +452,8 @@ def load_processed_files_from_npy(folder, required_variables_name_list):
                 # Only load npy and npz files
 
                 if (preprocessed_file.find('npy') != -1):
-                    value = np.load(my_file)
+                    value = np.load(my_file) if mmap_mode is None \
+                            else np.load(preprocessed_file, mmap_mode=mmap_mode)
                     preprocessed_data_dict[key] = value
                 elif (preprocessed_file.find('npz') != -1):
                     value = np.load(my_file, allow_pickle=True)
@@ -265,8 +465,917 @@ def load_processed_files_from_npy(folder, required_variables_name_list):
         
     return preprocessed_data_dict
 
+def load_processed_files_as_memmap(folder, required_variables_name_list, chunk_size=100000):
+    """
+    Load the processed .npy files with memory mapping, so the DataLoader workers share the same
+    page-cache copy and the loading time does not depend on the size of the split. Each array
+    is converted (only once, by chunks) to its final dtype (MEMMAP_DTYPES) and stored in
+    folder/memmap, so the torch tensors can be created with torch.from_numpy without copies.
+    The arrays are mapped in copy-on-write mode (in-place modifications are not saved)
+    """
+
+    memmap_folder = os.path.join(folder,"memmap")
+    if not os.path.exists(memmap_folder):
+        print("Create path: ", memmap_folder)
+        os.mkdir(memmap_folder)
+
+    preprocessed_data_dict = load_processed_files_from_npy(folder, required_variables_name_list, mmap_mode="c")
+
+    for key, value in preprocessed_data_dict.items():
+        if key not in MEMMAP_DTYPES:
+            continue
+
+        filename = os.path.join(memmap_folder,key+".npy")
+        source_filename = os.path.join(folder,key+".npy")
+
+        if (not os.path.exists(filename) or os.path.getmtime(filename) < os.path.getmtime(source_filename)):
+            tmp_filename = os.path.join(memmap_folder,f"{key}_{os.getpid()}.tmp")
+            memmap = np.lib.format.open_memmap(tmp_filename, mode="w+", 
+                                               dtype=MEMMAP_DTYPES[key], shape=value.shape)
+            if value.ndim == 0:
+                memmap[()] = value
+            else:
+                for start in range(0, value.shape[0], chunk_size):
+                    memmap[start:start+chunk_size] = value[start:start+chunk_size]
+            memmap.flush()
+            del memmap
+            os.replace(tmp_filename, filename) # Atomic, in case several processes load the same split
+
+        preprocessed_data_dict[key] = np.load(filename, mmap_mode="c")
+
+    return preprocessed_data_dict
+
+# Streaming writers (preprocessing outputs)
+
+NPY_STREAM_HEADER_SIZE = 256 # bytes (fixed, so the header can be rewritten when the array grows)
+
+class NpyStreamWriter:
+    """
+    Growable .npy file written by rows. The data is written into a memory-mapped region after a
+    fixed-size header whose shape is rewritten on each flush, so the file is always a valid .npy
+    with the rows flushed so far. The capacity is doubled (file extended, not copied) when needed.
+    resume = True keeps appending to an existing file
+    """
+
+    def __init__(self, filename, dtype, row_shape=(), capacity=1024, resume=False):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape, dtype=np.int64))
+        self.length = 0
+
+        if resume and os.path.isfile(filename):
+            stored = np.load(filename, mmap_mode="r")
+            assert stored.dtype == self.dtype and stored.shape[1:] == self.row_shape, \
+                f"{filename} stores {stored.dtype} {stored.shape[1:]} rows, expected {self.dtype} {self.row_shape}"
+            self.length = stored.shape[0]
+            del stored
+            self.file = open(filename, "r+b")
+        else:
+            self.file = open(filename, "w+b")
+
+        self.capacity = 0
+        self.memmap = None
+        self.map(max(capacity, self.length, 1))
+        self.write_header()
+
+    def map(self, capacity):
+        if self.memmap is not None:
+            self.memmap.flush()
+            del self.memmap
+
+        self.file.truncate(NPY_STREAM_HEADER_SIZE + capacity * self.row_bytes)
+        self.memmap = np.memmap(self.file, dtype=self.dtype, mode="r+", offset=NPY_STREAM_HEADER_SIZE,
+                                shape=(capacity,) + self.row_shape)
+        self.capacity = capacity
+
+    def write_header(self):
+        header = repr({"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False,
+                       "shape": (self.length,) + self.row_shape})
+        header = header.ljust(NPY_STREAM_HEADER_SIZE - 11) + "\n"
+
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1,0) + struct.pack("<H", len(header)) + header.encode("latin1"))
+        self.file.flush()
+
+    def append(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        num_rows = rows.shape[0]
+
+        if self.length + num_rows > self.capacity:
+            self.map(max(2 * self.capacity, self.length + num_rows))
+
+        self.memmap[self.length:self.length+num_rows] = rows
+        self.length += num_rows
+
+    def flush(self):
+        self.memmap.flush()
+        self.write_header()
+
+    def truncate(self, length):
+        """
+        Discard the rows after the first length rows (e.g. written after the last checkpoint)
+        """
+
+        self.length = min(length, self.length)
+        self.flush()
+
+    def close(self):
+        """
+        Flush and remove the unused capacity
+        """
+
+        self.flush()
+        del self.memmap
+        self.memmap = None
+        self.file.truncate(NPY_STREAM_HEADER_SIZE + self.length * self.row_bytes)
+        self.file.close()
+
+    def __len__(self):
+        return self.length
+
+class ProcessedDataWriter:
+    """
+    Stream the processed variables (key -> rows, e.g. the objects of a finished sequence) into one
+    NpyStreamWriter per variable (folder/<key>.npy), flushed every flush_every writes, so the memory
+    does not depend on the number of sequences and the flushed sequences survive a crash. If folder
+    is None, the rows are kept in memory and concatenated when closing
+    """
+
+    def __init__(self, folder=None, flush_every=1000, resume=False):
+        self.folder = folder
+        self.flush_every = flush_every
+        self.resume = resume
+        self.num_writes = 0
+        self.writers = dict()
+        self.rows = dict() # folder = None: key -> (dtype, row_shape, list of rows)
+
+        if folder is not None and not os.path.exists(folder):
+            os.makedirs(folder) # makedirs creates intermediate folders
+
+    def declare(self, key, dtype, row_shape=()):
+        """
+        Create the variable beforehand, so it has the right dtype and shape even if no rows are written
+        """
+
+        if key in self.writers or key in self.rows:
+            return
+
+        if self.folder is None:
+            self.rows[key] = (np.dtype(dtype), tuple(row_shape), [])
+        else:
+            self.writers[key] = NpyStreamWriter(os.path.join(self.folder,key+".npy"), dtype, row_shape,
+                                                resume=self.resume)
+
+    def write(self, rows_dict):
+        for key, rows in rows_dict.items():
+            rows = np.asarray(rows)
+            self.declare(key, rows.dtype, rows.shape[1:])
+
+            if self.folder is None:
+                dtype, row_shape, rows_list = self.rows[key]
+                rows_list.append(rows.astype(dtype, copy=False).reshape((-1,) + row_shape))
+            else:
+                self.writers[key].append(rows)
+
+        self.num_writes += 1
+        if self.num_writes % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def lengths(self):
+        return {key: len(writer) for key, writer in self.writers.items()}
+
+    def truncate(self, lengths):
+        """
+        Keep the first lengths[key] rows of each variable (0 if key is not in lengths)
+        """
+
+        for key, writer in self.writers.items():
+            writer.truncate(lengths.get(key, 0))
+
+    def close(self, mmap_mode="c"):
+        """
+        Return the written variables (key -> np.array, memory-mapped with mmap_mode if they are on disk)
+        """
+
+        data = dict()
+
+        for key, (dtype, row_shape, rows_list) in self.rows.items():
+            data[key] = np.concatenate(rows_list, axis=0) if rows_list else np.zeros((0,) + row_shape, dtype=dtype)
+
+        for key, writer in self.writers.items():
+            writer.close()
+            data[key] = np.load(writer.filename, mmap_mode=mmap_mode)
+
+        return data
+
+def append_processed_data(writer, data_dict, chunk_size=100000):
+    """
+    Write the arrays of data_dict (e.g. memory-mapped shards) into writer in chunks of rows
+    """
+
+    for key, value in data_dict.items():
+        writer.declare(key, value.dtype, value.shape[1:])
+        for start in range(0, value.shape[0], chunk_size):
+            writer.write({key: value[start:start+chunk_size]})
+
+def save_npy(filename, value, streamed_folder=None):
+    """
+    Save value as a .npy file. If value is a whole array streamed to streamed_folder (ProcessedDataWriter),
+    the file is moved instead of copied
+    """
+
+    if (streamed_folder is not None and isinstance(value, np.memmap) and value.filename is not None 
+        and os.path.dirname(os.path.abspath(value.filename)) == os.path.abspath(streamed_folder)
+        and os.path.isfile(value.filename) and np.load(value.filename, mmap_mode="r").shape == value.shape):
+        os.replace(value.filename, filename)
+    else:
+        with open(filename, 'wb') as my_file: np.save(my_file, value)
+
+# Resumable preprocessing jobs
+
+def process_file_chunk(chunk_args):
+    """
+    Worker function (multiprocessing). Apply process_fn(index, file_id) to the files of a chunk. The
+    result of each file is (index, file_id, rows, None) or (index, file_id, None, error) if it failed
+    """
+
+    process_fn, chunk = chunk_args
+
+    results = []
+    for index, file_id in chunk:
+        try:
+            results.append((index, file_id, process_fn(index, file_id), None))
+        except Exception as e:
+            results.append((index, file_id, None, f"{type(e).__name__}: {e}"))
+
+    return results
+
+class PreprocessingJob:
+    """
+    Resumable preprocessing job over file_id_list. process_fn(index, file_id) returns the rows of a
+    file (key -> rows) or None. The files are processed in order, in chunks (in a pool of num_workers
+    processes if num_workers > 1), and the rows are streamed to job_folder (ProcessedDataWriter, declared
+    with outputs: key -> (dtype, row_shape)) or given to on_result(index, file_id, rows).
+    After each chunk (at most every checkpoint_every seconds) the outputs are flushed (on_checkpoint)
+    and job_folder/checkpoint.json stores the number of completed files, the length of each output and
+    the quarantine (files whose process_fn raised an exception, which do not stop the job). If
+    placeholder_fn(index, file_id) is specified, the rows it returns are written for the quarantined
+    files, so the outputs keep one row per file. A new job
+    over the same files and params resumes from the last checkpoint (the rows written after it are
+    discarded). The throughput and ETA are reported from the measured rate of the current run
+    """
+
+    def __init__(self, job_folder, file_id_list, process_fn, outputs=None, on_result=None, on_checkpoint=None,
+                 placeholder_fn=None, params=None, num_workers=1, chunk_size=100, checkpoint_every=60, 
+                 report_every=30, verbose=True):
+        self.job_folder = job_folder
+        self.file_id_list = [int(file_id) for file_id in file_id_list]
+        self.process_fn = process_fn
+        self.outputs = outputs if outputs is not None else dict()
+        self.on_result = on_result
+        self.on_checkpoint = on_checkpoint
+        self.placeholder_fn = placeholder_fn
+        self.params = params if params is not None else dict()
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.checkpoint_every = checkpoint_every
+        self.report_every = report_every
+        self.verbose = verbose
+
+        self.checkpoint_filename = os.path.join(job_folder,"checkpoint.json")
+        self.files_hash = hashlib.sha1(np.asarray(self.file_id_list, dtype=np.int64).tobytes()).hexdigest()
+
+        self.num_completed = 0
+        self.quarantine = [] # [file_id, error]
+        self.output_lengths = dict() # Length of each output after the last completed chunk
+        self.elapsed = 0.0 # s, previous runs
+
+    def load_checkpoint(self):
+        """
+        Last checkpoint of this job (same files and params) or None
+        """
+
+        if not os.path.isfile(self.checkpoint_filename):
+            return None
+
+        with open(self.checkpoint_filename) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        if checkpoint["files_hash"] != self.files_hash or checkpoint["params"] != json.loads(json.dumps(self.params)):
+            print(f"{self.job_folder} belongs to a different job. Start from scratch")
+            return None
+
+        return checkpoint
+
+    def save_checkpoint(self):
+        if self.writer is not None: self.writer.flush()
+        if self.on_checkpoint is not None: self.on_checkpoint()
+
+        checkpoint = dict(files_hash=self.files_hash,
+                          params=self.params,
+                          num_files=len(self.file_id_list),
+                          num_completed=self.num_completed,
+                          completed_file_ids=[self.file_id_list[0], self.file_id_list[self.num_completed-1]] 
+                                             if self.num_completed > 0 else [],
+                          output_lengths=self.output_lengths,
+                          quarantine=self.quarantine,
+                          elapsed=self.elapsed + time.time() - self.t0)
+
+        tmp_filename = self.checkpoint_filename + ".tmp"
+        with open(tmp_filename, 'w') as checkpoint_file: json.dump(checkpoint, checkpoint_file)
+        os.replace(tmp_filename, self.checkpoint_filename) # Atomic, the previous checkpoint is valid until here
+
+    def report(self, num_processed_run):
+        """
+        Progress, throughput (files/s of the current run) and ETA
+        """
+
+        elapsed_run = time.time() - self.t0
+        rate = num_processed_run / elapsed_run if elapsed_run > 0 else 0.0
+        files_remaining = len(self.file_id_list) - self.num_completed
+        eta = files_remaining / rate if rate > 0 else (0.0 if files_remaining == 0 else float("inf"))
+        eta = time.strftime("%H:%M:%S", time.gmtime(eta)) if math.isfinite(eta) and eta < 86400 \
+              else (f"{round(eta/3600)} h" if math.isfinite(eta) else "unknown")
+
+        print(f"{self.num_completed}/{len(self.file_id_list)} files "
+              f"({round(100*self.num_completed/max(1,len(self.file_id_list)),1)} %). "
+              f"Throughput: {round(rate,2)} files/s. ETA: {eta}. Quarantined: {len(self.quarantine)}")
+
+    def run(self):
+        """
+        Process the remaining files. Return the outputs (see ProcessedDataWriter.close) and the quarantine
+        """
+
+        if not os.path.exists(self.job_folder):
+            os.makedirs(self.job_folder) # makedirs creates intermediate folders
+
+        checkpoint = self.load_checkpoint()
+        resume = checkpoint is not None
+
+        if resume:
+            self.num_completed = checkpoint["num_completed"]
+            self.quarantine = checkpoint["quarantine"]
+            self.elapsed = checkpoint["elapsed"]
+            print(f"Resuming {self.job_folder}: {self.num_completed}/{len(self.file_id_list)} files completed, "
+                  f"{len(self.quarantine)} quarantined")
+
+        self.writer = None
+        if self.on_result is None:
+            self.writer = ProcessedDataWriter(self.job_folder, flush_every=np.iinfo(np.int64).max, resume=resume)
+            for key, (dtype, row_shape) in self.outputs.items():
+                self.writer.declare(key, dtype, row_shape)
+            if resume: # Also the outputs created after the last checkpoint
+                for filename in glob.glob(os.path.join(self.job_folder,"*.npy")):
+                    stored = np.load(filename, mmap_mode="r")
+                    self.writer.declare(os.path.basename(filename)[:-4], stored.dtype, stored.shape[1:])
+                    del stored
+                self.writer.truncate(checkpoint["output_lengths"])
+            self.output_lengths = self.writer.lengths()
+
+        self.t0 = time.time()
+        last_checkpoint = last_report = self.t0
+        num_processed_run = 0
+
+        pending = list(enumerate(self.file_id_list))[self.num_completed:]
+        chunks = [(self.process_fn, pending[start:start+self.chunk_size]) 
+                  for start in range(0, len(pending), self.chunk_size)]
+
+        if self.num_workers > 1:
+            pool = multiprocessing.Pool(processes=self.num_workers)
+            results = pool.imap(process_file_chunk, chunks) # Ordered
+        else:
+            pool = None
+            results = map(process_file_chunk, chunks)
+
+        try:
+            for chunk_results in results:
+                chunk_quarantine = []
+                for index, file_id, rows, error in chunk_results:
+                    if error is not None:
+                        print(f"Sequence {file_id} quarantined: {error}")
+                        chunk_quarantine.append([file_id, error])
+                        rows = self.placeholder_fn(index, file_id) if self.placeholder_fn is not None else None
+                    if rows is not None:
+                        if self.writer is not None: self.writer.write(rows)
+                        else: self.on_result(index, file_id, rows)
+
+                # The checkpoint state only changes once the whole chunk has been written, so if writing 
+                # fails halfway, resuming discards its rows and processes the chunk again
+
+                self.num_completed += len(chunk_results)
+                self.quarantine.extend(chunk_quarantine)
+                if self.writer is not None: self.output_lengths = self.writer.lengths()
+                num_processed_run += len(chunk_results)
+
+                now = time.time()
+                if now - last_checkpoint >= self.checkpoint_every:
+                    self.save_checkpoint()
+                    last_checkpoint = now
+                if self.verbose and now - last_report >= self.report_every:
+                    self.report(num_processed_run)
+                    last_report = now
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            self.save_checkpoint()
+
+        if self.verbose: self.report(num_processed_run)
+
+        outputs = self.writer.close() if self.writer is not None else dict()
+
+        return outputs, self.quarantine
+
+    def cleanup(self):
+        """
+        Remove the job folder (checkpoint and remaining outputs) once the outputs have been stored
+        """
+
+        shutil.rmtree(self.job_folder, ignore_errors=True)
+
+def load_plausible_area_points(folder, mmap_mode="r"):
+    """
+    Discretized plausible area of a split (see PLAUSIBLE_AREA_FILES), memory-mapped, so the points
+    of any sequence are read without loading the whole arrays
+    """
+
+    plausible_area_data = dict()
+    for key, filename in PLAUSIBLE_AREA_FILES.items():
+        plausible_area_data[key] = np.load(os.path.join(folder,filename), mmap_mode=mmap_mode)
+
+    return plausible_area_data
+
+def get_sequence_plausible_area_points(plausible_area_data, index):
+    """
+    Valid pixel coordinates (num_points x 2) of the sequence in position index of the split
+    """
+
+    num_points = max(int(plausible_area_data["num_points"][index]),0)
+    return np.asarray(plausible_area_data["points"][index,:num_points])
+
+def save_processed_data_as_h5(filename, processed_data_dict, params=None, mode="a",
+                              chunk_size=4096, compression=None):
+    """
+    Store the processed variables as columns of a single self-describing .h5 container. Each
+    column is chunked along the first axis (optionally compressed, e.g. "gzip", "lzf") and has
+    its CRC32 checksum. The container also stores the schema version, the preprocessing
+    parameters (params, merged with the existing ones) and an offsets index (start of the objects
+    of each sequence) for per-sequence random access.
+    mode = "w" creates a new container, mode = "a" adds/replaces columns (e.g. the physical 
+    information once the social information has been stored). Without num_objs_in_seq, the
+    container must already exist and have the offsets index (social information)
+    """
+
+    if "num_objs_in_seq" not in processed_data_dict:
+        has_offsets = False
+        if mode != "w" and os.path.isfile(filename):
+            with h5py.File(filename, "r") as h5_file:
+                has_offsets = "offsets" in h5_file
+        if not has_offsets:
+            raise ValueError(f"{filename} does not contain the social information (offsets index). " \
+                             f"Preprocess the social data of the split before adding {list(processed_data_dict.keys())}")
+
+    with h5py.File(filename, mode) as h5_file:
+        if "schema_version" not in h5_file.attrs:
+            h5_file.attrs["schema_version"] = PROCESSED_DATA_SCHEMA_VERSION
+        elif h5_file.attrs["schema_version"] != PROCESSED_DATA_SCHEMA_VERSION:
+            raise ValueError(f"{filename} uses the schema version {h5_file.attrs['schema_version']}, " \
+                             f"expected {PROCESSED_DATA_SCHEMA_VERSION}")
+
+        all_params = json.loads(h5_file.attrs.get("params", "{}"))
+        all_params.update(params if params else dict())
+        h5_file.attrs["params"] = json.dumps(all_params)
+
+        if "num_objs_in_seq" in processed_data_dict:
+            num_objs_in_seq = np.asarray(processed_data_dict["num_objs_in_seq"])
+            processed_data_dict = dict(processed_data_dict)
+            processed_data_dict["offsets"] = np.concatenate([[0],np.cumsum(num_objs_in_seq)]).astype(np.int64)
+            num_seqs = len(num_objs_in_seq)
+        elif "offsets" in h5_file:
+            num_seqs = len(h5_file["offsets"]) - 1
+        else:
+            num_seqs = None
+
+        for key, value in processed_data_dict.items():
+            value = np.ascontiguousarray(value)
+
+            if (key in SEQUENCE_VARIABLES + ROTATED_SEQUENCE_VARIABLES and num_seqs is not None 
+                and value.ndim > 0 and value.shape[0] != num_seqs):
+                raise ValueError(f"{key} has {value.shape[0]} sequences, expected {num_seqs}")
+
+            if key in h5_file:
+                del h5_file[key]
+
+            if value.ndim > 0 and value.shape[0] > 0:
+                chunks = (min(chunk_size,value.shape[0]),) + value.shape[1:]
+                column = h5_file.create_dataset(key, data=value, chunks=chunks, compression=compression)
+            else:
+                column = h5_file.create_dataset(key, data=value)
+            column.attrs["crc32"] = zlib.crc32(value.tobytes())
+
+def load_processed_data_from_h5(filename, required_variables_name_list, check_sum=True):
+    """
+    Load the required columns of a processed data container (.h5). Check the schema version,
+    the checksums (if check_sum) and that all the per-object and per-sequence columns 
+    correspond to the same sequences (offsets index)
+    """
+
+    preprocessed_data_dict = dict()
+
+    with h5py.File(filename, "r") as h5_file:
+        if h5_file.attrs.get("schema_version") != PROCESSED_DATA_SCHEMA_VERSION:
+            raise ValueError(f"{filename} uses the schema version {h5_file.attrs.get('schema_version')}, " \
+                             f"expected {PROCESSED_DATA_SCHEMA_VERSION}")
+
+        missing_variables = [key for key in required_variables_name_list if key not in h5_file]
+        if missing_variables:
+            raise ValueError(f"{filename} does not contain the variables {missing_variables}")
+
+        if "offsets" not in h5_file:
+            raise ValueError(f"{filename} does not contain the offsets index (the social information " \
+                             f"has not been stored)")
+        offsets = h5_file["offsets"][()]
+
+        for key in required_variables_name_list:
+            value = h5_file[key][()]
+
+            if check_sum and zlib.crc32(np.ascontiguousarray(value).tobytes()) != h5_file[key].attrs["crc32"]:
+                raise ValueError(f"Wrong checksum of {key} in {filename}")
+
+            if value.ndim > 0 and value.shape[0] > 0:
+                if key in OBJECT_VARIABLES + ROTATED_OBJECT_VARIABLES and value.shape[0] != offsets[-1]:
+                    raise ValueError(f"{key} has {value.shape[0]} objects, expected {offsets[-1]}")
+                if key in SEQUENCE_VARIABLES + ROTATED_SEQUENCE_VARIABLES and value.shape[0] != len(offsets) - 1:
+                    raise ValueError(f"{key} has {value.shape[0]} sequences, expected {len(offsets)-1}")
+
+            preprocessed_data_dict[key] = value
+
+    return preprocessed_data_dict
+
+def load_manifest_from_h5(filename):
+    """
+    Load the manifest (file id, content hash, size and modification time of each processed .csv),
+    all the processed columns and the preprocessing parameters of a container. If the container 
+    or its manifest does not exist, return None, None, None
+    """
+
+    if not os.path.exists(filename):
+        return None, None, None
+
+    with h5py.File(filename, "r") as h5_file:
+        if "manifest_file_id" not in h5_file:
+            return None, None, None
+        variables_name_list = [key for key in h5_file.keys() if key != "offsets"]
+        params = json.loads(h5_file.attrs.get("params", "{}"))
+
+    processed_data_dict = load_processed_data_from_h5(filename, variables_name_list)
+    manifest = {key: processed_data_dict.pop(key) for key in MANIFEST_VARIABLES}
+
+    return manifest, processed_data_dict, params
+
+def get_files_manifest(file_id_list, root_file_name, manifest=None):
+    """
+    Compute the manifest (content hash, size and modification time) of the .csv files of file_id_list.
+    The content hash is only computed again if the size or modification time of the file changed
+    w.r.t. the previous manifest.
+    Output:
+        manifest (dict of np.arrays), changed_file_id_list (new or modified files, same order
+        than file_id_list)
+    """
+
+    previous = dict()
+    if manifest is not None:
+        for file_id, content_hash, size, mtime in zip(*[manifest[key] for key in MANIFEST_VARIABLES]):
+            previous[int(file_id)] = (content_hash, size, mtime)
+
+    hashes, sizes, mtimes = [], [], []
+    changed_file_id_list = []
+
+    for file_id in file_id_list:
+        path = os.path.join(root_file_name,str(file_id)+".csv")
+        stat = os.stat(path)
+        content_hash, size, mtime = previous.get(file_id, (None, -1, -1))
+
+        if stat.st_size != size or stat.st_mtime_ns != mtime:
+            with open(path, 'rb') as my_file:
+                new_hash = hashlib.blake2b(my_file.read(), digest_size=16).hexdigest().encode()
+            if new_hash != content_hash:
+                changed_file_id_list.append(file_id)
+            content_hash = new_hash
+
+        hashes.append(content_hash)
+        sizes.append(stat.st_size)
+        mtimes.append(stat.st_mtime_ns)
+
+    manifest = dict()
+    manifest["manifest_file_id"] = np.asarray(file_id_list, dtype=np.int64)
+    manifest["manifest_hash"] = np.asarray(hashes, dtype="S32")
+    manifest["manifest_size"] = np.asarray(sizes, dtype=np.int64)
+    manifest["manifest_mtime"] = np.asarray(mtimes, dtype=np.int64)
+
+    return manifest, changed_file_id_list
+
+def merge_processed_data(old_data, new_data, file_id_list, processed_file_id_list):
+    """
+    Incremental preprocessing. Merge the previous processed data (old_data, all columns of the
+    container) with the data of the new or modified files (new_data, social columns of 
+    processed_file_id_list). The sequences of old_data whose file was processed again or is not in
+    file_id_list any more are replaced/removed. Sequences are sorted following file_id_list, so the
+    social columns are the same than processing the whole file_id_list. The physical columns of the
+    new sequences are filled with zeros and marked as not valid (physical_data_valid = 0), so they 
+    can be computed afterwards only for these sequences
+    """
+
+    file_id_list = np.asarray(file_id_list)
+    sorter = np.argsort(file_id_list, kind="stable")
+    def file_rank(file_ids): # Position of each file id in file_id_list
+        return sorter[np.searchsorted(file_id_list, file_ids, sorter=sorter)]
+
+    old_file_ids = np.asarray(old_data["num_seq_list"])
+    keep = np.isin(old_file_ids, file_id_list) & ~np.isin(old_file_ids, processed_file_id_list)
+    keep_index = np.where(keep)[0]
+    num_new_seqs = len(new_data["num_seq_list"])
+
+    # Order of the merged sequences (kept old sequences first, then the new ones, sorted by rank)
+
+    seq_file_ids = np.concatenate([old_file_ids[keep_index], new_data["num_seq_list"]])
+    order = np.argsort(file_rank(seq_file_ids), kind="stable")
+
+    # Object indices (kept old objects first, then the new ones) of each merged sequence
+
+    old_offsets = np.concatenate([[0],np.cumsum(old_data["num_objs_in_seq"])]).astype(np.int64)
+    num_objs = np.concatenate([old_data["num_objs_in_seq"][keep_index], new_data["num_objs_in_seq"]]).astype(np.int64)
+    starts = np.concatenate([[0],np.cumsum(num_objs)[:-1]]).astype(np.int64)
+    def concatenated_ranges(range_start, range_len): # [range_start[0],range_start[0]+range_len[0]), ...
+        return np.repeat(range_start - (np.cumsum(range_len) - range_len), range_len) + np.arange(range_len.sum())
+
+    old_objs = concatenated_ranges(old_offsets[keep_index], num_objs[:len(keep_index)])
+    objs_order = concatenated_ranges(starts[order], num_objs[order])
+
+    merged_data = dict()
+
+    for key, old_value in old_data.items():
+        if key in OBJECT_VARIABLES:
+            if len(old_value) == 0 and len(new_data[key]) == 0: # E.g. non_linear_obj in the test split
+                merged_data[key] = new_data[key]
+            else:
+                merged_data[key] = np.concatenate([old_value[old_objs], new_data[key]], axis=0)[objs_order]
+        elif key in SEQUENCE_VARIABLES:
+            new_value = new_data[key] if key in new_data else np.zeros((num_new_seqs,)+old_value.shape[1:], 
+                                                                       dtype=old_value.dtype)
+            merged_data[key] = np.concatenate([old_value[keep_index], new_value], axis=0)[order]
+        elif key in ['straight_trajectories_list','curved_trajectories_list']:
+            old_value = old_value[np.isin(old_value, old_file_ids[keep_index])]
+            value = np.concatenate([old_value, new_data[key]]).astype(new_data[key].dtype)
+            merged_data[key] = value[np.argsort(file_rank(value), kind="stable")]
+
+    if "physical_data_valid" not in merged_data:
+        merged_data["physical_data_valid"] = np.zeros(len(seq_file_ids), dtype=np.int8)
+
+    return merged_data
+
+def replace_sequence_rows_h5(filename, sequence_index, rows_dict, params=None):
+    """
+    Incremental preprocessing. Replace the rows sequence_index of the per-sequence columns of a 
+    container (e.g. physical information computed only for the new sequences) and mark them as
+    valid (physical_data_valid = 1, unless rows_dict contains physical_data_valid). Missing columns are created (filled with zeros). The rotated 
+    columns (if any) are removed, since they depend on the replaced rows (see get_rotated_data)
+    """
+
+    with h5py.File(filename, "r") as h5_file:
+        if "offsets" not in h5_file:
+            raise ValueError(f"{filename} does not contain the offsets index (the social information " \
+                             f"has not been stored)")
+        num_seqs = len(h5_file["offsets"]) - 1
+        columns = {key: h5_file[key][()] for key in list(rows_dict.keys()) + ["physical_data_valid"]
+                   if key in h5_file}
+
+    for key, rows in rows_dict.items():
+        rows = np.asarray(rows)
+        if key not in columns:
+            columns[key] = np.zeros((num_seqs,)+rows.shape[1:], dtype=rows.dtype)
+        elif columns[key].shape[1:] != rows.shape[1:]:
+            raise ValueError(f"The rows of {key} have shape {rows.shape[1:]}, expected {columns[key].shape[1:]}")
+        columns[key][sequence_index] = rows
+
+    if "physical_data_valid" not in columns:
+        columns["physical_data_valid"] = np.zeros(num_seqs, dtype=np.int8)
+    if "physical_data_valid" not in rows_dict:
+        columns["physical_data_valid"][sequence_index] = 1
+
+    save_processed_data_as_h5(filename, columns, params=params, mode="a")
+
+    with h5py.File(filename, "a") as h5_file:
+        for key in ROTATED_OBJECT_VARIABLES + ROTATED_SEQUENCE_VARIABLES:
+            if key in h5_file:
+                del h5_file[key]
+
+def get_rotated_data(processed_data_dict, chunk_size=100000):
+    """
+    Rotate the trajectories, origin and centerlines of each sequence to align the last observation 
+    of the target agent with the Y-axis (the same rotation that seq_collate applies to every batch 
+    if apply_rotation, but computed only once). Return the rotated variables (ROTATED_VARIABLES) 
+    as rotated_<name>. The relative displacements are rotated as well (rotation is linear) and 
+    target_agent_orientation is not modified (required to counter-rotate the predictions)
+    """
+
+    target_agent_orientation = torch.from_numpy(np.asarray(processed_data_dict["target_agent_orientation"],
+                                                           dtype=np.float64))
+    R = data_augmentation_functions.get_target_frame_rotation(target_agent_orientation)
+    num_seqs = len(R)
+
+    num_objs_in_seq = np.asarray(processed_data_dict["num_objs_in_seq"]).astype(np.int64)
+    object_seq = np.repeat(np.arange(num_seqs), num_objs_in_seq) # Sequence of each object
+
+    rotated_data_dict = dict()
+
+    for key in ROTATED_VARIABLES:
+        value = np.asarray(processed_data_dict[key])
+        rotated_value = np.zeros(value.shape, dtype=value.dtype)
+
+        for start in range(0, value.shape[0], chunk_size):
+            chunk = torch.from_numpy(np.asarray(value[start:start+chunk_size], dtype=np.float64))
+
+            if key in OBJECT_VARIABLES: # num_objects x 2 (x|y) x seq_len
+                index = torch.from_numpy(object_seq[start:start+chunk_size])
+                chunk = data_augmentation_functions.rotate_traj_batch(chunk.transpose(1,2), R, 
+                                                                      index=index).transpose(1,2)
+            else: # num_seqs x ... x 2
+                chunk = data_augmentation_functions.rotate_traj_batch(chunk, R[start:start+chunk_size])
+
+            rotated_value[start:start+chunk_size] = chunk.numpy()
+
+        rotated_data_dict[f"rotated_{key}"] = rotated_value
+
+    return rotated_data_dict
+
+def load_sequence_from_h5(h5_file, index, required_variables_name_list):
+    """
+    Per-sequence random access. h5_file is an opened h5py.File. Only the chunks of the index-th 
+    sequence are read (objects: offsets[index]:offsets[index+1], sequences: index)
+    """
+
+    start, end = h5_file["offsets"][index:index+2]
+
+    sequence_data_dict = dict()
+    for key in required_variables_name_list:
+        if key in OBJECT_VARIABLES + ROTATED_OBJECT_VARIABLES:
+            sequence_data_dict[key] = h5_file[key][start:end]
+        elif key in SEQUENCE_VARIABLES + ROTATED_SEQUENCE_VARIABLES:
+            sequence_data_dict[key] = h5_file[key][index]
+        else:
+            sequence_data_dict[key] = h5_file[key][()]
+
+    return sequence_data_dict
+
 # Physical information functions
 
+PHYSICAL_CONTEXT_IMG_SIZE = 600 # pixels (rows = cols) of the decoded images (visual and goals)
+PHYSICAL_CONTEXT_CACHES = dict() # (data_imgs_folder, physical_context, shape) -> PhysicalContextCache
+
+class PhysicalContextCache:
+    """
+    Bounded cache of decoded physical context assets (e.g. resized images) with a fixed shape,
+    keyed by the sequence id. The entries, keys, LRU stamps and hit/miss counters are stored in an
+    anonymous shared memory map, so the cache created before the DataLoader workers are forked is 
+    shared by all of them (otherwise, each process has its own cache).
+    It is set-associative: a key can only be stored in one of the ways of the set key % num_sets, and
+    the least recently used way of the set is replaced
+    """
+
+    def __init__(self, num_entries, shape, dtype=np.uint8, ways=8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ways = min(ways, num_entries)
+        self.num_sets = math.ceil(num_entries / self.ways)
+
+        num_slots = self.num_sets * self.ways
+        header_size = (2 * num_slots + 3) * 8 # keys, stamps, counters (int64)
+        entry_size = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        self.buffer = mmap.mmap(-1, header_size + num_slots * entry_size) # Pages allocated on first write
+        self.keys = np.frombuffer(self.buffer, dtype=np.int64, count=num_slots, offset=0)
+        self.stamps = np.frombuffer(self.buffer, dtype=np.int64, count=num_slots, offset=num_slots*8)
+        self.counters = np.frombuffer(self.buffer, dtype=np.int64, count=3, offset=2*num_slots*8) # clock, hits, misses
+        self.entries = np.frombuffer(self.buffer, dtype=self.dtype, count=num_slots*int(np.prod(self.shape)),
+                                     offset=header_size).reshape((num_slots,) + self.shape)
+        self.keys[:] = -1
+
+        self.lock = multiprocessing.Lock()
+
+    def get_set(self, key):
+        """
+        Slots (slice) of the set of key
+        """
+
+        first_slot = (key % self.num_sets) * self.ways
+        return slice(first_slot, first_slot + self.ways)
+
+    def get(self, key):
+        """
+        Copy of the entry of key (None if it is not stored)
+        """
+
+        slots = self.get_set(key)
+
+        with self.lock:
+            way = np.flatnonzero(self.keys[slots] == key)
+            if len(way) == 0:
+                self.counters[2] += 1
+                return None
+
+            slot = slots.start + way[0]
+            self.counters[0] += 1
+            self.stamps[slot] = self.counters[0]
+            self.counters[1] += 1
+
+            return self.entries[slot].copy()
+
+    def put(self, key, value):
+        """
+        Store value (shape and dtype of the cache), replacing the least recently used way of its set
+        """
+
+        slots = self.get_set(key)
+
+        with self.lock:
+            way = np.flatnonzero(self.keys[slots] == key)
+            way = way[0] if len(way) > 0 else np.argmin(self.stamps[slots]) # Empty slots have stamp 0
+            slot = slots.start + way
+
+            self.keys[slot] = key
+            self.entries[slot] = value
+            self.counters[0] += 1
+            self.stamps[slot] = self.counters[0]
+
+    def get_or_load(self, key, load_fn):
+        """
+        Entry of key, calling load_fn() (outside the lock) and storing the result if it is not stored
+        """
+
+        value = self.get(key)
+        if value is None:
+            value = load_fn()
+            self.put(key, value)
+
+        return value
+
+    def stats(self):
+        """
+        Number of hits, misses and stored entries
+        """
+
+        with self.lock:
+            return dict(hits=int(self.counters[1]), misses=int(self.counters[2]),
+                        entries=int(np.count_nonzero(self.keys >= 0)))
+
+def init_physical_context_cache(data_imgs_folder, physical_context, num_entries, img_size=PHYSICAL_CONTEXT_IMG_SIZE):
+    """
+    Create the cache of decoded assets of physical_context ("visual" or "goals") of the images in
+    data_imgs_folder (one cache per split) with num_entries entries. Must be called before the 
+    DataLoader workers are created to be shared by them
+    """
+
+    shapes = {"visual": (img_size,img_size,3), # RGB image
+              "goals": (img_size,img_size)} # plausible area mask (grayscale)
+
+    if num_entries <= 0 or physical_context not in shapes:
+        return None
+
+    key = (data_imgs_folder, physical_context, shapes[physical_context])
+    if key not in PHYSICAL_CONTEXT_CACHES:
+        PHYSICAL_CONTEXT_CACHES[key] = PhysicalContextCache(num_entries, shapes[physical_context])
+
+    return PHYSICAL_CONTEXT_CACHES[key]
+
+def load_physical_context_asset(data_imgs_folder, physical_context, seq_id, shape, load_fn):
+    """
+    Decoded asset of the sequence seq_id, read from the cache of (data_imgs_folder, physical_context,
+    shape) if it exists
+    """
+
+    cache = PHYSICAL_CONTEXT_CACHES.get((data_imgs_folder, physical_context, tuple(shape)))
+    if cache is None:
+        return load_fn()
+
+    return cache.get_or_load(seq_id, load_fn)
+
+def load_visual_context(filename, img_size=PHYSICAL_CONTEXT_IMG_SIZE):
+    """
+    RGB image (img_size x img_size x 3, uint8) of the rasterized map of a sequence
+    """
+
+    img = cv2.imread(filename)
+    if img.shape[:2] != (img_size,img_size):
+        img = cv2.resize(img, dsize=(img_size,img_size))
+
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
 def load_physical_information(num_seq_list, obs_traj, obs_traj_rel, pred_traj_gt, pred_traj_gt_rel,
                               first_obs, map_origin, dist_rasterized_map, object_class_id_list, 
                               data_imgs_folder, physical_context="dummies",relevant_centerlines=None,
@@ -284,6 +1393,7 @@ def load_physical_information(num_seq_list, obs_traj, obs_traj_rel, pred_traj_gt
     batch_size = len(object_class_id_list)
     dist_around = abs(dist_rasterized_map[0])
     physical_context_list = []
+    goals_masks, goals_obs_seqs, goals_origins = [], [], []
 
     t0_idx = 0
     for i in range(batch_size):    
@@ -317,29 +1427,32 @@ def load_physical_information(num_seq_list, obs_traj, obs_traj_rel, pred_traj_gt
         filename = os.path.join(data_imgs_folder,str(curr_num_seq) + ".png")
 
         if physical_context == "visual":
-            # TODO: Not used at this moment, but could be interesting. 
-            # Use the new plot functions using Argoverse standard
-            # The img should be normalized between 0 and 1
-            img = map_functions.plot_trajectories(filename, curr_obs_traj_rel, curr_first_obs, 
-                                                  curr_map_origin, curr_object_class_id, dist_rasterized_map,
-                                                  rot_angle=-1,obs_len=obs_len, smoothen=True, show=False)
+            # Decoded (and resized) image of the rasterized map, cached by sequence id. 
+            # The img is normalized between 0 and 1
+
+            img_shape = (PHYSICAL_CONTEXT_IMG_SIZE,PHYSICAL_CONTEXT_IMG_SIZE,3)
+            img = load_physical_context_asset(data_imgs_folder, "visual", curr_num_seq, img_shape,
+                                              lambda: load_visual_context(filename))
             if DEBUG_IMAGES:
                 print("frames path: ", data_imgs_folder)
                 print("curr seq: ", str(curr_num_seq))
                 filename = data_imgs_folder + "seq_" + str(curr_num_seq) + ".png"
                 print("path: ", filename)
-                img = img * 255.0
-                cv2.imwrite(filename,img)
+                cv2.imwrite(filename,cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
             
-            plt.close("all")
-            physical_context_list.append(img)
+            physical_context_list.append(img.astype(np.float32) / 255.0)
 
         elif physical_context == "goals":
             agent_obs_seq = curr_obs_traj[:,agent_index,:] # 20 x 2, "abs" (around 0)
             agent_obs_seq_global = agent_obs_seq + curr_map_origin # abs (hdmap coordinates)
 
-            goal_points = goal_points_functions.get_goal_points(filename, agent_obs_seq_global, curr_map_origin, dist_around)
-            physical_context_list.append(goal_points)
+            # The goal points of the whole batch are computed at once after the loop
+
+            mask_shape = (PHYSICAL_CONTEXT_IMG_SIZE,PHYSICAL_CONTEXT_IMG_SIZE)
+            goals_masks.append(load_physical_context_asset(data_imgs_folder, "goals", curr_num_seq, mask_shape,
+                                                           lambda: goal_points_functions.load_goal_points_mask(filename)))
+            goals_obs_seqs.append(np.asarray(agent_obs_seq_global))
+            goals_origins.append(np.asarray(curr_map_origin).reshape(2))
 
         elif physical_context == "plausible_centerlines+area":
             filename = os.path.join(data_imgs_folder,str(curr_num_seq) + "_binary_plausible_area_filtered.png")
@@ -374,6 +1487,10 @@ def load_physical_information(num_seq_list, obs_traj, obs_traj_rel, pred_traj_gt
 
         t0_idx = t1_idx
 
+    if physical_context == "goals":
+        physical_context_list = goal_points_functions.get_goal_points_batch(np.stack(goals_masks), np.stack(goals_obs_seqs),
+                                                                            np.stack(goals_origins), dist_around)
+
     physical_context_arr = np.array(physical_context_list)
     return physical_context_arr
 
@@ -128,15 +128,15 @@ def get_non_linear(file_id, curr_seq, idx=0, obj_kind=2, threshold=2, debug_traj
 
     # Study distance from intermediate points to the line that links the first and last point
 
-    first_point = (agent_x[0], agent_y[0], 0)
-    last_point = (agent_x[-1], agent_y[-1], 0)
+    first_point = (agent_x[0,0], agent_y[0,0], 0)
+    last_point = (agent_x[-1,0], agent_y[-1,0], 0)
     num_out = 0
     num_far_out = 0
     num_close_out = 0
     flag = False
 
     for index in range(num_points):
-        point = (agent_x[index], agent_y[index], 0)
+        point = (agent_x[index,0], agent_y[index,0], 0)
         dist,_ = pnt2line(point,first_point,last_point)
         # print("index, dist: ", index, dist)
         if dist >= threshold:  
@@ -227,6 +227,222 @@ def get_non_linear(file_id, curr_seq, idx=0, obj_kind=2, threshold=2, debug_traj
         plt.show()
     return non_linear
 
+def _segment_count(events, resets):
+    """
+    Vectorized version of a counter that is increased with each event and set to 0 after each reset
+    (for each row). count[:,i] is the value of the counter at position i, before applying the reset
+    of position i
+    """
+
+    num_events = np.cumsum(events, axis=1)
+    reset_index = np.where(resets, np.arange(events.shape[1]), -1)
+    last_reset = np.maximum.accumulate(reset_index, axis=1)[:, :-1] # Last reset before each position
+    last_reset = np.concatenate([-np.ones((events.shape[0],1),dtype=int), last_reset], axis=1)
+
+    num_events_before = np.take_along_axis(num_events, np.maximum(last_reset,0), axis=1)
+    num_events_before[last_reset < 0] = 0
+
+    return num_events - num_events_before
+
+def _weighted_line_fit(x, y, weights):
+    """
+    Closed-form weighted least squares fit y = slope*x + intercept (for each row). If x is constant, 
+    slope = 0 (same as the minimum norm solution of sklearn LinearRegression)
+    """
+
+    num_points = weights.sum(axis=1)
+    x_mean = (weights*x).sum(axis=1) / num_points
+    y_mean = (weights*y).sum(axis=1) / num_points
+    dx = x - x_mean[:,np.newaxis]
+    dy = y - y_mean[:,np.newaxis]
+
+    sxx = (weights*dx*dx).sum(axis=1)
+    sxy = (weights*dx*dy).sum(axis=1)
+    slope = np.divide(sxy, sxx, out=np.zeros_like(sxy), where=sxx > 1e-12)
+    intercept = y_mean - slope*x_mean
+
+    return slope, intercept
+
+def get_non_linear_batch(seqs, threshold=2, num_min_outliers=8, num_fit_iterations=10):
+    """
+    Vectorized version of get_non_linear. Classify N trajectories (N x 2 (x,y) x num_points), e.g. all 
+    the objects of a sequence or a whole shard, as straight (0.0) or curved (1.0) in a single pass.
+    RANSAC is replaced by a deterministic robust line fit (least trimmed squares: least squares with
+    all points and then iteratively refit with the round(0.6*num_points) points with lowest residual,
+    same as RANSAC min_samples). The consecutive-outlier and point-to-chord rules are the same 
+    """
+
+    seqs = np.asarray(seqs, dtype=np.float64)
+    num_trajs, _, num_points = seqs.shape
+    if num_trajs == 0:
+        return np.zeros((0))
+
+    agent_x = seqs[:,0,:]
+    agent_y = seqs[:,1,:]
+
+    # Robust line fit
+
+    num_samples = round(0.6*num_points)
+    weights = np.ones_like(agent_x)
+    slope, intercept = _weighted_line_fit(agent_x, agent_y, weights)
+
+    for _ in range(num_fit_iterations):
+        residuals = np.abs(agent_y - (slope[:,np.newaxis]*agent_x + intercept[:,np.newaxis]))
+        trimmed = np.argsort(residuals, axis=1, kind="stable")[:, :num_samples]
+        weights = np.zeros_like(agent_x)
+        np.put_along_axis(weights, trimmed, 1.0, axis=1)
+        slope, intercept = _weighted_line_fit(agent_x, agent_y, weights)
+
+    residuals = np.abs(agent_y - (slope[:,np.newaxis]*agent_x + intercept[:,np.newaxis]))
+    outliers = residuals > threshold
+
+    ## Study consecutive outliers
+
+    num_consecutive_outliers = _segment_count(outliers, ~outliers)
+    ransac_flag = np.any(outliers & (num_consecutive_outliers >= num_min_outliers), axis=1)
+
+    # Study distance from intermediate points to the line that links the first and last point
+
+    line_vec = seqs[:,:,-1:] - seqs[:,:,:1] # N x 2 x 1
+    pnt_vec = seqs - seqs[:,:,:1] # N x 2 x num_points
+    line_len = np.sum(line_vec**2, axis=1) # N x 1 (squared)
+    degenerate = line_len[:,0] == 0 # First point == last point. get_non_linear fails -> curve
+
+    t = np.divide(np.sum(line_vec*pnt_vec, axis=1), line_len, 
+                  out=np.zeros((num_trajs,num_points)), where=line_len > 0)
+    t = np.clip(t, 0.0, 1.0)
+    dist = np.linalg.norm(pnt_vec - t[:,np.newaxis,:]*line_vec, axis=1) # N x num_points
+
+    out = dist >= threshold
+    far_out = dist >= threshold*1.5
+    close_out = dist >= round(0.66*threshold)
+
+    num_out = _segment_count(out, ~close_out) # Reset by points that are not close outliers
+    num_far_out = np.cumsum(far_out & out, axis=1) # Never reset
+    num_close_out = _segment_count(close_out, ~close_out)
+
+    flag = np.any(out & (num_out >= num_min_outliers), axis=1) | \
+           np.any(far_out & out & (num_far_out >= round(0.5 * num_min_outliers)), axis=1) | \
+           np.any(close_out & (num_close_out >= round(1.2 * num_min_outliers)), axis=1)
+
+    non_linear = (ransac_flag | flag | degenerate).astype(np.float64)
+
+    return non_linear
+
+def get_non_linear_agreement(seqs, threshold=2):
+    """
+    Compare the labels of get_non_linear (RANSAC, per trajectory) and get_non_linear_batch for N
+    trajectories (N x 2 x num_points).
+    Output:
+        report (dict): num_trajs, agreement (ratio), straight_to_curved and curved_to_straight
+        (RANSAC label -> vectorized label counts)
+    """
+
+    seqs = np.asarray(seqs, dtype=np.float64)
+
+    current_labels = np.zeros(len(seqs))
+    for i in range(len(seqs)):
+        try:
+            current_labels[i] = get_non_linear(None, seqs, idx=i, threshold=threshold)
+        except: # Same criteria than in preprocessing
+            current_labels[i] = 1.0
+    batch_labels = get_non_linear_batch(seqs, threshold=threshold)
+
+    report = dict()
+    report["num_trajs"] = len(seqs)
+    report["agreement"] = float(np.mean(current_labels == batch_labels)) if len(seqs) > 0 else 1.0
+    report["straight_to_curved"] = int(np.sum((current_labels == 0.0) & (batch_labels == 1.0)))
+    report["curved_to_straight"] = int(np.sum((current_labels == 1.0) & (batch_labels == 0.0)))
+
+    return report
+
+def resample_polylines(polylines, lengths=None, num_points=40, mode="spline"):
+    """
+    Resample a batch of polylines (e.g. centerlines) to num_points equally spaced points along their
+    arc length, in a single pass.
+    Input:
+        polylines: N x max_len x 2 (padded)
+        lengths: N, number of valid points of each polyline (max_len if not specified)
+        mode: "linear" (piecewise linear) or "spline" (cubic Hermite with arc-length knots and 
+              non-uniform Catmull-Rom tangents, C1)
+    Output:
+        resampled polylines: N x num_points x 2
+    Duplicated consecutive points (zero-length segments) are removed before resampling. A polyline
+    with a single point (or with all its points equal) is resampled as num_points copies of its 
+    first point
+    """
+
+    polylines = np.asarray(polylines, dtype=np.float64)
+    num_polylines, max_len = polylines.shape[:2]
+    if num_polylines == 0:
+        return np.zeros((0,num_points,2))
+
+    lengths = np.full(num_polylines, max_len) if lengths is None else np.clip(np.asarray(lengths), 1, max_len)
+    rows = np.arange(num_polylines)[:,np.newaxis]
+
+    def get_segment_len(polylines, lengths):
+        segment_len = np.linalg.norm(np.diff(polylines, axis=1), axis=2) # N x (max_len - 1)
+        segment_len[np.arange(max_len-1)[np.newaxis,:] >= (lengths-1)[:,np.newaxis]] = 0 # Padding
+        return segment_len
+
+    # Remove the duplicated points (each row is compacted), so the tangents are computed with
+    # distinct neighbours
+
+    segment_len = get_segment_len(polylines, lengths)
+    keep = np.arange(max_len)[np.newaxis,:] < lengths[:,np.newaxis]
+    keep[:,1:] &= segment_len > 0
+    polylines = polylines[rows, np.argsort(~keep, axis=1, kind="stable")]
+    lengths = np.maximum(keep.sum(axis=1), 1)
+
+    # Cumulative arc length (the padded segments have length 0)
+
+    segment_len = get_segment_len(polylines, lengths)
+    arc_len = np.concatenate((np.zeros((num_polylines,1)), np.cumsum(segment_len, axis=1)), axis=1)
+    total_len = arc_len[:,-1]
+
+    # Segment of each sample: searchsorted over all the polylines at once (each row is shifted so
+    # the flattened cumulative arc length is non-decreasing)
+
+    samples = np.linspace(0, 1, num_points)[np.newaxis,:] * total_len[:,np.newaxis] # N x num_points
+    shift = (np.arange(num_polylines) * (total_len.max() + 1))[:,np.newaxis]
+    index = np.searchsorted((arc_len + shift).reshape(-1), (samples + shift).reshape(-1), side="right")
+    index = index.reshape(num_polylines,num_points) - rows * max_len - 1
+    index = np.clip(index, 0, np.maximum(lengths-2,0)[:,np.newaxis])
+    next_index = np.minimum(index + 1, (lengths-1)[:,np.newaxis])
+
+    h = segment_len[rows, np.minimum(index, max_len-2)] if max_len > 1 else np.zeros_like(samples)
+    u = np.divide(samples - arc_len[rows, index], h, out=np.zeros_like(samples), where=h > 0)[...,np.newaxis]
+    p0 = polylines[rows, index]
+    p1 = polylines[rows, next_index]
+
+    if mode == "linear":
+        return p0 + u * (p1 - p0)
+
+    # Tangents (dp/ds) of each point: derivative of the parabola through the point and its neighbours
+    # (chord slopes weighted by the length of the opposite segment, exact for non-uniform spacing).
+    # At the ends, the tangent of the parabola through the last 3 points
+
+    chords = np.divide(np.diff(polylines, axis=1), segment_len[...,np.newaxis], 
+                       out=np.zeros((num_polylines,max_len-1,2)), where=segment_len[...,np.newaxis] > 0)
+    h_prev = np.pad(segment_len, ((0,0),(1,0)))[...,np.newaxis]
+    h_next = np.pad(segment_len, ((0,0),(0,1)))[...,np.newaxis]
+    chord_prev = np.pad(chords, ((0,0),(1,0),(0,0)))
+    chord_next = np.pad(chords, ((0,0),(0,1),(0,0)))
+
+    tangents = np.divide(h_next * chord_prev + h_prev * chord_next, h_prev + h_next,
+                         out=np.zeros_like(polylines), where=(h_prev + h_next) > 0)
+    tangents = np.where(h_prev == 0, chord_next, np.where(h_next == 0, chord_prev, tangents))
+
+    ends = np.flatnonzero(lengths >= 3)
+    for end, neighbour in ((np.zeros_like(ends), np.ones_like(ends)), (lengths[ends]-1, lengths[ends]-2)):
+        tangents[ends, end] = 2 * tangents[ends, end] - tangents[ends, neighbour]
+
+    m0 = tangents[rows, index] * h[...,np.newaxis]
+    m1 = tangents[rows, next_index] * h[...,np.newaxis]
+
+    u2, u3 = u**2, u**3
+    return (2*u3 - 3*u2 + 1) * p0 + (u3 - 2*u2 + u) * m0 + (-2*u3 + 3*u2) * p1 + (u3 - u2) * m1
+
 def poly_fit(traj, traj_len, threshold):
     """
     Input:
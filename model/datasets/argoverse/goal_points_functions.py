@@ -35,53 +35,40 @@ import matplotlib.pyplot as plt
 
 def get_points(img, center_px, scale_x, radius=100, color=255, N=1024, around_center=True, max_samples=None, DEBUG_TIME=False):
     """
+    Sample N pixels (rows, columns) of img == color, sorted in raster order (top-left to bottom-right).
+    If around_center, only the samples closer than radius (pixels) to center_px (row, column) are
+    returned (Gaussian samples around center_px if there are none)
     """
 
     start = time.time()
-    feasible_area = np.where(img == color)
+    feasible_area = img == color
+    if feasible_area.ndim == 3: feasible_area = feasible_area.any(axis=-1) # Any channel (e.g. BGR image)
+    feasible_area = np.flatnonzero(feasible_area)
     end = time.time()
-    if DEBUG_TIME: print(">> Time consumed by np.where: ", end-start)
-    start = time.time()
-    sampling_points = np.vstack(feasible_area)
-    end = time.time()
-    if DEBUG_TIME: print(">> Time consumed by sampling: ", end-start)
-    
-    # rng = np.random.default_rng()
+    if DEBUG_TIME: print(">> Time consumed by np.flatnonzero: ", end-start)
+
     num_samples = N
     start = time.time()
-    # points_feasible_area = len(feasible_area[0])
-    # sample_index = rng.choice(points_feasible_area, size=N, replace=False)
-    sample_index = np.random.randint(low=0,high=sampling_points.shape[1],size=num_samples)
-    sample_index = np.sort(sample_index) # Sort indeces in order to have to pixels sorted (from top-left to bottom right)
-
-    sampling_points = sampling_points[:,sample_index]
-    
-    px_y = sampling_points[0,:] # rows (pixels)
-    px_x = sampling_points[1,:] # columns (pixels)
+    sample_index = np.sort(np.random.randint(low=0,high=len(feasible_area),size=num_samples)) # Raster order
+    px_y, px_x = np.divmod(feasible_area[sample_index], img.shape[1]) # rows, columns (pixels)
     end = time.time()
     if DEBUG_TIME: print(">> Time consumed by sorting: ", end-start)
 
     ## Sample points around the specified center given a certain radius
     
-    # TODO: Optimize this
     # Should not be considered if the plausible area has been previously filtered
     if around_center:
-        final_points = [[a,b] for a,b in zip(px_y,px_x) if (math.sqrt(pow(a - center_px[0],2)+
-                                                                      pow(b - center_px[1],2)) < radius)]
-
-        if max_samples:               
-            final_points = random.sample(final_points,max_samples)
-            assert len(final_points) == max_samples
-          
-        final_points = np.array(final_points)
-
-        try:
-            px_y = final_points[:,0] # rows
-            px_x = final_points[:,1] # columns
-        except:
+        close = np.flatnonzero((px_y - center_px[0])**2 + (px_x - center_px[1])**2 < radius**2)
+
+        if max_samples:
+            close = np.sort(np.random.choice(close, size=max_samples, replace=False))
+
+        if len(close) > 0:
+            px_y, px_x = px_y[close], px_x[close]
+        else:
             scale_y = scale_x
-            px_y = center_px[0] + scale_y*np.random.randn(num_samples) # columns
-            px_x = center_px[1] + scale_x*np.random.randn(num_samples) # rows
+            px_y = center_px[0] + scale_y*np.random.randn(num_samples) # rows
+            px_x = center_px[1] + scale_x*np.random.randn(num_samples) # columns
                   
     return px_y, px_x
 
@@ -266,128 +253,136 @@ def plot_fepoints(img, filename, seq_px_x=None, seq_px_y=None, last_obs_px=None,
 
     plt.close('all')
     
-def get_goal_points(filename, obs_seq, origin_pos, real_world_offset, NUM_GOAL_POINTS=32):
+def get_agent_velocity_batch(obs_seqs, num_obs=5, period=0.1):
     """
+    Vectorized get_agent_velocity. obs_seqs: batch_size x obs_len x 2 (np.array). Return the average
+    velocity (batch_size) of the last num_obs points of each sequence
     """
 
-    split_folder = '/'.join(filename.split('/')[:-2])
-    goal_points_folder = split_folder + "/goal_points"
-    seq_id = filename.split('/')[-1].split('.')[0]
+    displacements = np.diff(obs_seqs[:,-num_obs:,:], axis=1)
 
-    # 0. Load image and get past observations
+    return np.linalg.norm(displacements, axis=2).mean(axis=1) / period
 
-    img = cv2.imread(filename)
-    img = cv2.resize(img, dsize=(600,600))
-    height, width = img.shape[:2]
-    img_size = height
-    scale_x = scale_y = float(height/(2*real_world_offset))
-
-    cx = int(width/2)
-    cy = int(height/2)
-    car_px = (cy,cx)
-
-    ori = obs_seq[-1, :]
+def get_agent_yaw_batch(obs_seqs, num_obs=5):
+    """
+    Vectorized get_agent_yaw. obs_seqs: batch_size x obs_len x 2 (np.array). Return the average yaw
+    (batch_size, radians) of the last num_obs points of each sequence (null angles are ignored)
+    """
 
-    # 0. Plot obs traj (AGENT)
+    displacements = np.diff(obs_seqs[:,-num_obs:,:], axis=1)
+    yaw = np.arctan2(displacements[...,1], displacements[...,0])
 
-    obs_x = obs_seq[:,0]
-    obs_y = obs_seq[:,1]
+    valid = yaw != 0
+    num_valid = np.maximum(valid.sum(axis=1),1)
+    mean_yaw = np.where(valid, yaw, 0).sum(axis=1) / num_valid
+    std_yaw = np.sqrt(np.where(valid, (yaw - mean_yaw[:,None])**2, 0).sum(axis=1) / num_valid)
 
-    obs_px_points = transform_real_world2px(obs_seq, origin_pos, real_world_offset, img_size)
-    agent_obs_px_x, agent_obs_px_y = obs_px_points[:,0], obs_px_points[:,1]
-    filename = goal_points_folder + "/" + seq_id + "_obs_traj.png"
-    # plot_fepoints(img, filename, agent_obs_px_x, agent_obs_px_y, car_px, change_bg=True)
+    # Angles around pi (e.g. pi and -pi): average the absolute value, with the most common sign
 
-    # 1. Get feasible area points (N samples)
+    num_positives = (yaw > 0).sum(axis=1)
+    num_negatives = valid.sum(axis=1) - num_positives
+    mean_abs_yaw = np.where(valid, np.absolute(yaw), 0).sum(axis=1) / num_valid
+    mean_abs_yaw = np.where(num_negatives > num_positives, -mean_abs_yaw, mean_abs_yaw)
 
-    # 1.0. (Optional) Observe random sampling in the whole feasible area
+    return np.where(std_yaw > 1.5, mean_abs_yaw, mean_yaw)
 
-    fe_y, fe_x = get_points(img, car_px, scale_x, rad=10000, color=255, N=1024, 
-                            sample_car=True, max_samples=None) # return rows, columns
-    filename = goal_points_folder + "/" + seq_id + "_all_samples.png"
-    # plot_fepoints(img, filename, agent_obs_px_x, agent_obs_px_y, car_px, goals_px_x=fe_x, goals_px_y=fe_y, change_bg=True)
+def get_goal_points_batch(masks, obs_seqs, origin_pos, real_world_offset, NUM_GOAL_POINTS=32, 
+                          num_samples=1024, pred_seconds=3, color=255):
+    """
+    Goal points of a batch of scenes, given their already decoded plausible area masks
+    masks: batch_size x rows x cols (uint8), centered at origin_pos and covering 
+           2 * real_world_offset metres in each direction
+    obs_seqs: batch_size x obs_len x 2, AGENT observations (global coordinates)
+    origin_pos: batch_size x 2 (global coordinates)
+    1. Sample num_samples pixels of the plausible area (mask == color) of each scene
+    2. Keep the samples closer than the distance covered at the AGENT estimated velocity in pred_seconds
+    3. Keep the samples in front of the AGENT (estimated yaw)
+    4. Keep the NUM_GOAL_POINTS furthest samples (padded with noisy copies of the closest one if
+       there are not enough samples, Gaussian samples around the AGENT if there are none)
+    Return the goal points (batch_size x NUM_GOAL_POINTS x 2, global coordinates)
+    """
 
-    # 1.1. Filter using AGENT estimated velocity
+    masks = np.asarray(masks)
+    obs_seqs = np.asarray(obs_seqs, dtype=np.float64)
+    origin_pos = np.asarray(origin_pos, dtype=np.float64).reshape(-1,2)
 
-    mean_vel = get_agent_velocity(torch.transpose(obs_seq,0,1))
-    pred_seconds = 3 # instead of 3 s (prediction in ARGOVERSE)
-    radius = mean_vel * pred_seconds
-    radius_px = radius * scale_x	
+    batch_size, rows, cols = masks.shape
+    scale_x = float(cols/(2*real_world_offset)) # px/m
+    scale_y = float(rows/(2*real_world_offset))
+    cy, cx = rows // 2, cols // 2
 
-    fe_y, fe_x = get_points(img, car_px, scale_x, rad=radius_px, color=255, N=1024, 
-                                sample_car=True, max_samples=None) # return rows, columns
+    # 1. Random samples (raster order) of the plausible area of all the scenes at once. The flat
+    #    indeces of the plausible area are sorted by scene, so the samples of each scene are taken from
+    #    its own range
 
-    filename = goal_points_folder + "/" + seq_id + "_vel_filter.png"
-    # plot_fepoints(img, filename, agent_obs_px_x, agent_obs_px_y, car_px, 
-    #               goals_px_x=fe_x, goals_px_y=fe_y, radius=radius_px, change_bg=True)
+    feasible_area = np.flatnonzero(masks.reshape(batch_size,-1) == color)
+    num_feasible = np.bincount(feasible_area // (rows*cols), minlength=batch_size)
+    first_feasible = np.cumsum(num_feasible) - num_feasible
 
-    # 1.2. Filter points applying rotation
+    ranks = np.sort((np.random.random((batch_size,num_samples)) * num_feasible[:,None]).astype(np.int64), axis=1)
+    sample_index = np.minimum(first_feasible[:,None] + ranks, max(len(feasible_area)-1,0))
+    px_y, px_x = np.divmod(feasible_area[sample_index] % (rows*cols), cols) if len(feasible_area) > 0 else \
+                 (np.full((batch_size,num_samples),cy), np.full((batch_size,num_samples),cx))
+    dx, dy = px_x - cx, px_y - cy # pixels w.r.t. the AGENT (center of the image)
 
-    mean_yaw = get_agent_yaw(torch.transpose(obs_seq,0,1)) # radians
+    # 2. Filter using AGENT estimated velocity
 
-    if mean_yaw >= 0.0:
-        angle = math.pi/2 - mean_yaw
-    elif mean_yaw < 0.0:
-        angle = -(math.pi / 2 + (math.pi - abs(mean_yaw)))
+    radius_px = get_agent_velocity_batch(obs_seqs) * pred_seconds * scale_x
+    dist = dx**2 + dy**2
+    valid = (dist < (radius_px**2)[:,None]) & (num_feasible > 0)[:,None]
 
-    c, s = np.cos(angle), np.sin(angle)
-    R = np.array([[c,-s], [s, c]])
+    # 3. Filter points applying rotation (AGENT heading pointing to the top of the image)
 
-    fe_x_trans = fe_x - cx # get px w.r.t. the center of the image to be rotated
-    fe_y_trans = fe_y - cy
+    angle = math.pi/2 - get_agent_yaw_batch(obs_seqs)
+    c, s = np.cos(angle)[:,None], np.sin(angle)[:,None]
+    valid &= (-s * dx + c * dy).astype(np.int32) < 0
 
-    close_pts = np.hstack((fe_x_trans.reshape(-1,1),fe_y_trans.reshape(-1,1)))
-    close_pts_rotated = np.matmul(close_pts,R).astype(np.int32)
+    # 4. Get furthest NUM_GOAL_POINTS samples (sorted by distance), closest to the hypothetical radius
 
-    fe_x_rot = close_pts_rotated[:,0] + cx
-    fe_y_rot = close_pts_rotated[:,1] + cy
+    num_valid = valid.sum(axis=1)
+    sorted_index = np.argsort(np.where(valid, dist, np.inf), axis=1) # valid samples first
+    positions = np.maximum(num_valid - NUM_GOAL_POINTS, 0)[:,None] + np.arange(NUM_GOAL_POINTS)[None,:]
+    positions = np.minimum(positions, num_samples-1)
+    goals_index = np.take_along_axis(sorted_index, positions, axis=1)
 
-    filtered_fe_x = fe_x[np.where(fe_y_rot < cy)[0]]
-    filtered_fe_y = fe_y[np.where(fe_y_rot < cy)[0]]
+    goals_px = np.stack((np.take_along_axis(px_y, goals_index, axis=1),
+                         np.take_along_axis(px_x, goals_index, axis=1)), axis=2).astype(np.float64) # rows, columns
+    
+    padding = np.arange(NUM_GOAL_POINTS)[None,:] >= num_valid[:,None]
+    noise = np.where(num_valid > 0, 0.2, scale_x)[:,None,None] * np.random.randn(batch_size,NUM_GOAL_POINTS,2)
+    reference = np.where((num_valid > 0)[:,None], goals_px[:,0,:], [cy,cx])
+    goals_px = np.where(padding[...,None], reference[:,None,:] + noise, goals_px)
 
-    filename = goal_points_folder + "/" + seq_id + "_angle_filter.png"
-    # plot_fepoints(img, filename, agent_obs_px_x, agent_obs_px_y, car_px, 
-    #               goals_px_x=filtered_fe_x, goals_px_y=filtered_fe_y, radius=radius_px, change_bg=True)
+    # 5. Transform pixels to real-world coordinates
 
-    # 2. Get furthest N samples (closest the the hypothetical radius)
+    goal_points = np.empty_like(goals_px)
+    goal_points[...,0] = origin_pos[:,None,0] - real_world_offset + goals_px[...,1] / scale_x
+    goal_points[...,1] = origin_pos[:,None,1] + real_world_offset - goals_px[...,0] / scale_y
 
-    dist = []
-    for i in range(len(filtered_fe_x)):
-        d = math.sqrt(pow(filtered_fe_x[i] - car_px[0],2) + pow(filtered_fe_y[i] - car_px[1],2))
-        dist.append(d)
+    return goal_points
 
-    dist = np.array(dist)
+def load_goal_points_mask(filename, img_size=600):
+    """
+    Plausible area mask (img_size x img_size, grayscale) used to compute the goal points
+    """
 
-    furthest_indeces = np.argsort(dist)
-    if len(furthest_indeces) > NUM_GOAL_POINTS:
-        furthest_indeces = np.argsort(dist)[-NUM_GOAL_POINTS:]
+    img_gray = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    if img_gray.shape[:2] != (img_size,img_size):
+        img_gray = cv2.resize(img_gray, dsize=(img_size,img_size))
 
-    final_samples_x, final_samples_y = filtered_fe_x[furthest_indeces], filtered_fe_y[furthest_indeces]
-    
-    try:
-        diff_points = NUM_GOAL_POINTS - len(final_samples_x)
-        final_samples_x = np.hstack((final_samples_x, final_samples_x[0]+0.2 * np.random.randn(diff_points)))
-        final_samples_y = np.hstack((final_samples_y, final_samples_y[0]+0.2 * np.random.randn(diff_points)))
-    except:
-        final_samples_x = cx + scale_x*np.random.randn(NUM_GOAL_POINTS)
-        final_samples_y = cy + scale_y*np.random.randn(NUM_GOAL_POINTS)
-
-    filename = goal_points_folder + "/" + seq_id + "_final_samples.png"
-    # plot_fepoints(img, filename, agent_obs_px_x, agent_obs_px_y, car_px, 
-    #               goals_px_x=final_samples_x, goals_px_y=final_samples_y, radius=radius_px, change_bg=True)
-
-    if len(final_samples_x) != NUM_GOAL_POINTS:
-        print(f"Final samples does not match with {NUM_GOAL_POINTS} required samples")
-        # plot_fepoints(img, filename, agent_obs_px_x, agent_obs_px_y, car_px, 
-        #               goals_px_x=final_samples_x, goals_px_y=final_samples_y, radius=radius_px, change_bg=True, show=True)
-        pdb.set_trace()
+    return img_gray
 
-    # 3. Transform pixels to real-world coordinates
+def get_goal_points(filename, obs_seq, origin_pos, real_world_offset, NUM_GOAL_POINTS=32):
+    """
+    Goal points (NUM_GOAL_POINTS x 2, global coordinates) of a single sequence (see get_goal_points_batch)
+    """
 
-    final_samples_px = np.hstack((final_samples_y.reshape(-1,1), final_samples_x.reshape(-1,1))) # rows, columns
-    rw_points = transform_px2real_world(final_samples_px, origin_pos, real_world_offset, img_size)
+    mask = load_goal_points_mask(filename)
+    obs_seq = obs_seq.cpu().data.numpy() if torch.is_tensor(obs_seq) else obs_seq
+    origin_pos = origin_pos.cpu().data.numpy() if torch.is_tensor(origin_pos) else origin_pos
 
-    return rw_points
+    return get_goal_points_batch(mask[None], np.asarray(obs_seq)[None], np.asarray(origin_pos).reshape(1,2), 
+                                 real_world_offset, NUM_GOAL_POINTS=NUM_GOAL_POINTS)[0]
 
 def get_driveable_area_and_centerlines(filename, agent_xy_abs, relevant_centerlines, origin_pos, 
                                        OBS_LEN=20, IMG_ROWS=600, NUM_POINTS_PLAUSIBLE_AREA=512, DEBUG=False, DEBUG_TIME=False):
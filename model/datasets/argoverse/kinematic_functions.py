@@ -0,0 +1,185 @@
+#!/usr/bin/env python3.8
+# -*- coding: utf-8 -*-
+
+## Kinematic functions (batched velocity, acceleration, yaw and yaw rate estimation)
+
+"""
+Created on Fri Oct 16 2026
+@author: Carlos Gómez-Huélamo
+"""
+
+# DL & Math imports
+
+import numpy as np
+import scipy as sp
+import scipy.interpolate
+
+from scipy.signal import savgol_filter
+
+#######################################
+
+# All the functions work with a batch of trajectories (batch_size x num_points x 2, e.g. the observations
+# of every agent of a batch or a shard) and return one value per trajectory. With a single trajectory
+# (batch_size = 1) they return the same values as MapFeaturesUtils.get_agent_velocity_and_acceleration
+# and MapFeaturesUtils.get_yaw
+
+FILTERS = ["none","savgol","cubic_spline","savgol+cubic_spline","least_squares","ctra"]
+
+KINEMATIC_FEATURES = ["vel","acc","yaw","yaw_rate"] # Columns of the stored table
+KINEMATIC_FEATURES_FILES = {"file_ids": "kinematic_file_ids.npy", # num_seq (int64)
+                            "features": "kinematic_features.npy"} # num_seq x len(KINEMATIC_FEATURES) (float64)
+
+MAX_VEL = 35 # m/s. If the vehicle is faster and accelerating (> MAX_ACC), the acceleration is assumed to be 0
+MAX_ACC = 5 # m/s2
+
+def get_weighted_average(values, min_weight=1, max_weight=4):
+    """
+    Average of each row of values (batch_size x N) with linearly increasing weights (the last
+    values are the most relevant)
+    """
+
+    return np.average(values, axis=1, weights=np.linspace(min_weight,max_weight,values.shape[1]))
+
+def get_upsampled_trajectories(xy, upsampling_factor=2):
+    """
+    Cubic interpolation of the trajectories (batch_size x num_points x 2) with upsampling_factor times
+    more points
+    """
+
+    num_points = xy.shape[1]
+    points = np.arange(num_points)
+    upsampled_points = np.linspace(points.min(), points.max(), upsampling_factor*num_points)
+
+    return sp.interpolate.interp1d(points, xy, kind='cubic', axis=1)(upsampled_points)
+
+def get_least_squares_trajectories(xy, polynomial_order=2, seq_len=50):
+    """
+    Polynomial (x(t), y(t), t = 1 ... num_points) fitted by least squares to each trajectory. All the
+    trajectories share the Vandermonde matrix, so they are fitted at once. Return the filtered
+    trajectories (batch_size x num_points x 2) and their extension to seq_len points (batch_size x seq_len x 2)
+    """
+
+    batch_size, num_points = xy.shape[:2]
+    t = np.linspace(1, num_points, num_points)
+    t2 = np.linspace(1, seq_len, seq_len)
+
+    coeffs = np.linalg.lstsq(np.vander(t, polynomial_order+1),
+                             xy.transpose(1,0,2).reshape(num_points,-1), rcond=None)[0] # order+1 x (batch_size · 2)
+
+    xy_f = np.matmul(np.vander(t, polynomial_order+1), coeffs).reshape(num_points,batch_size,2).transpose(1,0,2)
+    extended_xy_f = np.matmul(np.vander(t2, polynomial_order+1), coeffs).reshape(seq_len,batch_size,2).transpose(1,0,2)
+
+    return xy_f, extended_xy_f
+
+def get_ctra_parameters(xy, period=0.1):
+    """
+    Constant Turn Rate and Acceleration model fitted by least squares to each trajectory: the speed and
+    the (unwrapped) heading of the displacements are linear in time. Return the velocity, acceleration,
+    yaw and yaw rate in the last point (batch_size each)
+    """
+
+    displacements = np.diff(xy, axis=1)
+    speed = np.linalg.norm(displacements, axis=2) / period
+    heading = np.unwrap(np.arctan2(displacements[...,1], displacements[...,0]), axis=1)
+
+    t = (np.arange(displacements.shape[1]) + 0.5) * period # Middle of each displacement
+    t_last = (xy.shape[1] - 1) * period
+    A = np.vander(t, 2) # slope, intercept
+
+    acc, speed_0 = np.linalg.lstsq(A, speed.T, rcond=None)[0]
+    yaw_rate, heading_0 = np.linalg.lstsq(A, heading.T, rcond=None)[0]
+
+    vel = speed_0 + acc * t_last
+    yaw = np.arctan2(np.sin(heading_0 + yaw_rate * t_last), np.cos(heading_0 + yaw_rate * t_last))
+
+    return vel, acc, yaw, yaw_rate
+
+def get_ctra_trajectories(xy, vel, acc, yaw, yaw_rate, period=0.1, seq_len=50):
+    """
+    Trajectories (batch_size x seq_len x 2) given by the observations and their CTRA extension from the
+    last point
+    """
+
+    batch_size, num_points = xy.shape[:2]
+    extended_xy = np.zeros((batch_size,seq_len,2))
+    extended_xy[:,:num_points] = xy
+
+    for i in range(num_points, seq_len):
+        dt = (i - num_points + 1) * period
+        curr_vel = np.maximum(vel + acc * dt, 0)
+        curr_yaw = yaw + yaw_rate * dt
+        extended_xy[:,i,0] = extended_xy[:,i-1,0] + curr_vel * np.cos(curr_yaw) * period
+        extended_xy[:,i,1] = extended_xy[:,i-1,1] + curr_vel * np.sin(curr_yaw) * period
+
+    return extended_xy
+
+def get_kinematic_features(xy, obs_len=None, period=0.1, filter="least_squares", upsampling_factor=2,
+                           seq_len=50):
+    """
+    Kinematic features of a batch of trajectories in their last point
+    xy: batch_size x num_points x 2 (np.array, e.g. the observations of all the agents of a shard)
+    obs_len: index (+1) of the point used to compute the yaw from the filtered trajectories (as
+             MapFeaturesUtils.get_yaw, num_points by default)
+    filter: none (finite differences), savgol, cubic_spline, savgol+cubic_spline, least_squares or ctra
+    Return a dict with vel, acc, yaw, yaw_rate (batch_size), lane_dir_vector (batch_size x 2, displacement
+    used for the yaw), xy_filtered (batch_size x num_points (· upsampling_factor) x 2) and
+    extended_xy_filtered (batch_size x seq_len x 2, only least_squares and ctra. Otherwise, empty)
+    """
+
+    xy = np.asarray(xy, dtype=np.float64)
+    batch_size, num_points = xy.shape[:2]
+    if obs_len is None: obs_len = num_points
+
+    extended_xy_f = np.zeros((batch_size,0,2))
+
+    if filter == "savgol":
+        xy_f = savgol_filter(xy, window_length=int(num_points/4), polyorder=3, axis=1)
+    elif filter == "cubic_spline":
+        xy_f = get_upsampled_trajectories(xy, upsampling_factor=upsampling_factor)
+        period = period / upsampling_factor
+    elif filter == "savgol+cubic_spline":
+        xy_f = get_upsampled_trajectories(xy, upsampling_factor=upsampling_factor)
+        period = period / upsampling_factor
+        xy_f = savgol_filter(xy_f, window_length=int(xy_f.shape[1]/4), polyorder=3, axis=1)
+    elif filter == "least_squares":
+        xy_f, extended_xy_f = get_least_squares_trajectories(xy, seq_len=seq_len)
+    else: # No filter (original data). Also CTRA, fitted to the finite differences
+        xy_f = xy
+
+    # Velocity and acceleration (finite differences)
+
+    vel_f = np.linalg.norm(np.diff(xy_f, axis=1), axis=2) / period
+    acc_f = np.diff(vel_f, axis=1) / period
+
+    # Theoretically, if the points are computed using Least Squares with a Polynomial with order >= 2,
+    # the velocity in the last observation should be fine, since you are taking into account the
+    # acceleration (either negative or positive)
+
+    vel = vel_f[:,-1] if filter == "least_squares" else get_weighted_average(vel_f)
+    acc = get_weighted_average(acc_f)
+
+    # Yaw (last displacement of the filtered trajectory) and yaw rate
+
+    lane_dir_vector = xy_f[:,obs_len-1,:] - xy_f[:,obs_len-2,:]
+    yaw = np.arctan2(lane_dir_vector[:,1], lane_dir_vector[:,0])
+
+    displacements = np.diff(xy_f, axis=1)
+    yaw_rate_f = np.diff(np.unwrap(np.arctan2(displacements[...,1], displacements[...,0]), axis=1), axis=1) / period
+    yaw_rate = yaw_rate_f[:,-1] if filter == "least_squares" else get_weighted_average(yaw_rate_f)
+
+    if filter == "ctra":
+        vel, acc, yaw, yaw_rate = get_ctra_parameters(xy, period=period)
+        extended_xy_f = get_ctra_trajectories(xy, vel, acc, yaw, yaw_rate, period=period, seq_len=seq_len)
+
+    acc = np.where((vel > MAX_VEL) & (acc > MAX_ACC), 0, acc) # The vehicle cannot drive faster in this problem!
+                                                              # This is an assumption!
+
+    return dict(vel=vel, acc=acc, yaw=yaw, yaw_rate=yaw_rate, lane_dir_vector=lane_dir_vector,
+                xy_filtered=xy_f, extended_xy_filtered=extended_xy_f)
+
+def get_kinematic_features_row(kinematic_features, index=0):
+    """
+    Row (KINEMATIC_FEATURES order) of the index-th trajectory, to be stored in the table
+    """
+
+    return np.array([kinematic_features[key][index] for key in KINEMATIC_FEATURES])
@@ -13,11 +13,20 @@ import pdb
 import os
 import git
 import copy
+import functools
+import zipfile
 
 from typing import Any, Dict, List, Tuple, Union
+from collections.abc import Mapping
 from shapely.geometry import LineString, Point, Polygon
 from shapely.ops import unary_union
 
+try:
+    from shapely import contains_xy, prepare # shapely >= 2.0
+except ImportError: # shapely 1.8 (prepared internally on each call)
+    from shapely.vectorized import contains as contains_xy
+    prepare = None
+
 # DL & Math imports
 
 import math
@@ -35,9 +44,15 @@ import matplotlib.pyplot as plt
 # Custom imports
 
 import argoverse.utils.centerline_utils as centerline_utils
+import model.datasets.argoverse.raster_functions as raster_functions
+import model.datasets.argoverse.kinematic_functions as kinematic_functions
+import model.datasets.argoverse.geometric_functions as geometric_functions
 
 from argoverse.utils.mpl_plotting_utils import visualize_centerline
 from argoverse.map_representation.map_api import ArgoverseMap
+from argoverse.map_representation.lane_segment import LaneSegment
+from argoverse.utils.manhattan_search import find_all_polygon_bboxes_overlapping_query_bbox
+from argoverse.utils.geometry import point_inside_polygon
 from argoverse.utils.centerline_utils import (
     get_nt_distance,
     centerline_to_polygon,
@@ -85,6 +100,800 @@ def draw_lane_polygons(
         else:
             ax.plot(polygon[:, 0], polygon[:, 1], color=color, linewidth=linewidth, alpha=1.0, zorder=1)
 
+# Spatial index of the lane centerlines
+
+MAP_CACHE_FOLDER = os.path.join(BASE_DIR,"data/datasets/argoverse/map_cache") # Precomputed map structures
+
+LANE_INDEX_CELL_SIZE = 50.0 # meters
+
+CACHE_LOAD_ERRORS = (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile) # Corrupted cache file -> rebuild
+
+def save_file_atomically(filename, save_fn):
+    """
+    Write filename with save_fn(file) through a temporary file of this process, so other processes 
+    (e.g. preprocessing workers building the same cache) never read a partial file
+    """
+
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'wb') as my_file:
+        save_fn(my_file)
+    os.replace(tmp_filename, filename)
+
+def get_lane_centerline(city_lane_centerlines, lane_id):
+    """
+    Centerline of lane_id in avm.city_lane_centerlines_dict[city_name]. With ArgoverseMapCache (CityLanes)
+    it is read directly from the memory-mapped arrays, without creating the LaneSegment
+    """
+
+    if isinstance(city_lane_centerlines, CityLanes):
+        return city_lane_centerlines.get_lane_centerline(lane_id)
+    return city_lane_centerlines[lane_id].centerline
+
+_LANE_SPATIAL_INDEX = dict() # (city_name, cell_size) -> LaneSpatialIndex (built or loaded once per process)
+
+class LaneSpatialIndex:
+    """
+    Uniform grid over the bounding boxes (xmin, ymin, xmax, ymax) of the lane centerlines of a city.
+    Each cell stores the lanes whose bbox overlaps it (CSR: cell_start, cell_lanes), so a query only
+    checks the lanes of the cells it covers instead of every lane of the city. The returned indeces
+    (w.r.t. lane_ids) are sorted, so the lanes follow the order of avm.city_lane_centerlines_dict
+    """
+
+    def __init__(self, lane_ids, bboxes, cell_size=LANE_INDEX_CELL_SIZE):
+        self.lane_ids = np.asarray(lane_ids, dtype=np.int64)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1,4)
+        self.cell_size = float(cell_size)
+
+        self.origin = self.bboxes[:,:2].min(axis=0) if len(self.bboxes) > 0 else np.zeros(2)
+        cells_min = self.get_cells(self.bboxes[:,:2])
+        cells_max = self.get_cells(self.bboxes[:,2:])
+        self.nx, self.ny = (cells_max.max(axis=0) + 1) if len(self.bboxes) > 0 else (1,1)
+
+        # Cells covered by each lane (vectorized over all the lanes)
+
+        span = cells_max - cells_min + 1
+        num_cells = span[:,0] * span[:,1]
+        lane_rep = np.repeat(np.arange(len(self.lane_ids)), num_cells)
+        local = np.arange(num_cells.sum()) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+        span_y = span[lane_rep,1]
+        cell_x = cells_min[lane_rep,0] + local // span_y
+        cell_y = cells_min[lane_rep,1] + local % span_y
+        cell_id = cell_x * self.ny + cell_y
+
+        order = np.argsort(cell_id, kind="stable")
+        self.cell_lanes = lane_rep[order]
+        self.cell_start = np.concatenate(([0],np.cumsum(np.bincount(cell_id, minlength=self.nx*self.ny))))
+
+    @classmethod
+    def from_city_lanes(cls, city_lane_centerlines, cell_size=LANE_INDEX_CELL_SIZE):
+        """
+        Build the index from avm.city_lane_centerlines_dict[city_name]
+        """
+
+        lane_ids = list(city_lane_centerlines.keys())
+        bboxes = np.zeros((len(lane_ids),4))
+
+        for i, lane_id in enumerate(lane_ids):
+            lane_cl = get_lane_centerline(city_lane_centerlines, lane_id)
+            bboxes[i] = [np.min(lane_cl[:,0]), np.min(lane_cl[:,1]), np.max(lane_cl[:,0]), np.max(lane_cl[:,1])]
+
+        return cls(lane_ids, bboxes, cell_size=cell_size)
+
+    def get_cells(self, xy):
+        return np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+
+    def query_bbox(self, x_min, x_max, y_min, y_max):
+        """
+        Indeces of the lanes whose bbox overlaps (strictly) the query bbox. Same condition as
+        scanning all the lanes: min(x) < x_max, min(y) < y_max, max(x) > x_min, max(y) > y_min
+        """
+
+        (cx_min, cy_min), (cx_max, cy_max) = self.get_cells(np.array([[x_min,y_min],[x_max,y_max]]))
+        cx_min, cy_min = max(cx_min,0), max(cy_min,0)
+        cx_max, cy_max = min(cx_max,self.nx-1), min(cy_max,self.ny-1)
+
+        if cx_min > cx_max or cy_min > cy_max:
+            return np.zeros(0, dtype=np.int64)
+
+        # The cells of each column (same x) are contiguous in cell_lanes
+
+        candidates = [self.cell_lanes[self.cell_start[cx*self.ny+cy_min]:self.cell_start[cx*self.ny+cy_max+1]]
+                      for cx in range(cx_min,cx_max+1)]
+        candidates = np.unique(np.concatenate(candidates))
+
+        bboxes = self.bboxes[candidates]
+        overlap = ((bboxes[:,0] < x_max) & (bboxes[:,1] < y_max)
+                 & (bboxes[:,2] > x_min) & (bboxes[:,3] > y_min))
+
+        return candidates[overlap]
+
+    def query_radius(self, x, y, radius):
+        """
+        Indeces of the lanes whose bbox is at most radius meters away from (x,y)
+        """
+
+        candidates = self.query_bbox(x-radius, x+radius, y-radius, y+radius)
+        bboxes = self.bboxes[candidates]
+
+        dx = np.maximum(np.maximum(bboxes[:,0] - x, x - bboxes[:,2]), 0)
+        dy = np.maximum(np.maximum(bboxes[:,1] - y, y - bboxes[:,3]), 0)
+
+        return candidates[dx**2 + dy**2 <= radius**2]
+
+    def save(self, filename):
+        save_file_atomically(filename, lambda my_file: np.savez(my_file, lane_ids=self.lane_ids, bboxes=self.bboxes, 
+                                                                cell_size=self.cell_size))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as index_data:
+            return cls(index_data["lane_ids"], index_data["bboxes"], cell_size=float(index_data["cell_size"]))
+
+def get_lane_spatial_index(avm, city_name, cell_size=LANE_INDEX_CELL_SIZE, index_folder=MAP_CACHE_FOLDER):
+    """
+    Spatial index of the lane centerlines of city_name. It is built once (then stored in index_folder
+    and kept in memory) and rebuilt if the lanes of the map do not match the stored ones
+    """
+
+    key = (city_name, cell_size)
+    if key in _LANE_SPATIAL_INDEX:
+        return _LANE_SPATIAL_INDEX[key]
+
+    city_lane_centerlines = avm.city_lane_centerlines_dict[city_name]
+    filename = os.path.join(index_folder,f"lane_spatial_index_{city_name}_{int(cell_size)}m.npz")
+
+    lane_index = None
+    if os.path.isfile(filename):
+        try:
+            lane_index = LaneSpatialIndex.load(filename)
+        except CACHE_LOAD_ERRORS as e:
+            print(f"{filename} could not be read ({e}). Rebuild the lane spatial index")
+        if lane_index is not None and not np.array_equal(lane_index.lane_ids, np.fromiter(city_lane_centerlines.keys(), dtype=np.int64)):
+            lane_index = None # Outdated (different map files)
+
+    if lane_index is None:
+        lane_index = LaneSpatialIndex.from_city_lanes(city_lane_centerlines, cell_size=cell_size)
+
+        try:
+            if not os.path.exists(index_folder):
+                os.makedirs(index_folder) # makedirs creates intermediate folders
+            lane_index.save(filename)
+        except OSError as e:
+            print(f"The lane spatial index could not be stored in {index_folder}: ", e)
+
+    _LANE_SPATIAL_INDEX[key] = lane_index
+    return lane_index
+
+def get_lanes_in_bbox(avm, city_name, x_min, x_max, y_min, y_max):
+    """
+    Lane ids and centerlines whose bbox overlaps the query bbox (instead of scanning all the lanes
+    of the city)
+    """
+
+    lane_index = get_lane_spatial_index(avm, city_name)
+    city_lane_centerlines = avm.city_lane_centerlines_dict[city_name]
+
+    lane_ids = lane_index.lane_ids[lane_index.query_bbox(x_min, x_max, y_min, y_max)].tolist()
+    lane_centerlines = [get_lane_centerline(city_lane_centerlines, lane_id) for lane_id in lane_ids]
+
+    return lane_ids, lane_centerlines
+
+# Cached lane polygons (point in polygon score of the candidate lane sequences)
+
+LANE_POLYGON_CACHE_SIZE = 20000 # lanes
+LANE_SEQ_POLYGON_CACHE_SIZE = 5000 # lane sequences
+
+@functools.lru_cache(maxsize=LANE_POLYGON_CACHE_SIZE)
+def get_lane_polygon(avm, city_name, lane_id):
+    """
+    Polygon (buffered, so it is valid) of a lane segment
+    """
+
+    return Polygon(avm.get_lane_segment_polygon(lane_id, city_name)).buffer(0)
+
+@functools.lru_cache(maxsize=LANE_SEQ_POLYGON_CACHE_SIZE)
+def get_lane_seq_polygon(avm, city_name, lane_seq):
+    """
+    Union of the polygons of a lane sequence (tuple of lane ids), prepared to evaluate 
+    many points against it
+    """
+
+    lane_seq_polygon = unary_union([get_lane_polygon(avm, city_name, lane_id) for lane_id in lane_seq])
+    if prepare is not None:
+        prepare(lane_seq_polygon)
+
+    return lane_seq_polygon
+
+def points_in_polygon(polygon, xy):
+    """
+    Boolean mask of the points (N x 2) that lie inside the polygon (same as polygon.contains(Point(xy))
+    per point)
+    """
+
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1,2)
+    return np.asarray(contains_xy(polygon, xy[:,0], xy[:,1]), dtype=bool)
+
+# Lane graph (candidate centerlines search)
+
+LANE_GRAPH_DFS_BUCKET = 10.0 # meters
+LANE_GRAPH_DFS_CACHE_SIZE = 50000 # (lane, direction, distance bucket)
+LANE_SEQ_CENTERLINE_CACHE_SIZE = 20000 # lane sequences
+
+_LANE_GRAPH = dict() # city_name -> LaneGraph (built or loaded once per process)
+
+class LaneGraph:
+    """
+    Lane graph of a city as compact arrays (w.r.t. lane_ids): successors and predecessors of each lane
+    in CSR format (succ_start, succ_index, pred_start, pred_index; -1 if the lane is not in the map)
+    and length of each lane segment. dfs returns the same lane sequences (and order) as ArgoverseMap.dfs
+    """
+
+    def __init__(self, lane_ids, lengths, succ_start, succ_index, pred_start, pred_index):
+        self.lane_ids = np.asarray(lane_ids, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+        self.succ_start = np.asarray(succ_start, dtype=np.int64)
+        self.succ_index = np.asarray(succ_index, dtype=np.int64)
+        self.pred_start = np.asarray(pred_start, dtype=np.int64)
+        self.pred_index = np.asarray(pred_index, dtype=np.int64)
+
+        self.lane_index = {lane_id: i for i, lane_id in enumerate(self.lane_ids.tolist())}
+
+        # Traversal trees memoized by (lane, direction, distance bucket)
+
+        self.get_dfs_tree = functools.lru_cache(maxsize=LANE_GRAPH_DFS_CACHE_SIZE)(self.get_dfs_tree)
+
+    @classmethod
+    def from_city_lanes(cls, city_lane_centerlines):
+        """
+        Build the graph from avm.city_lane_centerlines_dict[city_name]. The length of each lane is
+        computed as in ArgoverseMap.dfs (LineString(centerline).length)
+        """
+
+        lane_ids = list(city_lane_centerlines.keys())
+        lane_index = {lane_id: i for i, lane_id in enumerate(lane_ids)}
+
+        lengths = np.array([LineString(lane_props.centerline).length for lane_props in city_lane_centerlines.values()])
+
+        def get_csr(neighbours_list):
+            neighbours_list = [neighbours if neighbours is not None else [] for neighbours in neighbours_list]
+            start = np.concatenate(([0],np.cumsum([len(neighbours) for neighbours in neighbours_list])))
+            index = np.array([lane_index.get(lane_id,-1) for neighbours in neighbours_list for lane_id in neighbours],
+                             dtype=np.int64)
+            return start, index
+
+        succ_start, succ_index = get_csr([lane_props.successors for lane_props in city_lane_centerlines.values()])
+        pred_start, pred_index = get_csr([lane_props.predecessors for lane_props in city_lane_centerlines.values()])
+
+        return cls(lane_ids, lengths, succ_start, succ_index, pred_start, pred_index)
+
+    def get_dfs_tree(self, lane_id, extend_along_predecessor, max_threshold):
+        """
+        Traversal tree (preorder) from lane_id, expanding the nodes whose accumulated distance is
+        <= max_threshold. Per node: accumulated distance, accumulated distance of the parent, if it
+        has no children and lane sequence
+        """
+
+        start, index = ((self.pred_start, self.pred_index) if extend_along_predecessor 
+                        else (self.succ_start, self.succ_index))
+
+        node_dist, parent_dist, no_children, lane_seqs = [], [], [], []
+        stack = [(self.lane_index[lane_id], 0, -np.inf, [lane_id])]
+
+        while stack:
+            node, dist, dist_parent, lane_seq = stack.pop()
+            children = index[start[node]:start[node+1]]
+
+            node_dist.append(dist)
+            parent_dist.append(dist_parent)
+            no_children.append(len(children) == 0)
+            lane_seqs.append(lane_seq)
+
+            if dist > max_threshold:
+                continue
+
+            for child in children[::-1]: # Reversed, so the children are popped in order
+                if child == -1:
+                    raise KeyError(f"Lane {lane_seq[0] if extend_along_predecessor else lane_seq[-1]} has a neighbour out of the map")
+
+                child_id = int(self.lane_ids[child])
+                child_seq = [child_id] + lane_seq if extend_along_predecessor else lane_seq + [child_id]
+                stack.append((child, dist + self.lengths[child], dist, child_seq))
+
+        return np.array(node_dist), np.array(parent_dist), np.array(no_children), lane_seqs
+
+    def dfs(self, lane_id, threshold=30, extend_along_predecessor=False):
+        """
+        Lane sequences from lane_id (successors or predecessors) up to the threshold distance. A node
+        is returned if its parent was expanded (distance <= threshold) and it is not expanded or has
+        no children, so the tree of the distance bucket answers any threshold below it
+        """
+
+        max_threshold = (math.floor(threshold / LANE_GRAPH_DFS_BUCKET) + 1) * LANE_GRAPH_DFS_BUCKET
+        node_dist, parent_dist, no_children, lane_seqs = self.get_dfs_tree(lane_id, extend_along_predecessor, max_threshold)
+
+        selected = (parent_dist <= threshold) & ((node_dist > threshold) | no_children)
+
+        return [list(lane_seqs[i]) for i in np.flatnonzero(selected)]
+
+    def save(self, filename):
+        save_file_atomically(filename, lambda my_file: np.savez(my_file, lane_ids=self.lane_ids, lengths=self.lengths, 
+                                                                succ_start=self.succ_start, succ_index=self.succ_index,
+                                                                pred_start=self.pred_start, pred_index=self.pred_index))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as graph_data:
+            return cls(graph_data["lane_ids"], graph_data["lengths"], 
+                       graph_data["succ_start"], graph_data["succ_index"],
+                       graph_data["pred_start"], graph_data["pred_index"])
+
+def get_lane_graph(avm, city_name, graph_folder=MAP_CACHE_FOLDER):
+    """
+    Lane graph of city_name. It is built once (then stored in graph_folder and kept in memory)
+    and rebuilt if the lanes of the map do not match the stored ones
+    """
+
+    if city_name in _LANE_GRAPH:
+        return _LANE_GRAPH[city_name]
+
+    city_lane_centerlines = avm.city_lane_centerlines_dict[city_name]
+    filename = os.path.join(graph_folder,f"lane_graph_{city_name}.npz")
+
+    lane_graph = None
+    if os.path.isfile(filename):
+        try:
+            lane_graph = LaneGraph.load(filename)
+        except CACHE_LOAD_ERRORS as e:
+            print(f"{filename} could not be read ({e}). Rebuild the lane graph")
+        if lane_graph is not None and not np.array_equal(lane_graph.lane_ids, np.fromiter(city_lane_centerlines.keys(), dtype=np.int64)):
+            lane_graph = None # Outdated (different map files)
+
+    if lane_graph is None:
+        lane_graph = LaneGraph.from_city_lanes(city_lane_centerlines)
+
+        try:
+            if not os.path.exists(graph_folder):
+                os.makedirs(graph_folder) # makedirs creates intermediate folders
+            lane_graph.save(filename)
+        except OSError as e:
+            print(f"The lane graph could not be stored in {graph_folder}: ", e)
+
+    _LANE_GRAPH[city_name] = lane_graph
+    return lane_graph
+
+@functools.lru_cache(maxsize=LANE_SEQ_CENTERLINE_CACHE_SIZE)
+def get_lane_seq_centerline(avm, city_name, lane_seq):
+    """
+    Concatenated centerline of a lane sequence (tuple of lane ids). Read-only, since it is shared
+    """
+
+    centerline = np.vstack([np.empty((0,2))] + [avm.get_lane_segment_centerline(lane_id, city_name)[:,:2] 
+                                                for lane_id in lane_seq])
+    centerline.setflags(write=False)
+
+    return centerline
+
+def get_cl_from_lane_seq(avm, lane_seqs, city_name):
+    """
+    Same as avm.get_cl_from_lane_seq, but the centerlines are cached by lane sequence
+    """
+
+    return [get_lane_seq_centerline(avm, city_name, tuple(lane_seq)).copy() for lane_seq in lane_seqs]
+
+# Drivable area raster of each city
+
+DRIVABLE_AREA_RESOLUTION = 1.0 # m/px (ArgoverseMap drivable area rasters are 1 px per meter)
+
+_DRIVABLE_AREA_RASTER = dict() # (city_name, resolution) -> DrivableAreaRaster (built or loaded once per process)
+
+class DrivableAreaRaster:
+    """
+    Drivable area bitmap of a city (rows x cols, uint8, 1 if drivable) and the affine transform 
+    (2 x 3) from city coordinates to pixels: a point is in the pixel (floor(px_x), floor(px_y)). 
+    The bitmap is stored as .npy, so it is memory-mapped instead of loaded into memory
+    """
+
+    def __init__(self, bitmap, city_to_px):
+        self.bitmap = bitmap
+        self.city_to_px = np.asarray(city_to_px, dtype=np.float64)
+
+    @classmethod
+    def from_avm(cls, avm, city_name, resolution=DRIVABLE_AREA_RESOLUTION):
+        """
+        Build the raster from avm.get_rasterized_driveable_area(city_name), resampled (nearest) to
+        resolution (m/px)
+        """
+
+        da_mat, npyimage_to_city_se2_mat = avm.get_rasterized_driveable_area(city_name)
+
+        # Affine transform given by the 3 x 3 SE(2) matrix (city coordinates -> pixel centers, rounded
+        # by ArgoverseMap.get_raster_layer_points_boolean)
+
+        npyimage_to_city_se2_mat = np.asarray(npyimage_to_city_se2_mat, dtype=np.float64)
+        city_to_px = np.hstack((npyimage_to_city_se2_mat[:2,:2], npyimage_to_city_se2_mat[:2,2:3]))
+        city_to_px[:,2] += 0.5 # pixel centers -> pixel edges (floor instead of round)
+
+        bitmap = (np.asarray(da_mat) != 0).astype(np.uint8)
+        scale = DRIVABLE_AREA_RESOLUTION / resolution
+        if scale != 1.0:
+            rows, cols = bitmap.shape
+            bitmap = cv2.resize(bitmap, dsize=(int(round(cols*scale)),int(round(rows*scale))), 
+                                interpolation=cv2.INTER_NEAREST)
+            city_to_px *= scale
+
+        return cls(bitmap, city_to_px)
+
+    def save(self, filename):
+        """
+        Atomic writes, the transform first, so filename (the bitmap) only exists once both are complete
+        """
+
+        save_file_atomically(filename.replace(".npy","_transform.npy"), 
+                             lambda my_file: np.save(my_file, self.city_to_px))
+        save_file_atomically(filename, lambda my_file: np.save(my_file, self.bitmap))
+
+    @classmethod
+    def load(cls, filename, mmap_mode="r"):
+        return cls(np.load(filename, mmap_mode=mmap_mode), np.load(filename.replace(".npy","_transform.npy")))
+
+    def get_pixels(self, xy):
+        """
+        Pixels (column, row) of the points xy (... x 2, city coordinates)
+        """
+
+        xy = np.asarray(xy, dtype=np.float64)
+        px = np.matmul(xy, self.city_to_px[:,:2].T) + self.city_to_px[:,2]
+
+        return np.floor(px).astype(np.int64)
+
+    def is_drivable(self, xy):
+        """
+        Boolean array (...) with the drivable points of xy (... x 2, city coordinates). The points 
+        out of the raster are not drivable
+        """
+
+        px = self.get_pixels(xy)
+        rows, cols = self.bitmap.shape
+        inside = (px[...,0] >= 0) & (px[...,0] < cols) & (px[...,1] >= 0) & (px[...,1] < rows)
+
+        drivable = np.zeros(inside.shape, dtype=bool)
+        drivable[inside] = self.bitmap[px[...,1][inside],px[...,0][inside]] != 0
+
+        return drivable
+
+def get_drivable_area_raster(city_name, avm=None, resolution=DRIVABLE_AREA_RESOLUTION, raster_folder=MAP_CACHE_FOLDER):
+    """
+    Drivable area raster of city_name. It is built once (then stored in raster_folder and memory-mapped),
+    so the ArgoverseMap (avm, get_argoverse_map if it is not specified) is only required the first time. If avm 
+    is specified, the stored raster is rebuilt if its size does not match the map
+    """
+
+    key = (city_name, resolution)
+    if key in _DRIVABLE_AREA_RASTER:
+        return _DRIVABLE_AREA_RASTER[key]
+
+    filename = os.path.join(raster_folder,f"drivable_area_{city_name}_{resolution:g}m.npy")
+
+    drivable_area = None
+    if os.path.isfile(filename):
+        try:
+            drivable_area = DrivableAreaRaster.load(filename)
+        except CACHE_LOAD_ERRORS as e:
+            print(f"{filename} could not be read ({e}). Rebuild the drivable area raster")
+        if drivable_area is not None and avm is not None:
+            rows, cols = avm.get_rasterized_driveable_area(city_name)[0].shape
+            scale = DRIVABLE_AREA_RESOLUTION / resolution
+            if drivable_area.bitmap.shape != (int(round(rows*scale)),int(round(cols*scale))):
+                drivable_area = None # Outdated (different map files)
+
+    if drivable_area is None:
+        if avm is None: avm = get_argoverse_map()
+        drivable_area = DrivableAreaRaster.from_avm(avm, city_name, resolution=resolution)
+
+        try:
+            if not os.path.exists(raster_folder):
+                os.makedirs(raster_folder) # makedirs creates intermediate folders
+            drivable_area.save(filename)
+            drivable_area = DrivableAreaRaster.load(filename) # Memory-mapped
+        except OSError as e:
+            print(f"The drivable area raster could not be stored in {raster_folder}: ", e)
+
+    _DRIVABLE_AREA_RASTER[key] = drivable_area
+    return drivable_area
+
+# Memory-mapped ArgoverseMap (lanes and rasters of each city shared by all the processes)
+
+ARGOVERSE_MAP_FOLDER = os.path.join(MAP_CACHE_FOLDER,"argoverse_map")
+ARGOVERSE_MAP_KEYS = ["has_traffic_control","turn_direction","is_intersection","l_neighbor_id","r_neighbor_id",
+                      "centerline_start","centerline_points","polygon_start","polygon_points",
+                      "succ_start","succ_ids","pred_start","pred_ids","halluc_bboxes","halluc_laneid_map",
+                      "driveable_area","driveable_area_transform","ground_height","ground_height_transform",
+                      "lane_ids"] # {city_name}_{key}.npy. lane_ids is written last (the city is complete)
+TURN_DIRECTIONS = ["NONE","LEFT","RIGHT"] # LaneSegment.turn_direction (stored as the index)
+
+_ARGOVERSE_MAP = dict() # map_folder -> ArgoverseMapCache (opened once per process)
+
+class CityLanes(Mapping):
+    """
+    Read-only lane_id -> LaneSegment view of the lanes of a city (same as 
+    avm.city_lane_centerlines_dict[city_name], same order). The LaneSegment objects are created 
+    on demand from the memory-mapped arrays
+    """
+
+    def __init__(self, city_data):
+        self.city_data = city_data
+        self.lane_index = {lane_id: i for i, lane_id in enumerate(city_data["lane_ids"].tolist())}
+
+    def get_centerline(self, i):
+        start = self.city_data["centerline_start"]
+        return np.array(self.city_data["centerline_points"][start[i]:start[i+1]])
+
+    def get_lane_centerline(self, lane_id):
+        return self.get_centerline(self.lane_index[lane_id])
+
+    def get_polygon(self, i):
+        start = self.city_data["polygon_start"]
+        return np.array(self.city_data["polygon_points"][start[i]:start[i+1]])
+
+    def get_neighbours(self, i, key):
+        start = self.city_data[f"{key}_start"]
+        neighbours = self.city_data[f"{key}_ids"][start[i]:start[i+1]].tolist()
+        return neighbours if len(neighbours) > 0 else None
+
+    def __getitem__(self, lane_id):
+        i = self.lane_index[lane_id]
+        l_neighbor_id, r_neighbor_id = int(self.city_data["l_neighbor_id"][i]), int(self.city_data["r_neighbor_id"][i])
+
+        return LaneSegment(lane_id,
+                           bool(self.city_data["has_traffic_control"][i]),
+                           TURN_DIRECTIONS[self.city_data["turn_direction"][i]],
+                           bool(self.city_data["is_intersection"][i]),
+                           l_neighbor_id if l_neighbor_id != -1 else None,
+                           r_neighbor_id if r_neighbor_id != -1 else None,
+                           self.get_neighbours(i, "pred"),
+                           self.get_neighbours(i, "succ"),
+                           self.get_centerline(i))
+
+    def __iter__(self):
+        return iter(self.lane_index)
+
+    def __len__(self):
+        return len(self.lane_index)
+
+class ArgoverseMapCache:
+    """
+    Read-only ArgoverseMap (the part of its API used in this repo) backed by .npy files opened with
+    memory mapping: attributes, centerlines, polygons, successors and predecessors of the lanes (CSR), 
+    hallucinated lane bboxes (get_lane_ids_in_xy_bbox) and drivable area and ground height rasters 
+    of each city. The files are written once (build), so opening the map takes milliseconds instead 
+    of parsing the vector map, and all the processes (e.g. DataLoader or preprocessing workers) share 
+    the same physical pages. Any other attribute is taken from a full ArgoverseMap, only created if 
+    it is required (or if the files do not exist yet)
+    """
+
+    def __init__(self, map_folder=ARGOVERSE_MAP_FOLDER):
+        self.map_folder = map_folder
+        self.city_data = dict() # city_name -> dict of memory-mapped arrays
+        self.city_lanes = dict() # city_name -> CityLanes
+        self._city_names = None
+        self._city_lane_centerlines_dict = None
+        self._avm = None
+
+    # The memory maps are not pickled (e.g. spawned workers), they are opened again
+
+    def __getstate__(self):
+        return {"map_folder": self.map_folder}
+
+    def __setstate__(self, state):
+        self.__init__(state["map_folder"])
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.avm, name)
+
+    @property
+    def avm(self):
+        if self._avm is None:
+            self._avm = ArgoverseMap()
+        return self._avm
+
+    @staticmethod
+    def save_array(filename, value):
+        tmp_filename = f"{filename}.{os.getpid()}.tmp" # Other processes never read a partial file
+        with open(tmp_filename, 'wb') as my_file:
+            np.save(my_file, value)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def build(cls, avm, map_folder=ARGOVERSE_MAP_FOLDER):
+        """
+        Store the lanes and rasters of every city of avm in map_folder
+        """
+
+        if not os.path.exists(map_folder):
+            os.makedirs(map_folder) # makedirs creates intermediate folders
+
+        def get_csr(arrays, dtype):
+            start = np.concatenate(([0],np.cumsum([len(array) for array in arrays]))).astype(np.int64)
+            values = np.concatenate([np.asarray(array, dtype=dtype) for array in arrays]) if len(arrays) > 0 else np.zeros(0, dtype=dtype)
+            return start, values
+
+        for city_name, city_lane_centerlines in avm.city_lane_centerlines_dict.items():
+            lanes = list(city_lane_centerlines.values())
+            centerlines = [np.asarray(lane.centerline, dtype=np.float64)[:,:2] for lane in lanes]
+
+            city_data = dict()
+            city_data["has_traffic_control"] = np.array([bool(lane.has_traffic_control) for lane in lanes])
+            city_data["turn_direction"] = np.array([TURN_DIRECTIONS.index(lane.turn_direction) for lane in lanes], dtype=np.int8)
+            city_data["is_intersection"] = np.array([bool(lane.is_intersection) for lane in lanes])
+            city_data["l_neighbor_id"] = np.array([lane.l_neighbor_id if lane.l_neighbor_id is not None else -1 for lane in lanes], dtype=np.int64)
+            city_data["r_neighbor_id"] = np.array([lane.r_neighbor_id if lane.r_neighbor_id is not None else -1 for lane in lanes], dtype=np.int64)
+
+            city_data["centerline_start"], city_data["centerline_points"] = get_csr(centerlines, np.float64)
+            city_data["polygon_start"], city_data["polygon_points"] = get_csr([centerline_to_polygon(centerline) for centerline in centerlines],
+                                                                              np.float64)
+            city_data["succ_start"], city_data["succ_ids"] = get_csr([lane.successors or [] for lane in lanes], np.int64)
+            city_data["pred_start"], city_data["pred_ids"] = get_csr([lane.predecessors or [] for lane in lanes], np.int64)
+
+            halluc_bboxes = np.asarray(avm.city_halluc_bbox_table[city_name], dtype=np.float64)
+            city_data["halluc_bboxes"] = halluc_bboxes
+            city_data["halluc_laneid_map"] = np.array([avm.city_halluc_tableidx_to_laneid_map[city_name][str(i)] 
+                                                     for i in range(len(halluc_bboxes))], dtype=np.int64)
+
+            # The rasters are returned with their 3 x 3 SE(2) matrix (np.array), stored unchanged
+
+            da_mat, da_se2_mat = avm.get_rasterized_driveable_area(city_name)
+            city_data["driveable_area"], city_data["driveable_area_transform"] = np.asarray(da_mat), np.asarray(da_se2_mat)
+            ground_height_mat, ground_height_se2_mat = avm.get_rasterized_ground_height(city_name)
+            city_data["ground_height"], city_data["ground_height_transform"] = np.asarray(ground_height_mat), np.asarray(ground_height_se2_mat)
+
+            city_data["lane_ids"] = np.fromiter(city_lane_centerlines.keys(), dtype=np.int64)
+
+            for key in ARGOVERSE_MAP_KEYS:
+                cls.save_array(os.path.join(map_folder,f"{city_name}_{key}.npy"), city_data[key])
+
+    @property
+    def city_names(self):
+        if self._city_names is None: # The folder is only listed once
+            if not os.path.isdir(self.map_folder) or not any(filename.endswith("_lane_ids.npy") for filename in os.listdir(self.map_folder)):
+                self.build(self.avm, self.map_folder)
+
+            self._city_names = sorted(filename[:-len("_lane_ids.npy")] for filename in os.listdir(self.map_folder)
+                                      if filename.endswith("_lane_ids.npy"))
+        return self._city_names
+
+    def get_city_data(self, city_name):
+        """
+        Memory-mapped arrays of city_name (built from the full ArgoverseMap if they do not exist)
+        """
+
+        if city_name in self.city_data:
+            return self.city_data[city_name]
+
+        if not os.path.isfile(os.path.join(self.map_folder,f"{city_name}_lane_ids.npy")):
+            self.build(self.avm, self.map_folder)
+
+        city_data = {key: np.load(os.path.join(self.map_folder,f"{city_name}_{key}.npy"), mmap_mode="r") 
+                     for key in ARGOVERSE_MAP_KEYS}
+
+        self.city_data[city_name] = city_data
+        return city_data
+
+    def get_city_lanes(self, city_name):
+        if city_name not in self.city_lanes:
+            self.city_lanes[city_name] = CityLanes(self.get_city_data(city_name))
+        return self.city_lanes[city_name]
+
+    @property
+    def city_lane_centerlines_dict(self):
+        if self._city_lane_centerlines_dict is None:
+            self._city_lane_centerlines_dict = {city_name: self.get_city_lanes(city_name) for city_name in self.city_names}
+        return self._city_lane_centerlines_dict
+
+    # Rasters
+
+    def get_raster(self, city_name, key):
+        """
+        Raster and its 3 x 3 SE(2) matrix (np.array), as ArgoverseMap
+        """
+
+        city_data = self.get_city_data(city_name)
+        return city_data[key], np.array(city_data[f"{key}_transform"])
+
+    def get_rasterized_driveable_area(self, city_name):
+        return self.get_raster(city_name, "driveable_area")
+
+    def get_rasterized_ground_height(self, city_name):
+        return self.get_raster(city_name, "ground_height")
+
+    def get_ground_height_at_xy(self, point_cloud, city_name):
+        """
+        Ground height of the points (N x 2, city coordinates). NaN if they are out of the raster
+        """
+
+        city_data = self.get_city_data(city_name)
+        ground_height_mat, transform = city_data["ground_height"], city_data["ground_height_transform"]
+
+        px = np.round(np.matmul(np.asarray(point_cloud)[:,:2], transform[:2,:2].T) + transform[:2,2]).astype(np.int64)
+        valid = ((px[:,0] >= 0) & (px[:,0] < ground_height_mat.shape[1]) 
+               & (px[:,1] >= 0) & (px[:,1] < ground_height_mat.shape[0]))
+
+        ground_height_values = np.full(px.shape[0], np.nan)
+        ground_height_values[valid] = ground_height_mat[px[valid,1],px[valid,0]]
+
+        return ground_height_values
+
+    def append_height_to_2d_city_pt_cloud(self, pt_cloud_xy, city_name):
+        return np.hstack([pt_cloud_xy, self.get_ground_height_at_xy(pt_cloud_xy, city_name)[:,np.newaxis]])
+
+    # Lanes
+
+    def get_lane_segment_centerline(self, lane_segment_id, city_name):
+        city_lanes = self.get_city_lanes(city_name)
+        return self.append_height_to_2d_city_pt_cloud(city_lanes.get_centerline(city_lanes.lane_index[lane_segment_id]), city_name)
+
+    def get_lane_segment_polygon(self, lane_segment_id, city_name):
+        city_lanes = self.get_city_lanes(city_name)
+        return self.append_height_to_2d_city_pt_cloud(city_lanes.get_polygon(city_lanes.lane_index[lane_segment_id]), city_name)
+
+    def get_lane_ids_in_xy_bbox(self, query_x, query_y, city_name, query_search_range_manhattan=5.0):
+        """
+        Lanes whose hallucinated bbox overlaps the query bbox (same order as ArgoverseMap)
+        """
+
+        city_data = self.get_city_data(city_name)
+        query_bbox = np.array([query_x - query_search_range_manhattan, query_y - query_search_range_manhattan,
+                               query_x + query_search_range_manhattan, query_y + query_search_range_manhattan])
+        overlap_indxs = find_all_polygon_bboxes_overlapping_query_bbox(city_data["halluc_bboxes"], query_bbox)
+
+        return city_data["halluc_laneid_map"][overlap_indxs].tolist()
+
+    def get_lane_segments_containing_xy(self, query_x, query_y, city_name):
+        occupied_lane_ids = []
+        for lane_id in self.get_lane_ids_in_xy_bbox(query_x, query_y, city_name):
+            lane_polygon = self.get_lane_segment_polygon(lane_id, city_name)
+            if point_inside_polygon(lane_polygon.shape[0], lane_polygon[:,0], lane_polygon[:,1], query_x, query_y):
+                occupied_lane_ids.append(lane_id)
+
+        return occupied_lane_ids
+
+    def remove_extended_predecessors(self, lane_seqs, xy, city_name):
+        """
+        Remove the lanes before the lane occupied by the first point of the trajectory
+        """
+
+        occupied_lane_ids = self.get_lane_segments_containing_xy(xy[0,0], xy[0,1], city_name)
+
+        filtered_lane_seq = []
+        for lane_seq in lane_seqs:
+            new_lane_seq = lane_seq
+            for i, lane_id in enumerate(lane_seq):
+                if lane_id in occupied_lane_ids:
+                    new_lane_seq = lane_seq[i:]
+                    break
+            filtered_lane_seq.append(new_lane_seq)
+
+        return filtered_lane_seq
+
+    def draw_lane(self, lane_segment_id, city_name, legend=False, color="lightgrey"):
+        lane_segment_polygon = self.get_lane_segment_polygon(lane_segment_id, city_name)
+        if legend:
+            plt.plot(lane_segment_polygon[:,0], lane_segment_polygon[:,1], color="dimgray", label="Lane")
+        else:
+            plt.plot(lane_segment_polygon[:,0], lane_segment_polygon[:,1], color=color)
+
+def get_argoverse_map(map_folder=ARGOVERSE_MAP_FOLDER):
+    """
+    Memory-mapped ArgoverseMap (ArgoverseMapCache) stored in map_folder, opened once per process.
+    The cities are mapped the first time they are used
+    """
+
+    if map_folder not in _ARGOVERSE_MAP:
+        _ARGOVERSE_MAP[map_folder] = ArgoverseMapCache(map_folder)
+
+    return _ARGOVERSE_MAP[map_folder]
+
 # Main function for map generation
 
 def map_generator(curr_num_seq,
@@ -94,8 +903,10 @@ def map_generator(curr_num_seq,
                   city_name,
                   centerlines_colour="gray",
                   show: bool = False,
-                  root_folder = "data/datasets/argoverse/motion-forecasting/train/data_images") -> None:
+                  root_folder = "data/datasets/argoverse/motion-forecasting/train/data_images",
+                  img_size = raster_functions.IMG_SIZE) -> None:
     """
+    Save the BEV image (img_size x img_size pixels) of the lanes around origin_pos
     """
 
     if not os.path.exists(root_folder):
@@ -118,24 +929,11 @@ def map_generator(curr_num_seq,
 
     t0 = time.time()
 
-    seq_lane_props = dict()
-    if plot_centerlines:
-        seq_lane_props = avm.city_lane_centerlines_dict[city_name]
-
-    ### Get lane centerlines which lie within the range of trajectories
+    ### Get lane centerlines which lie within the range of trajectories (spatial index of the city)
 
     lane_centerlines = []
-    
-    for lane_id, lane_props in seq_lane_props.items():
-
-        lane_cl = lane_props.centerline
-
-        if (np.min(lane_cl[:, 0]) < x_max
-            and np.min(lane_cl[:, 1]) < y_max
-            and np.max(lane_cl[:, 0]) > x_min
-            and np.max(lane_cl[:, 1]) > y_min):
-
-            lane_centerlines.append(lane_cl)
+    if plot_centerlines:
+        _, lane_centerlines = get_lanes_in_bbox(avm, city_name, x_min, x_max, y_min, y_max)
 
     ## Get local polygons around the origin
 
@@ -159,45 +957,30 @@ def map_generator(curr_num_seq,
 
     # print("\nTime consumed by local das and polygons calculation: ", time.time()-t0)
 
-    # Plot
-
-    fig, ax = plt.subplots(figsize=(6,6), facecolor="black")
-    plt.xlim(x_min, x_max)
-    plt.ylim(y_min, y_max)
-    plt.axis("off") # Comment if you want to generate images with x|y-labels
-    
-    ## Plot nearby segments
-
-    # avm.plot_nearby_halluc_lanes(ax, city_name, xcenter, ycenter)
-
-    ## Plot hallucinated polygones and centerlines
+    # Rasterize the lane polygons and centerlines (no matplotlib figure). The image covers
+    # exactly the [x_min,x_max] x [y_min,y_max] area
 
     t0 = time.time()
 
-    for lane_cl in lane_centerlines:
-        lane_polygon = centerline_to_polygon(lane_cl[:, :2])
-                                                                          #"black"  
-        ax.fill(lane_polygon[:, 0], lane_polygon[:, 1], "white", edgecolor='white', fill=True)
-        ax.plot(lane_cl[:, 0], lane_cl[:, 1], "-", color=centerlines_colour, linewidth=1.5, alpha=1.0, zorder=2)
-        # N.B. If you want to represent the centerline on top of the filled polygon, the zorder must be higher
-
-    # print("Time consumed by plot drivable area and lane centerlines: ", time.time()-t0)
+    img, _ = raster_functions.rasterize_lanes(lane_centerlines, extent=(x_min, x_max, y_min, y_max), 
+                                              img_size=img_size, channels=3, lane_colour="white", 
+                                              centerlines_colour=centerlines_colour)
 
     # draw_lane_polygons(ax, local_das, "tab:pink", linewidth=1.5, fill=False)
     # draw_lane_polygons(ax, local_lane_polygons, "tab:red", linewidth=1.5, fill=False)
 
+    # print("Time consumed by plot drivable area and lane centerlines: ", time.time()-t0)
+
     # Save image
 
     filename = root_folder + "/" + str(curr_num_seq) + ".png"
 
     if show:
+        plt.imshow(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
         plt.show()
         pdb.set_trace()
 
-    # Save PLT canvas -> png to automatically remove padding
-
-    plt.savefig(filename, bbox_inches='tight', facecolor=fig.get_facecolor(), 
-                edgecolor='none', pad_inches=0)
+    cv2.imwrite(filename, img)
 
 # Map Feature computations
 
@@ -229,13 +1012,8 @@ class MapFeaturesUtils:
         Returns:
             point_in_polygon_score: Number of coordinates in the trajectory that lie within the lane sequence
         """
-        lane_seq_polygon = unary_union([
-            Polygon(avm.get_lane_segment_polygon(lane, city_name)).buffer(0)
-            for lane in lane_seq
-        ])
-        point_in_polygon_score = 0
-        for xy in xy_seq:
-            point_in_polygon_score += lane_seq_polygon.contains(Point(xy))
+        lane_seq_polygon = get_lane_seq_polygon(avm, city_name, tuple(lane_seq)) # LRU cache
+        point_in_polygon_score = int(np.count_nonzero(points_in_polygon(lane_seq_polygon, xy_seq)))
         return point_in_polygon_score
 
     def sort_lanes_based_on_point_in_polygon_score(
@@ -302,7 +1080,7 @@ class MapFeaturesUtils:
             lane_seq = lane_seqs[i]
             score = scores[i]
             diverse = True
-            centerline = avm.get_cl_from_lane_seq([lane_seq], city_name)[0]
+            centerline = get_cl_from_lane_seq(avm, [lane_seq], city_name)[0]
             if aligned_cl_count < int(max_candidates / 2):
                 start_dist = LineString(centerline).project(Point(xy_seq[0]))
                 end_dist = LineString(centerline).project(Point(xy_seq[-1]))
@@ -359,98 +1137,20 @@ class MapFeaturesUtils:
 
         # ... . . .  .  .  .    .    .    .     .     .      .       .       .       .       .        .        .          . (Wrong interpretation) 
 
-        x = agent_seq[:,0]
-        y = agent_seq[:,1]
-        xy = np.vstack((x, y))
-
-        extended_xy_f = np.array([])
-        num_points_trajectory = agent_seq.shape[0]
-
-        if filter == "savgol":
-            xy_f = savgol_filter(xy, window_length=int(num_points_trajectory/4), polyorder=3, axis=1)
-        elif filter == "cubic_spline":
-            points = np.arange(agent_seq.shape[0])
-            upsampled_num_points_ = upsampling_factor*num_points_trajectory # We upsample the frequency to estimate more
-                                                                            # points from the given observation data
-            period = period / upsampling_factor
-
-            upsampled_points = np.linspace(points.min(), points.max(), upsampled_num_points_)
-
-            up_x = sp.interpolate.interp1d(points,x,kind='cubic')(upsampled_points)
-            up_y = sp.interpolate.interp1d(points,y,kind='cubic')(upsampled_points)
-
-            xy_f = np.vstack((up_x,up_y))
-
-            num_points_trajectory = upsampled_num_points_
-        elif filter == "savgol+cubic_spline":
-            points = np.arange(num_points_trajectory)
-            upsampled_num_points_ = upsampling_factor*num_points_trajectory # We upsample the frequency to estimate more
-            # points from the given observation data
-            period = period / upsampling_factor
-
-            upsampled_points = np.linspace(points.min(), points.max(), upsampled_num_points_)
-
-            up_x = sp.interpolate.interp1d(points,x,kind='cubic')(upsampled_points)
-            up_y = sp.interpolate.interp1d(points,y,kind='cubic')(upsampled_points)
-
-            num_points_trajectory = upsampled_num_points_
-
-            xy_f = np.vstack((up_x,up_y))
-            xy_f = savgol_filter(xy_f, window_length=int(num_points_trajectory/4), polyorder=3, axis=1)
-        elif filter == "least_squares":
-            polynomial_order = 2
-            # print("Polynomial order: ", polynomial_order)
-            t = np.linspace(1, num_points_trajectory, num_points_trajectory)
-            px = np.poly1d(np.polyfit(t,x,polynomial_order))
-            py = np.poly1d(np.polyfit(t,y,polynomial_order))
-
-            xy_f = np.vstack((px(t),py(t)))
+        # Batched kinematics (kinematic_functions) with a single trajectory
 
-            seq_len = 50
-            t2 = np.linspace(1, seq_len, seq_len)
-            extended_xy_f = np.vstack((px(t2),py(t2)))
-        else: # No filter, original data
-            xy_f = xy
+        kinematic_features = kinematic_functions.get_kinematic_features(agent_seq[np.newaxis,:,:2], period=period,
+                                                                        filter=filter if filter else "none",
+                                                                        upsampling_factor=upsampling_factor)
 
-        obs_seq_f = xy_f
-
-        vel_f = np.zeros((num_points_trajectory-1))
-        for i in range(1,obs_seq_f.shape[1]):
-            x_pre, y_pre = obs_seq_f[:,i-1]
-            x_curr, y_curr = obs_seq_f[:,i]
-
-            dist = math.sqrt(pow(x_curr-x_pre,2)+pow(y_curr-y_pre,2))
-
-            curr_vel = dist / period
-            vel_f[i-1] = curr_vel
-        
-        acc_f = np.zeros((num_points_trajectory-2))
-        for i in range(1,len(vel_f)):
-            vel_pre = vel_f[i-1]
-            vel_curr = vel_f[i]
-
-            delta_vel = vel_curr - vel_pre
-
-            curr_acc = delta_vel / period
-            acc_f[i-1] = curr_acc
+        vel_f_averaged = kinematic_features["vel"][0]
+        acc_f_averaged = kinematic_features["acc"][0]
+        xy_f = kinematic_features["xy_filtered"][0].T # 2 x num_points
+        extended_xy_f = kinematic_features["extended_xy_filtered"][0].T
 
         min_weight = 1
         max_weight = 4
-
-        if filter == "least_squares":
-            # Theoretically, if the points are computed using Least Squares with a Polynomial with order >= 2,
-            # the velocity in the last observation should be fine, since you are taking into account the 
-            # acceleration (either negative or positive)
-
-            vel_f_averaged = vel_f[-1]
-        else:
-            vel_f_averaged = np.average(vel_f,weights=np.linspace(min_weight,max_weight,len(vel_f))) 
-
-        acc_f_averaged = np.average(acc_f,weights=np.linspace(min_weight,max_weight,len(acc_f)))
         acc_f_averaged_aux = acc_f_averaged
-        if vel_f_averaged > 35 and acc_f_averaged > 5:
-            acc_f_averaged = 0 # The vehicle cannot drive faster in this problem!
-                               # This is an assumption!
 
         if debug:
             print("Filter: ", filter)
@@ -550,21 +1250,17 @@ class MapFeaturesUtils:
                                agent_xy=None,obs_len=None,seq_len=None,split=None,seq_id=None,
                                viz=False,debug=False):
         """
+        Resample the centerline (N x 2) to max_points equally spaced points along its arc length
+        (cubic Hermite spline, geometric_functions.resample_polylines). Return None if the centerline
+        is empty
         """
 
-        try:
-            cx, cy = centerline[:,0], centerline[:,1]
-            points = np.arange(cx.shape[0])
-
-            new_points = np.linspace(points.min(), points.max(), max_points)
-        
-            new_cx = sp.interpolate.interp1d(points,cx,kind='cubic')(new_points)
-            new_cy = sp.interpolate.interp1d(points,cy,kind='cubic')(new_points)
-        except:
-            if debug: pdb.set_trace()
+        centerline = np.asarray(centerline)[:,:2]
+        if centerline.shape[0] == 0:
             return
 
-        interp_centerline = np.hstack([new_cx.reshape(-1,1),new_cy.reshape(-1,1)])
+        interp_centerline = geometric_functions.resample_polylines(centerline[np.newaxis], [centerline.shape[0]],
+                                                                   num_points=max_points, mode="spline")[0]
 
         if viz:
             fig, ax = plt.subplots(figsize=(8,8), facecolor="white")
@@ -824,13 +1520,12 @@ class MapFeaturesUtils:
 
     def get_closest_wp(self, pos, centerline):
         """
+        Index of the closest waypoint of the centerline to pos and L2-distance of each waypoint
         """
 
-        query_obs = np.repeat(pos.reshape(1,-1),repeats=centerline.shape[0],axis=0)
-        dist_array = np.zeros((query_obs.shape[0]))
-
-        for k in range(query_obs.shape[0]): # TODO: How to compute the L2-distance point by point?
-            dist_array[k] = np.linalg.norm(centerline[k,:]-query_obs[k,:])
+        diff = centerline - pos.reshape(1,-1)
+        dist_array = np.sqrt(np.matmul(diff[:,None,:],diff[:,:,None]).reshape(-1)) # Same as np.linalg.norm 
+                                                                                   # (dot) per waypoint
 
         closest_wp = np.argmin(dist_array)
 
@@ -953,10 +1648,11 @@ class MapFeaturesUtils:
             # print("dfs_threshold_front, dfs_threshold_back: ", dfs_threshold_front, dfs_threshold_back)
 
             # DFS to get all successor and predecessor candidates
+            lane_graph = get_lane_graph(avm, city_name) # Precomputed graph of the city (memoized DFS)
             obs_pred_lanes: List[Sequence[int]] = []
             for lane in curr_lane_candidates:
-                candidates_future = avm.dfs(lane, city_name, 0, dfs_threshold_front)
-                candidates_past = avm.dfs(lane, city_name, 0, dfs_threshold_back, True)
+                candidates_future = lane_graph.dfs(lane, dfs_threshold_front)
+                candidates_past = lane_graph.dfs(lane, dfs_threshold_back, True)
 
                 # Merge past and future
                 for past_lane_seq in candidates_past:
@@ -983,8 +1679,7 @@ class MapFeaturesUtils:
                 candidate_centerlines = self.get_heuristic_centerlines_for_test_set(
                     obs_pred_lanes, xy_filtered, city_name, avm, max_candidates, scores)
             else:
-                candidate_centerlines = avm.get_cl_from_lane_seq(
-                    [obs_pred_lanes[0]], city_name)
+                candidate_centerlines = get_cl_from_lane_seq(avm, [obs_pred_lanes[0]], city_name)
                 
             ## Additional ##
 
@@ -1037,10 +1732,11 @@ class MapFeaturesUtils:
             dfs_threshold_back = dist_around
 
             # DFS to get all successor and predecessor candidates
+            lane_graph = get_lane_graph(avm, city_name) # Precomputed graph of the city (memoized DFS)
             obs_pred_lanes: List[List[int]] = []
             for lane in curr_lane_candidates:
-                candidates_future = avm.dfs(lane, city_name, 0, dfs_threshold_front)
-                candidates_past = avm.dfs(lane, city_name, 0, dfs_threshold_back, True)
+                candidates_future = lane_graph.dfs(lane, dfs_threshold_front)
+                candidates_past = lane_graph.dfs(lane, dfs_threshold_back, True)
 
                 # Merge past and future
                 for past_lane_seq in candidates_past:
@@ -1055,7 +1751,7 @@ class MapFeaturesUtils:
             obs_pred_lanes = avm.remove_extended_predecessors(obs_pred_lanes, xy_filtered, city_name)
 
             # Getting candidate centerlines
-            candidate_cl = avm.get_cl_from_lane_seq(obs_pred_lanes, city_name)
+            candidate_cl = get_cl_from_lane_seq(avm, obs_pred_lanes, city_name)
 
             # Reduce the number of candidates based on distance travelled along the centerline
             candidate_centerlines = filter_candidate_centerlines(xy_filtered, candidate_cl)
@@ -1106,14 +1802,8 @@ class MapFeaturesUtils:
             y_min = ycenter + dist_rasterized_map[2]
             y_max = ycenter + dist_rasterized_map[3]
 
-            seq_lane_props = dict()
+            ### Get lane centerlines which lie within the range of trajectories (spatial index of the city)
 
-            seq_lane_props = avm.city_lane_centerlines_dict[city_name]
-
-            ### Get lane centerlines which lie within the range of trajectories
-
-            lane_centerlines = []
-            lane_ids = []
             obs_pred_lanes: List[Sequence[int]] = []
 
             yaw_aux = math.pi/2 - yaw # In order to align the data with the vertical axis
@@ -1121,16 +1811,7 @@ class MapFeaturesUtils:
 
             last_obs = xy_filtered[-1,:]
 
-            for lane_id, lane_props in seq_lane_props.items():
-                lane_cl = lane_props.centerline
-
-                if (np.min(lane_cl[:, 0]) < x_max
-                    and np.min(lane_cl[:, 1]) < y_max
-                    and np.max(lane_cl[:, 0]) > x_min
-                    and np.max(lane_cl[:, 1]) > y_min):
-
-                    lane_centerlines.append(lane_cl)
-                    lane_ids.append(lane_id)
+            lane_ids, lane_centerlines = get_lanes_in_bbox(avm, city_name, x_min, x_max, y_min, y_max)
             candidate_centerlines = lane_centerlines
 
             ### Filter centerline which start point is in front of the agent last observation
@@ -31,6 +31,7 @@ import matplotlib.pyplot as plt
 
 import model.datasets.argoverse.dataset_utils as dataset_utils
 import model.datasets.argoverse.goal_points_functions as goal_points_functions
+import model.datasets.argoverse.map_functions as map_functions
 
 #######################################
 
@@ -360,20 +361,12 @@ def viz_predictions_all(
                                 fontsize=12
                                 )
                         
-        seq_lane_props = avm.city_lane_centerlines_dict[city_name]
+        ### Get lane centerlines which lie within the range of trajectories (spatial index of the city)
 
-        ### Get lane centerlines which lie within the range of trajectories
+        lane_ids, _ = map_functions.get_lanes_in_bbox(avm, city_name, x_min, x_max, y_min, y_max)
 
-        for lane_id, lane_props in seq_lane_props.items():
-
-            lane_cl = lane_props.centerline
-
-            if (np.min(lane_cl[:, 0]) < x_max
-                and np.min(lane_cl[:, 1]) < y_max
-                and np.max(lane_cl[:, 0]) > x_min
-                and np.max(lane_cl[:, 1]) > y_min):
-
-                avm.draw_lane(lane_id, city_name, color="lightgray")
+        for lane_id in lane_ids:
+            avm.draw_lane(lane_id, city_name, color="lightgray")
 
     plt.xlim(x_min, x_max)
     plt.ylim(y_min, y_max)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3.8
+# -*- coding: utf-8 -*-
+
+## Raster functions (headless BEV images of the lanes, without matplotlib)
+
+"""
+Created on Fri Oct 16 2026
+@author: Carlos Gómez-Huélamo
+"""
+
+# General purpose imports
+
+import math
+
+# DL & Math imports
+
+import numpy as np
+import cv2
+
+# Custom imports
+
+from argoverse.utils.centerline_utils import centerline_to_polygon
+
+#######################################
+
+# The images are equivalent to the matplotlib figures previously used (figsize=(6,6), dpi=100, axes
+# covering the whole figure, xlim/ylim = world extent), so the line widths (points) are converted
+# to pixels as linewidth * DPI / 72
+
+DPI = 100
+IMG_SIZE = 600 # pixels (6 inches x 100 dpi)
+SUBPIXEL_SHIFT = 4 # cv2 fixed-point coordinates (1/16 pixel)
+
+# BGR (cv2) values of the matplotlib colours used by the BEV images
+
+COLOURS = {"black": (0,0,0),
+           "white": (255,255,255),
+           "gray": (128,128,128),
+           "grey": (128,128,128),
+           "red": (0,0,255),
+           "r": (0,0,255),
+           "green": (0,128,0),
+           "g": (0,128,0),
+           "blue": (255,0,0),
+           "b": (255,0,0),
+           "darkmagenta": (139,0,139)}
+
+def get_colour(colour, channels=3):
+    """
+    BGR tuple (channels = 3) or gray level (channels = 1, same as cv2.COLOR_BGR2GRAY) of a colour
+    name or BGR tuple
+    """
+
+    bgr = COLOURS[colour] if isinstance(colour, str) else tuple(colour)
+
+    if channels == 1:
+        if len(bgr) == 1: return (int(bgr[0]),)
+        b, g, r = bgr
+        return (int(round(0.299*r + 0.587*g + 0.114*b)),)
+
+    return tuple(int(c) for c in bgr)
+
+def points_to_pixels(linewidth, dpi=DPI):
+    """
+    Matplotlib linewidth (points) to line thickness (pixels, at least 1)
+    """
+
+    return max(1,int(round(linewidth * dpi / 72)))
+
+def get_empty_canvas(img_size=IMG_SIZE, channels=3, batch_size=None, background="black"):
+    """
+    img_size: int or (width, height). Return a (height x width x channels) uint8 canvas (batch_size x
+    height x width x channels if batch_size is specified) filled with the background colour
+    """
+
+    width, height = (img_size, img_size) if np.isscalar(img_size) else img_size
+
+    shape = (height, width, channels)
+    if batch_size is not None: shape = (batch_size,) + shape
+
+    canvas = np.empty(shape, dtype=np.uint8)
+    canvas[...] = get_colour(background, channels=channels)
+
+    return canvas
+
+def world_to_pixel(xy, extent, img_size):
+    """
+    xy: np.array (... x 2) in world coordinates
+    extent: (x_min, x_max, y_min, y_max) of the image
+    img_size: (width, height) in pixels
+    Return the pixel coordinates (... x 2, float, column|row). x_min|y_max correspond to the left|top
+    edges of the image and the y axis is inverted (like imshow with origin="upper")
+    """
+
+    x_min, x_max, y_min, y_max = extent
+    width, height = img_size
+
+    xy = np.asarray(xy, dtype=np.float64)
+    px = np.empty_like(xy)
+    px[...,0] = (xy[...,0] - x_min) * (width / (x_max - x_min))
+    px[...,1] = (y_max - xy[...,1]) * (height / (y_max - y_min))
+
+    return px
+
+def to_cv2_points(px):
+    """
+    Pixel coordinates (edges) to the fixed-point coordinates (pixel centers) used by cv2 (int32 with
+    SUBPIXEL_SHIFT fractional bits)
+    """
+
+    return np.round((px - 0.5) * (1 << SUBPIXEL_SHIFT)).astype(np.int32)
+
+def rasterize_polygons(canvas, polygons, extent, colour="white", edge_thickness=0, antialiasing=False):
+    """
+    Fill the polygons (list of N x 2 arrays in world coordinates) in the canvas (height x width x channels,
+    modified in-place). edge_thickness (pixels) also draws the outline, as the edgecolor of ax.fill
+    """
+
+    if len(polygons) == 0:
+        return canvas
+
+    height, width = canvas.shape[:2]
+    colour = get_colour(colour, channels=canvas.shape[2] if canvas.ndim == 3 else 1)
+    line_type = cv2.LINE_AA if antialiasing else cv2.LINE_8
+
+    # Transform all the polygons at once
+
+    lengths = [len(polygon) for polygon in polygons]
+    px = to_cv2_points(world_to_pixel(np.concatenate(polygons,axis=0), extent, (width,height)))
+    px = np.split(px, np.cumsum(lengths)[:-1])
+
+    # One fillPoly call per polygon: a single call fills the contours with the even-odd rule, so the
+    # overlap of two polygons (e.g. lanes sharing their first segments) would be left unfilled
+
+    for polygon_px in px:
+        cv2.fillPoly(canvas, [polygon_px], colour, lineType=line_type, shift=SUBPIXEL_SHIFT)
+    if edge_thickness > 0:
+        cv2.polylines(canvas, px, True, colour, thickness=edge_thickness, lineType=line_type, shift=SUBPIXEL_SHIFT)
+
+    return canvas
+
+def rasterize_polylines(canvas, polylines, extent, colour="gray", thickness=2, antialiasing=False):
+    """
+    Draw the polylines (list of N x 2 arrays in world coordinates) in the canvas (modified in-place)
+    """
+
+    if len(polylines) == 0:
+        return canvas
+
+    height, width = canvas.shape[:2]
+    colour = get_colour(colour, channels=canvas.shape[2] if canvas.ndim == 3 else 1)
+    line_type = cv2.LINE_AA if antialiasing else cv2.LINE_8
+
+    lengths = [len(polyline) for polyline in polylines]
+    px = to_cv2_points(world_to_pixel(np.concatenate(polylines,axis=0), extent, (width,height)))
+    px = np.split(px, np.cumsum(lengths)[:-1])
+
+    cv2.polylines(canvas, px, False, colour, thickness=thickness, lineType=line_type, shift=SUBPIXEL_SHIFT)
+
+    return canvas
+
+def rasterize_points(canvas, points, extent, colour="red", radius=3, antialiasing=False):
+    """
+    Draw the points (N x 2 in world coordinates) as filled circles in the canvas (modified in-place)
+    """
+
+    height, width = canvas.shape[:2]
+    colour = get_colour(colour, channels=canvas.shape[2] if canvas.ndim == 3 else 1)
+    line_type = cv2.LINE_AA if antialiasing else cv2.LINE_8
+
+    px = to_cv2_points(world_to_pixel(np.asarray(points).reshape(-1,2), extent, (width,height)))
+    for center in px:
+        cv2.circle(canvas, tuple(center.tolist()), radius << SUBPIXEL_SHIFT, colour, thickness=-1,
+                   lineType=line_type, shift=SUBPIXEL_SHIFT)
+
+    return canvas
+
+def get_arrow_polygon(origin, dx, dy, width):
+    """
+    Polygon (world coordinates) of plt.arrow(x, y, dx, dy, width=width) with the default head
+    (head_width = 3 * width, head_length = 1.5 * head_width, not included in the length)
+    """
+
+    length = math.hypot(dx, dy)
+    if length == 0:
+        return np.zeros((0,2))
+
+    head_width = 3 * width
+    head_length = 1.5 * head_width
+
+    # Arrow pointing to +x, then rotated and translated
+
+    arrow = np.array([[0,-width/2],
+                      [length,-width/2],
+                      [length,-head_width/2],
+                      [length+head_length,0],
+                      [length,head_width/2],
+                      [length,width/2],
+                      [0,width/2]])
+
+    c, s = dx / length, dy / length
+    R = np.array([[c,s],[-s,c]])
+
+    return np.matmul(arrow,R) + np.asarray(origin).reshape(1,2)
+
+def get_lane_polygons(centerlines):
+    """
+    Lane polygons (argoverse centerline_to_polygon) of the centerlines (list of N x 2 arrays). Padded
+    centerlines (all zeros) are ignored
+    """
+
+    return [centerline_to_polygon(centerline[:,:2]) for centerline in centerlines if np.any(centerline)]
+
+def get_polygons_extent(polygons):
+    """
+    (x_min, x_max, y_min, y_max) of a list of polygons
+    """
+
+    xy = np.concatenate(polygons,axis=0)
+    x_min, y_min = xy.min(axis=0)
+    x_max, y_max = xy.max(axis=0)
+
+    return (x_min, x_max, y_min, y_max)
+
+def rasterize_lanes(centerlines, extent=None, img_size=IMG_SIZE, channels=3, canvas=None,
+                    lane_colour="white", centerlines_colour="gray", centerlines_width=1.5,
+                    highlight_first_lane=None, antialiasing=False):
+    """
+    BEV image (height x width x channels, uint8) of the lanes: lane polygons filled with lane_colour
+    and centerlines (linewidth in points) drawn on top, on a black background. If extent is None,
+    it is the bbox of the lane polygons. highlight_first_lane (colour) fills the polygon of the first
+    centerline again (e.g. the oracle). Return the image and the extent
+    """
+
+    lane_polygons = get_lane_polygons(centerlines)
+    centerlines = [centerline[:,:2] for centerline in centerlines if np.any(centerline)]
+
+    if extent is None:
+        extent = get_polygons_extent(lane_polygons) if len(lane_polygons) > 0 else (-1,1,-1,1)
+
+    if canvas is None:
+        canvas = get_empty_canvas(img_size, channels=channels)
+
+    rasterize_polygons(canvas, lane_polygons, extent, colour=lane_colour, edge_thickness=1, antialiasing=antialiasing)
+    if highlight_first_lane is not None and len(lane_polygons) > 0:
+        rasterize_polygons(canvas, lane_polygons[:1], extent, colour=highlight_first_lane, edge_thickness=1,
+                           antialiasing=antialiasing)
+    if centerlines_colour is not None:
+        rasterize_polylines(canvas, centerlines, extent, colour=centerlines_colour,
+                            thickness=points_to_pixels(centerlines_width), antialiasing=antialiasing)
+
+    return canvas, extent
+
+def rasterize_lanes_batch(centerlines_batch, extents=None, img_size=IMG_SIZE, channels=3, **kwargs):
+    """
+    BEV images of a batch of sequences. centerlines_batch: list (batch_size) of lists of centerlines,
+    extents: list of (x_min, x_max, y_min, y_max) (None -> bbox of the lanes of each sequence). Return
+    a batch_size x height x width x channels uint8 array (filled in-place) and the extents
+    """
+
+    canvas = get_empty_canvas(img_size, channels=channels, batch_size=len(centerlines_batch))
+    if extents is None: extents = [None] * len(centerlines_batch)
+
+    extents_out = []
+    for i, (centerlines, extent) in enumerate(zip(centerlines_batch, extents)):
+        _, extent = rasterize_lanes(centerlines, extent=extent, canvas=canvas[i], **kwargs)
+        extents_out.append(extent)
+
+    return canvas, extents_out
+
+def rasterize_agent(canvas, agent_xy, extent, obs_len, lane_dir_vector=None, antialiasing=False):
+    """
+    Draw the agent in the canvas (modified in-place), as in the color plausible area images:
+    orientation in the last observation (darkmagenta arrow), observation (blue) and prediction (red,
+    if agent_xy contains it) with the final position
+    """
+
+    if lane_dir_vector is not None:
+        arrow = get_arrow_polygon(agent_xy[obs_len-1], lane_dir_vector[0] * 4, lane_dir_vector[1] * 4, width=0.3)
+        if len(arrow) > 0:
+            rasterize_polygons(canvas, [arrow], extent, colour="darkmagenta", antialiasing=antialiasing)
+
+    thickness = points_to_pixels(3)
+    radius = max(1,points_to_pixels(5) // 2)
+
+    if agent_xy.shape[0] > obs_len: # train and val
+        rasterize_polylines(canvas, [agent_xy[:obs_len]], extent, colour="b",
+                            thickness=thickness, antialiasing=antialiasing)
+        rasterize_polylines(canvas, [agent_xy[obs_len:]], extent, colour="r",
+                            thickness=thickness, antialiasing=antialiasing)
+        rasterize_points(canvas, agent_xy[-1], extent, colour="r", radius=radius, antialiasing=antialiasing)
+    else: # test
+        rasterize_polylines(canvas, [agent_xy], extent, colour="b", thickness=thickness, antialiasing=antialiasing)
+        rasterize_points(canvas, agent_xy[-1], extent, colour="b", radius=radius, antialiasing=antialiasing)
+
+    return canvas
+
+if __name__ == "__main__":
+    # Sanity check: the overlap of two crossing lanes is filled (as each lane alone)
+
+    crossing_centerlines = [np.array([[-20.0,0.0],[20.0,0.0]]), np.array([[0.0,-20.0],[0.0,20.0]])]
+    extent = (-20,20,-20,20)
+
+    img, _ = rasterize_lanes(crossing_centerlines, extent=extent, centerlines_colour=None)
+    for centerline in crossing_centerlines:
+        img_lane, _ = rasterize_lanes([centerline], extent=extent, centerlines_colour=None)
+        assert np.all(img[img_lane != 0] != 0), "Overlapping lanes are not filled"
+    assert np.all(img[IMG_SIZE//2,IMG_SIZE//2] == get_colour("white")), "Overlapping lanes are not filled"
+
+    print("Overlapping lanes are filled")
@@ -29,6 +29,11 @@ from torch.autograd import Function
 from numba import jit, prange, cuda
 from torch import Tensor
 
+# Custom imports
+
+import model.datasets.argoverse.dataset_utils as dataset_utils
+import model.datasets.argoverse.map_functions as map_functions
+
 #######################################
 
 smooth_l1_loss = nn.SmoothL1Loss(reduction="none") # mean, sum, none
@@ -411,81 +416,62 @@ def _assert_shapes(ground_truth: np.ndarray, pred: np.ndarray, confidences: np.n
     assert np.isfinite(avails).all(), "invalid value found in avails"
 
 def evaluate_feasible_area_prediction(pred_traj_fake_abs, pred_traj_gt_abs, map_origin, num_seq, 
-                                      absolute_root_folder, split, dist_rasterized_map=[-40,40,-40,40]):
+                                      absolute_root_folder, split, dist_rasterized_map=[-40,40,-40,40],
+                                      city_ids=None, mode="average"):
     """
-    Get feasible_area_loss. If a prediction point (in pixel coordinates) is in the drivable (feasible)
-    area, is weighted with 1. Otherwise, it is weighted with 0. Theoretically, most AGENT points (observation
-    and prediction) must be in the Feasible Area in Argoverse 1.1.
+    Get feasible_area_loss. If a prediction point is in the drivable (feasible) area of the city 
+    (map_functions.DrivableAreaRaster, memory-mapped), is weighted with 1. Otherwise, it is weighted 
+    with 0. Theoretically, most AGENT points (observation and prediction) must be in the Feasible Area 
+    in Argoverse 1.1.
 
     Input:
-        pred_traj_fake_abs: Torch.tensor -> pred_len x 2 (x|y) in absolute coordinates (around 0,0)
-        map_origin: Tor
-        filename: Image filename to read
+        pred_traj_fake_abs: Torch.tensor -> pred_len x batch_size x 2 (x|y) or batch_size x num_modes x
+                            pred_len x 2 (multimodal) in absolute coordinates (around 0,0)
+        pred_traj_gt_abs: Torch.tensor -> pred_len x batch_size x 2 (x|y) in absolute coordinates
+        map_origin: Torch.tensor -> batch_size x 1 x 2, global coordinates of the origin of each sequence
+        city_ids: city of each sequence (dataset_utils.CITY_NAME_CODES). If not specified, the city of a 
+                  sequence is the one whose drivable area contains more groundtruth points
+        num_seq, absolute_root_folder, split, dist_rasterized_map: not used (the rasters cover the 
+                  whole city, so no per-sequence image is read)
+        mode: average (mean of the batch), sum or raw (one value per sequence)
     Output:
-        feasible_area_loss: min = 0 (num_points · 1), max = pred_len (num_points · 1)
+        feasible_area_loss: scalar or batch_size (raw), min = 0, max = pred_len per sequence (average 
+                            of the modes if multimodal)
     """
 
-    feasible_area_loss = torch.zeros((pred_traj_fake_abs.shape[1]))
-    feasible_area_loss_v2 = torch.zeros((pred_traj_fake_abs.shape[1]))
-
-    pred_len = pred_traj_fake_abs.shape[0]
-    img_resize = 600
-    real_world_offset = abs(dist_rasterized_map[0])
-
-    # Iterate over the different sequences and predictions
-
-    for t,seq in enumerate(num_seq):
-        _seq = seq.item()
-        filename = os.path.join(absolute_root_folder,split,"data_images",f"{_seq}.png")
-
-        img_map = cv2.imread(filename)
-        img_map = cv2.resize(img_map, dsize=(img_resize,img_resize))
-        img_map_gray = cv2.cvtColor(img_map,cv2.COLOR_BGR2GRAY)
-
-        xcenter, ycenter = map_origin[t][0][0], map_origin[t][0][1]
-        x_min = xcenter + dist_rasterized_map[0]
-        x_max = xcenter + dist_rasterized_map[1]
-        y_min = ycenter + dist_rasterized_map[2]
-        y_max = ycenter + dist_rasterized_map[3]
-
-        ## Compute slope and intercept to transform global point to pixel
+    batch_size = map_origin.shape[0]
+    origin = map_origin.detach().cpu().numpy().reshape(batch_size,1,2)
 
-        m_x = float(img_resize / (2 * real_world_offset)) # slope
-        m_y = float(-img_resize / (2 * real_world_offset))
+    pred = pred_traj_fake_abs.detach().cpu().numpy()
+    num_modes = pred.shape[1] if pred.ndim == 4 else 1
+    pred = pred.reshape(batch_size,-1,2) if pred.ndim == 4 else pred.transpose(1,0,2)
+    pred = pred + origin # batch_size x (num_modes · pred_len) x 2, global coordinates
 
-        i_x = float(-(img_resize / (2 * real_world_offset)) * x_min) # intercept
-        i_y = float((img_resize / (2 * real_world_offset)) * y_max)
+    city_names = sorted(dataset_utils.CITY_NAME_CODES, key=dataset_utils.CITY_NAME_CODES.get)
+    drivable_areas = [map_functions.get_drivable_area_raster(city_name) for city_name in city_names]
 
-        _feasible_area_loss = []
-        _feasible_area_loss_v2 = []
-
-        for i in range(pred_len):
-            # TODO: Check map tensors in new .npy save
-            pix_x = int((pred_traj_fake_abs[i,t,0]+map_origin[t][0][0]) * m_x + i_x)
-            pix_y = int((pred_traj_fake_abs[i,t,1]+map_origin[t][0][1]) * m_y + i_y)
-
-            gt_pix_x = int((pred_traj_gt_abs[i,t,0]+map_origin[t][0][0]) * m_x + i_x)
-            gt_pix_y = int((pred_traj_gt_abs[i,t,1]+map_origin[t][0][1]) * m_y + i_y)
-
-            # Out of the image (we assume the physical context is big enough to capture the whole prediction)
-
-            if pix_y > img_resize-1 or pix_y < 0 or pix_x > img_resize-1 or pix_x < 0: 
-                _feasible_area_loss.append(0)
-                _feasible_area_loss_v2.append(0)
-            else:    
-                if img_map_gray[pix_y,pix_x] == 255.0: _feasible_area_loss.append(1)
-                else: _feasible_area_loss.append(0)
-                if img_map_gray[pix_y,pix_x] == img_map_gray[gt_pix_y,gt_pix_x]: 
-                    _feasible_area_loss_v2.append(1)
-                else:
-                    _feasible_area_loss_v2.append(0)
-
-        feasible_area_loss[t] = sum(_feasible_area_loss)
-        feasible_area_loss_v2[t] = sum(_feasible_area_loss_v2)
-
-    feasible_area_loss_v2 = feasible_area_loss_v2.mean()
-    #pdb.set_trace()
-    return feasible_area_loss
+    if city_ids is None:
+        gt = pred_traj_gt_abs.detach().cpu().numpy().transpose(1,0,2) + origin
+        city_ids = np.argmax(np.stack([drivable_area.is_drivable(gt).sum(axis=1) 
+                                       for drivable_area in drivable_areas]), axis=0)
+    else:
+        city_ids = np.asarray(city_ids.cpu() if torch.is_tensor(city_ids) else city_ids).reshape(-1).round().astype(np.int64)
+
+    # All the points of the sequences of each city at once
+
+    feasible_area_loss = np.zeros(batch_size)
+    for city_id, drivable_area in enumerate(drivable_areas):
+        city_seqs = np.flatnonzero(city_ids == city_id)
+        if len(city_seqs) > 0:
+            feasible_area_loss[city_seqs] = drivable_area.is_drivable(pred[city_seqs]).sum(axis=1) / num_modes
+
+    feasible_area_loss = torch.from_numpy(feasible_area_loss).type(torch.float).to(pred_traj_fake_abs.device)
+    if mode == "sum":
+        return torch.sum(feasible_area_loss)
+    elif mode == "average":
+        return torch.mean(feasible_area_loss)
+    elif mode == "raw":
+        return feasible_area_loss
 
 # SoftDWT
 
@@ -16,7 +16,7 @@ from torch.utils.data import DataLoader
 import torch.optim.lr_scheduler as lrs
 from torch.cuda.amp import GradScaler, autocast 
 
-from model.datasets.argoverse.dataset import ArgoverseMotionForecastingDataset, seq_collate
+from model.datasets.argoverse.dataset import ArgoverseMotionForecastingDataset, ArgoverseBatchSampler, seq_collate
 from model.models.mp_so import TrajectoryGenerator, TrajectoryDiscriminator
 # from model.models.social_lstm_mhsa import TrajectoryGenerator, TrajectoryDiscriminator
 from model.modules.losses import gan_g_loss, l2_loss, gan_g_loss_bce, pytorch_neg_multi_log_likelihood_batch, mse_custom, \
@@ -120,9 +120,11 @@ def model_trainer(config, logger):
                                                    class_balance=config.dataset.class_balance,
                                                    obs_origin=config.hyperparameters.obs_origin)
 
+    train_sampler = ArgoverseBatchSampler(data_train, batch_size=config.dataset.batch_size,
+                                          shuffle=config.dataset.shuffle) # Class balance / hard mining
     train_loader = DataLoader(data_train,
-                              batch_size=config.dataset.batch_size,
-                              shuffle=config.dataset.shuffle,
+                              sampler=train_sampler,
+                              batch_size=None, # Whole batch gathered by the dataset
                               num_workers=config.dataset.num_workers,
                               collate_fn=seq_collate)
 
@@ -136,9 +138,11 @@ def model_trainer(config, logger):
                                                  split_percentage=config.dataset.split_percentage,
                                                  class_balance=-1.0,
                                                  obs_origin=config.hyperparameters.obs_origin)
+    val_sampler = ArgoverseBatchSampler(data_val, batch_size=config.dataset.batch_size,
+                                        shuffle=config.dataset.shuffle)
     val_loader = DataLoader(data_val,
-                            batch_size=config.dataset.batch_size,
-                            shuffle=config.dataset.shuffle,
+                            sampler=val_sampler,
+                            batch_size=None, # Whole batch gathered by the dataset
                             num_workers=config.dataset.num_workers,
                             collate_fn=seq_collate)
 
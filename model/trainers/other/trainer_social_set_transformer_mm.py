@@ -29,7 +29,7 @@ from torch.utils.tensorboard import SummaryWriter
 
 # Custom imports
 
-from model.datasets.argoverse.dataset import ArgoverseMotionForecastingDataset, seq_collate
+from model.datasets.argoverse.dataset import ArgoverseMotionForecastingDataset, ArgoverseBatchSampler, seq_collate
 from model.models.social_set_transformer_mm import TrajectoryGenerator
 from model.modules.losses import l2_loss_multimodal, mse_custom, pytorch_neg_multi_log_likelihood_batch, evaluate_feasible_area_prediction
 from model.modules.evaluation_metrics import displacement_error, final_displacement_error
@@ -217,9 +217,11 @@ def model_trainer(config, logger):
                                                    preprocess_data=config.dataset.preprocess_data,
                                                    save_data=config.dataset.save_data)
 
+    train_sampler = ArgoverseBatchSampler(data_train, batch_size=config.dataset.batch_size,
+                                          shuffle=config.dataset.shuffle) # Class balance / hard mining
     train_loader = DataLoader(data_train,
-                              batch_size=config.dataset.batch_size,
-                              shuffle=config.dataset.shuffle,
+                              sampler=train_sampler,
+                              batch_size=None, # Whole batch gathered by the dataset
                               num_workers=config.dataset.num_workers,
                               collate_fn=seq_collate)
 
@@ -238,9 +240,11 @@ def model_trainer(config, logger):
                                                  preprocess_data=config.dataset.preprocess_data,
                                                  save_data=config.dataset.save_data)
 
+    val_sampler = ArgoverseBatchSampler(data_val, batch_size=config.dataset.batch_size,
+                                        shuffle=False)
     val_loader = DataLoader(data_val,
-                            batch_size=config.dataset.batch_size,
-                            shuffle=False,
+                            sampler=val_sampler,
+                            batch_size=None, # Whole batch gathered by the dataset
                             num_workers=config.dataset.num_workers,
                             collate_fn=seq_collate)
 
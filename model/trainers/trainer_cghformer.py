@@ -31,7 +31,9 @@ from torch.utils.tensorboard import SummaryWriter
 
 # Custom imports
 
-from model.datasets.argoverse.dataset import ArgoverseMotionForecastingDataset, seq_collate
+from model.datasets.argoverse.dataset import ArgoverseMotionForecastingDataset, ArgoverseBatchSampler, seq_collate, \
+                                            get_augmentation_parameters, ROTATABLE_PHYSICAL_CONTEXTS
+from model.datasets.argoverse.data_augmentation_functions import augment_trajectories
 from model.models.cghformer import TrajectoryGenerator
 from model.modules.losses import l2_loss_multimodal, mse, pytorch_neg_multi_log_likelihood_batch, \
                                  evaluate_feasible_area_prediction, smoothL1, l1_ewta_loss, l1_wta_loss, SoftDTW
@@ -51,7 +53,9 @@ torch.backends.cudnn.benchmark = True
 torch.set_float32_matmul_precision("medium")
 
 current_cuda = None
+augmentation_parameters = None # Data augmentation in the training device (augmentation_on_device)
 absolute_root_folder = None
+split_datasets = dict() # split -> dataset (e.g. city of the sequences of a batch)
 
 CHECK_ACCURACY_TRAIN = False
 CHECK_ACCURACY_VAL = True
@@ -577,6 +581,12 @@ def model_trainer(config, logger):
 
     global current_cuda
     current_cuda = torch.device(f"cuda:{config.device_gpu}")
+
+    global augmentation_parameters
+    if config.dataset.data_augmentation and config.dataset.augmentation_on_device:
+        augmentation_parameters = get_augmentation_parameters(config.dataset.apply_rotation,
+                                                              config.hyperparameters.physical_context)
+
     device = torch.device(current_cuda if torch.cuda.is_available() else "cpu")
     
     long_dtype, float_dtype = get_dtypes(config.use_gpu)
@@ -608,11 +618,24 @@ def model_trainer(config, logger):
                                                    extra_data_train=config.dataset.extra_data_train,
                                                    hard_mining=config.dataset.hard_mining,
                                                    preprocess_data=config.dataset.preprocess_data,
+                                                   preprocess_workers=config.dataset.preprocess_workers,
+                                                   raw_data_cache=config.dataset.raw_data_cache,
+                                                   trajectory_classifier=config.dataset.trajectory_classifier,
+                                                   memory_mapping=config.dataset.memory_mapping,
+                                                   data_container=config.dataset.data_container,
+                                                   incremental_preprocessing=config.dataset.incremental_preprocessing,
+                                                   rotated_data=config.dataset.rotated_data,
+                                                   augmentation_on_device=config.dataset.augmentation_on_device,
+                                                   physical_context_cache=config.dataset.physical_context_cache,
                                                    save_data=config.dataset.save_data)
 
+    train_sampler = ArgoverseBatchSampler(data_train,
+                                          batch_size=config.dataset.batch_size,
+                                          shuffle=config.dataset.shuffle) # Class balance / hard mining
+
     train_loader = DataLoader(data_train,
-                              batch_size=config.dataset.batch_size,
-                              shuffle=config.dataset.shuffle,
+                              sampler=train_sampler,
+                              batch_size=None, # Whole batch gathered by the dataset
                               num_workers=config.dataset.num_workers,
                               collate_fn=seq_collate)
 
@@ -633,11 +656,24 @@ def model_trainer(config, logger):
                                                  physical_context=config.hyperparameters.physical_context,
                                                  extra_data_train=config.dataset.extra_data_train,
                                                  preprocess_data=config.dataset.preprocess_data,
+                                                 preprocess_workers=config.dataset.preprocess_workers,
+                                                 raw_data_cache=config.dataset.raw_data_cache,
+                                                 trajectory_classifier=config.dataset.trajectory_classifier,
+                                                 memory_mapping=config.dataset.memory_mapping,
+                                                 data_container=config.dataset.data_container,
+                                                 incremental_preprocessing=config.dataset.incremental_preprocessing,
+                                                 rotated_data=config.dataset.rotated_data,
+                                                 physical_context_cache=config.dataset.physical_context_cache,
                                                  save_data=config.dataset.save_data)
                               
+    global split_datasets
+    split_datasets = dict(train=data_train, val=data_val)
+
+    val_sampler = ArgoverseBatchSampler(data_val, batch_size=config.dataset.batch_size,
+                                        shuffle=False)
     val_loader = DataLoader(data_val,
-                            batch_size=config.dataset.batch_size,
-                            shuffle=False,
+                            sampler=val_sampler,
+                            batch_size=None, # Whole batch gathered by the dataset
                             num_workers=config.dataset.num_workers,
                             collate_fn=seq_collate)
 
@@ -1135,6 +1171,16 @@ def generator_step(hyperparameters, batch, generator, optimizer_g,
     
     batch_size = seq_start_end.shape[0]
 
+    # Data augmentation in the training device (instead of seq_collate)
+
+    if augmentation_parameters is not None and split == "train":
+        rotate_phy_info = hyperparameters.physical_context in ROTATABLE_PHYSICAL_CONTEXTS
+        obs_traj, obs_traj_rel, pred_traj_gt, pred_traj_gt_rel, aug_relevant_centerlines = \
+            augment_trajectories(obs_traj, pred_traj_gt, seq_start_end,
+                                 phy_info=relevant_centerlines if rotate_phy_info else None,
+                                 **augmentation_parameters)
+        if rotate_phy_info: relevant_centerlines = aug_relevant_centerlines
+
     # Take (if specified) data of only the AGENT of interest
 
     agent_idx = None
@@ -1208,7 +1254,8 @@ def generator_step(hyperparameters, batch, generator, optimizer_g,
     elif hyperparameters.loss_type_g == "mse+fa" or hyperparameters.loss_type_g == "mse_w+fa":
         loss_ade, loss_fde = calculate_mse_gt_loss_multimodal(pred_traj_gt, pred_traj_fake, loss_f["mse"])
         loss_fa = evaluate_feasible_area_prediction(pred_traj_fake, pred_traj_gt, map_origin, num_seq, 
-                                                    absolute_root_folder, split)
+                                                    absolute_root_folder, split, 
+                                                    city_ids=split_datasets[split].get_city_ids(num_seq))
 
         loss = hyperparameters.loss_ade_weight*loss_ade + \
                 hyperparameters.loss_fde_weight*loss_fde + \
@@ -17,6 +17,7 @@ import pdb
 import sys
 import os
 import time
+import functools
 
 # DL & Math imports
 
@@ -32,42 +33,15 @@ BASE_DIR = "/home/denso/carlos_vsr_workspace/mapfe4mp"
 sys.path.append(BASE_DIR)
 
 from model.datasets.argoverse.dataset_utils import read_file, \
-                                                   load_list_from_folder
+                                                   load_list_from_folder, \
+                                                   get_origin_and_city, \
+                                                   PreprocessingJob
                                                    
 import model.datasets.argoverse.map_functions as map_functions
-from argoverse.map_representation.map_api import ArgoverseMap
 
 #######################################
 
-avm = ArgoverseMap()
-
-def get_origin_and_city(seq,obs_window):
-    """
-    """
-
-    frames = np.unique(data[:, 0]).tolist() 
-    frame_data = []
-    for frame in frames:
-        frame_data.append(data[frame == data[:, 0], :]) # save info for each frame
-
-    obs_frame = frame_data[obs_window-1]
-
-    # Get origin
-
-    try:
-        origin = obs_frame[obs_frame[:,2] == 1][:,3:5].reshape(-1) # Get x|y of the AGENT (object_class = 1) in the obs window
-    except:
-        pdb.set_trace()
-    
-    # Get city
-
-    city_id = round(obs_frame[0,-1])
-    if city_id == 0:
-        city_name = "PIT"
-    else:
-        city_name = "MIA"
-
-    return origin, city_name
+avm = map_functions.get_argoverse_map() # Memory-mapped (built the first time)
 
 # Load config
 
@@ -94,6 +68,7 @@ config.dataset.data_augmentation = False
 config.hyperparameters.pred_len = 30 # In test, we do not have the gt (prediction points)
 
 dist_around = 75
+num_workers = 1 # > 1 -> pool of processes
 dist_rasterized_map = [-dist_around, dist_around, -dist_around, dist_around]
 
 # data_images_folder = BASE_DIR + "/" + config.dataset.path + config.dataset.split + "/data_images"
@@ -124,19 +99,16 @@ if (start_from + n_files) >= num_files:
 else:
     file_id_list = file_id_list[start_from:start_from+n_files]
 
-time_per_iteration = float(0)
-aux_time = float(0)
+def generate_sequence_map(index, file_id, root_file_name):
+    """
+    Generate the BEV image of the lanes around the AGENT (last observation) of a sequence
+    """
 
-for i, file_id in enumerate(file_id_list):
-    print(f"File {file_id} -> {i+1}/{len(file_id_list)}")
-    files_remaining = len(file_id_list) - (i+1)
     path = os.path.join(root_file_name,str(file_id)+".csv")
     data = read_file(path) 
 
-    origin_pos, city_name = get_origin_and_city(data,config.hyperparameters.obs_origin)
-    origin_pos = origin_pos.tolist() # np.array -> list
+    origin_pos, city_name = get_origin_and_city(data,obs_window)
 
-    start = time.time()
     map_functions.map_generator(file_id,
                                 origin_pos,
                                 dist_rasterized_map,
@@ -145,11 +117,15 @@ for i, file_id in enumerate(file_id_list):
                                 centerlines_colour="red",
                                 show=False,
                                 root_folder=data_images_folder)
-    end = time.time()
-    aux_time += (end-start)
-    time_per_iteration = aux_time/(i+1)
 
-    print(f"Time per iteration: {time_per_iteration} s. \n \
-            Estimated time to finish ({files_remaining} files): {round(time_per_iteration*files_remaining/60)} min")
+# Resumable job (checkpoints in job_folder). The sequences that raise an exception are quarantined
+
+job_folder = data_images_folder + "_job"
+job = PreprocessingJob(job_folder, file_id_list, 
+                       functools.partial(generate_sequence_map, root_file_name=root_file_name),
+                       params=dict(dist_rasterized_map=dist_rasterized_map), 
+                       num_workers=num_workers)
+_, quarantine = job.run()
 
-    plt.close("all")
\ No newline at end of file
+print("Quarantined sequences: ", [file_id for file_id, _ in quarantine])
+job.cleanup()
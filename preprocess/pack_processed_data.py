@@ -0,0 +1,78 @@
+#!/usr/bin/env python3.8
+# -*- coding: utf-8 -*-
+
+## Pack an existing processed split (folder of .npy files) into a single .h5 container,
+## choosing the centerlines variant (no need to copy the variant as relevant_centerlines.npy)
+
+"""
+Created on Fri Oct 16 12:40:05 2026
+@author: Carlos Gómez-Huélamo
+"""
+
+# General purpose imports
+
+import sys
+import os
+import git
+
+# DL & Math
+
+import numpy as np
+
+# Custom imports
+
+repo = git.Repo('.', search_parent_directories=True)
+BASE_DIR = repo.working_tree_dir
+sys.path.append(BASE_DIR)
+
+from model.datasets.argoverse.dataset_utils import load_processed_files_from_npy, save_processed_data_as_h5, \
+                                                   load_processed_data_from_h5
+
+#######################################
+
+dataset_path = "data/datasets/argoverse/motion-forecasting/"
+splits_to_pack = dict({"train":[True,1.0], # Split, Pack, Split percentage
+                       "val":  [True,1.0],
+                       "test": [False,1.0]})
+
+# Centerlines variant (see preprocess_data.py)
+
+algorithm = "map_api"
+first_centerline_waypoint = "first_obs" # first_obs, last_obs
+max_points = 40 # 40 (first_obs), 30 (last_obs)
+distance_method = "CTRA"
+filter = "least_squares"
+variant = f"{algorithm}_{first_centerline_waypoint}_{str(max_points)}_{distance_method}_{filter}_points"
+
+compression = "lzf" # None, "lzf", "gzip"
+
+social_variables_names = ['seq_list','seq_list_rel','loss_mask_list','non_linear_obj',
+                          'num_objs_in_seq','seq_id_list','object_class_id_list',
+                          'object_id_list','ego_vehicle_origin','num_seq_list',
+                          'straight_trajectories_list','curved_trajectories_list','city_id',
+                          'norm','target_agent_orientation']
+
+for split_name,features in splits_to_pack.items():
+    if features[0]:
+        data_processed_folder = os.path.join(BASE_DIR,dataset_path,split_name,
+                                             f"data_processed_{str(int(features[1]*100))}_percent")
+        filename = data_processed_folder + ".h5"
+        print(f"Packing {data_processed_folder} -> {filename} ...")
+
+        processed_data_dict = load_processed_files_from_npy(data_processed_folder, social_variables_names)
+        processed_data_dict["oracle_centerlines"] = np.load(os.path.join(data_processed_folder,
+                                                                         f"oracle_centerlines_{variant}.npy"))
+        processed_data_dict["relevant_centerlines"] = np.load(os.path.join(data_processed_folder,
+                                                                           f"relevant_centerlines_{variant}.npy"))
+
+        params = dict(split=split_name, split_percentage=features[1],
+                      centerlines=dict(algorithm=algorithm,
+                                       first_centerline_waypoint=first_centerline_waypoint,
+                                       max_points=max_points,
+                                       distance_method=distance_method,
+                                       filter=filter))
+        save_processed_data_as_h5(filename, processed_data_dict, params=params, mode="w", compression=compression)
+
+        # Check the container (schema, checksums and number of sequences/objects of each column)
+
+        load_processed_data_from_h5(filename, list(processed_data_dict.keys()))
@@ -17,7 +17,8 @@ import time
 import os
 import git
 import pdb
-import copy
+import math
+import functools
 
 from prodict import Prodict
 
@@ -27,30 +28,23 @@ import pandas as pd
 import numpy as np
 import cv2
 
-from sklearn.metrics.pairwise import euclidean_distances
-
-# Plot imports
-
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
-
 # Custom imports
 
 from argoverse.data_loading.argoverse_forecasting_loader import ArgoverseForecastingLoader
-from argoverse.utils.mpl_plotting_utils import visualize_centerline
-from argoverse.map_representation.map_api import ArgoverseMap
-from argoverse.utils.centerline_utils import centerline_to_polygon
-
-avm = ArgoverseMap()
 
 repo = git.Repo('.', search_parent_directories=True)
 BASE_DIR = repo.working_tree_dir
 sys.path.append(BASE_DIR)
 
-from model.datasets.argoverse.map_functions import MapFeaturesUtils
+import model.datasets.argoverse.raster_functions as raster_functions
+import model.datasets.argoverse.kinematic_functions as kinematic_functions
+import model.datasets.argoverse.geometric_functions as geometric_functions
+
+from model.datasets.argoverse.map_functions import MapFeaturesUtils, get_argoverse_map
 from model.datasets.argoverse.dataset import ArgoverseMotionForecastingDataset
-from model.datasets.argoverse.dataset_utils import load_list_from_folder, get_origin_and_city, read_file
+from model.datasets.argoverse.dataset_utils import load_list_from_folder, get_origin_and_city, read_file, read_agent_track, \
+                                                   save_processed_data_as_h5, load_processed_data_from_h5, \
+                                                   replace_sequence_rows_h5, PreprocessingJob, save_npy
 
 #######################################
 
@@ -99,7 +93,6 @@ distance_method = "CTRA" # CTRV, CTRA
 
 viz = False
 limit_qualitative_results = 150
-check_every = 0.1 # % of total files
 
 RAW_DATA_FORMAT = {
     "TIMESTAMP": 0,
@@ -111,13 +104,318 @@ RAW_DATA_FORMAT = {
 }
 
 map_features_utils_instance = MapFeaturesUtils()
-avm = ArgoverseMap()
+avm = get_argoverse_map() # Memory-mapped (built the first time)
 
 def find_nearest(array, value):
     array = np.asarray(array)
     idx = (np.abs(array - value)).argmin()
     return idx, array[idx]
 
+def get_centerline_segment(centerline, first_obs, last_obs, dist_around):
+    """
+    Reduce a candidate centerline to the waypoints from the closest one to the first (or last, 
+    see first_centerline_waypoint) observation to the closest one to the last observation + dist_around
+    (CTRV/CTRA during pred seconds). The centerline is inverted if it does not follow the direction of the
+    agent (this sometimes happens if the agent is carrying a lane change maneuver)
+    """
+
+    def get_closest_wps(centerline, first_wp_obs):
+        # Get index of the closest waypoint to the first observation
+
+        closest_wp_first, _ = map_features_utils_instance.get_closest_wp(first_wp_obs, centerline)
+
+        # Get index of the closest waypoint to the last observation + dist_around
+
+        closest_wp_last, dist_array_last = map_features_utils_instance.get_closest_wp(last_obs, centerline)
+        idx, _ = find_nearest(dist_array_last[closest_wp_last:],dist_around) # To determine dist around from this point
+
+        num_points = idx + (closest_wp_last - closest_wp_first)
+        if num_points < min_points:
+            num_points = min_points # you must have at least 4 points to conduct a cubic interpolation
+
+        return closest_wp_first, closest_wp_last, num_points
+
+    first_wp_obs = last_obs if first_centerline_waypoint == "last_obs" else first_obs
+    closest_wp_first, closest_wp_last, num_points = get_closest_wps(centerline, first_wp_obs)
+
+    # Determine if the centerline is inverted: The best and most interpretable solution is if the
+    # the end point is closer than the start point and the last observation is closer to the start
+    # rather than the first observation. Distance between consecutive waypoints (same as np.linalg.norm)
+
+    diff = centerline[1:,:] - centerline[:-1,:]
+    dist = np.sqrt(np.matmul(diff[:,None,:],diff[:,:,None]).reshape(-1))
+
+    invert = False
+
+    try:
+        dist_firstobs2start = np.cumsum(dist[:closest_wp_first+1])[-1]
+        dist_lastobs2start = np.cumsum(dist[:closest_wp_last+1])[-1]
+        dist_firstobs2end = np.cumsum(dist[closest_wp_first:])[-1]
+
+        if ((dist_lastobs2start >= dist_firstobs2start)
+        and ((closest_wp_first > 0 and closest_wp_first < centerline.shape[0])
+            or (dist_firstobs2start <= dist_firstobs2end))):
+            pass
+        else:
+            invert = True
+
+    except Exception as e:
+        invert = True
+
+    if invert: # Repeat again the process to obtain the closest wps (from the first observation)
+        centerline = centerline[::-1]
+        closest_wp_first, closest_wp_last, num_points = get_closest_wps(centerline, first_obs)
+
+    # Reduce the lane to the closest N points, starting from the first observation 
+    # (closest to current position) and ending in the closest wp assuming CTRA during pred seconds
+
+    if closest_wp_first+num_points+1 <= centerline.shape[0]:
+        centerline_filtered = centerline[closest_wp_first:closest_wp_first+num_points+1,:]
+    else: # If we have reached the end, travel backwards 
+        # TODO: Interpolate frontwards
+        back_num_points = (closest_wp_first+num_points+1) - centerline.shape[0]
+        centerline_filtered = centerline[closest_wp_first-back_num_points:,:]
+
+    return centerline_filtered
+
+def get_interpolated_centerline(centerline_filtered, centerline, agent_xy, split_name, file_id, viz=False):
+    """
+    Resample (arc length, cubic spline) the filtered centerline to max_points waypoints. Return None
+    if the interpolation fails
+    """
+
+    if centerline_filtered.shape[0] == max_points:
+        return centerline_filtered
+
+    try:
+        interpolated_centerline = map_features_utils_instance.interpolate_centerline(centerline_filtered,
+                                                                                     max_points=max_points,
+                                                                                     agent_xy=agent_xy,
+                                                                                     obs_len=obs_len,
+                                                                                     seq_len=obs_len+pred_len,
+                                                                                     split=split_name,
+                                                                                     seq_id=file_id,
+                                                                                     viz=viz)
+
+        assert interpolated_centerline.shape[0] == max_points
+    except:
+        # TODO: Take the closest max_points if the previous algorithm fails
+
+        map_features_utils_instance.debug_centerline_and_agent([centerline], agent_xy, obs_len, obs_len+pred_len, split_name, file_id)
+        return None
+
+    return interpolated_centerline
+
+def get_interpolated_centerlines(centerlines_filtered):
+    """
+    Resample all the filtered centerlines of a sequence (list of N_i x 2 arrays) to max_points waypoints
+    in a single call (geometric_functions.resample_polylines). The centerlines that already have max_points
+    waypoints are not modified. Return a list (None for the empty centerlines)
+    """
+
+    lengths = np.array([centerline.shape[0] for centerline in centerlines_filtered])
+    to_resample = np.flatnonzero((lengths > 0) & (lengths != max_points))
+
+    interpolated_centerlines = [centerline if length == max_points else None 
+                                for centerline, length in zip(centerlines_filtered, lengths)]
+    if len(to_resample) == 0:
+        return interpolated_centerlines
+
+    padded_centerlines = np.zeros((len(to_resample),lengths[to_resample].max(),2))
+    for i, index_centerline in enumerate(to_resample):
+        padded_centerlines[i,:lengths[index_centerline]] = centerlines_filtered[index_centerline][:,:2]
+
+    resampled_centerlines = geometric_functions.resample_polylines(padded_centerlines, lengths[to_resample],
+                                                                   num_points=max_points, mode="spline")
+    for i, index_centerline in enumerate(to_resample):
+        interpolated_centerlines[index_centerline] = resampled_centerlines[i]
+
+    return interpolated_centerlines
+
+def save_plausible_area(relevant_centerlines_filtered, agent_xy, lane_dir_vector, file_id, output_dir):
+    """
+    Save the BEV images (gray and color) of the plausible area (relevant centerlines) of the sequence.
+    The lane polygons are rasterized directly (no matplotlib figure), the extent of the images is the
+    bbox of the lane polygons
+    """
+
+    # Paint centerlines
+
+    img_bgr, extent = raster_functions.rasterize_lanes(relevant_centerlines_filtered, img_size=raster_functions.IMG_SIZE,
+                                                       channels=3, lane_colour="white", centerlines_colour="gray")
+
+    filename = os.path.join(output_dir,f"{file_id}_binary_plausible_area_filtered_gray.png")
+    img_gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    cv2.imwrite(filename, img_gray)
+
+    if HIGHLIGHT_ORACLE:
+        img_bgr, _ = raster_functions.rasterize_lanes(relevant_centerlines_filtered, extent=extent, canvas=img_bgr,
+                                                      lane_colour="white", centerlines_colour="gray",
+                                                      highlight_first_lane="green")
+
+    # Paint agent's orientation and trajectory
+
+    raster_functions.rasterize_agent(img_bgr, agent_xy, extent, obs_len, lane_dir_vector=lane_dir_vector)
+
+    filename = os.path.join(output_dir,f"{file_id}_binary_plausible_area_filtered_color.png")
+    cv2.imwrite(filename, img_bgr)
+
+def get_sequence_centerlines(index, file_id, root_file_name, split_name, output_dir):
+    """
+    Physical information of a sequence: orientation of the target agent in the last observation,
+    relevant centerlines (mode "test", max_centerlines x max_points x 2, padded with zeros) and
+    oracle centerline (max_points x 2, None if it could not be computed). index (position of the 
+    sequence in the split) determines if the qualitative results are plotted
+    """
+
+    seq_viz = viz and (limit_qualitative_results == -1 or index+1 <= limit_qualitative_results)
+    seq_path = os.path.join(root_file_name,str(file_id)+".csv")
+
+    # Get social and map features for the agent
+
+    agent_track = read_agent_track(seq_path)
+    agent_xy = agent_track[:,[RAW_DATA_FORMAT["X"],RAW_DATA_FORMAT["Y"]]].astype("float")
+    first_obs = agent_xy[0,:]
+    last_obs = agent_xy[obs_origin-1,:]
+
+    # Filter agent's trajectory (smooth) and estimate its kinematics in the last observation
+
+    kinematic_features = kinematic_functions.get_kinematic_features(agent_xy[np.newaxis,:obs_len,:], obs_len=obs_len, 
+                                                                    filter=filter)
+    vel, acc = kinematic_features["vel"][0], kinematic_features["acc"][0]
+                                                                                        
+    if distance_method == "CTRV":
+        dist_around = vel * (pred_len/freq)
+    elif distance_method == "CTRA":
+        dist_around = vel * (pred_len/freq) + 1/2 * acc * (pred_len/freq)**2
+
+    if dist_around < min_dist_around:
+        dist_around = min_dist_around
+
+    # Compute agent's orientation
+
+    lane_dir_vector, yaw = kinematic_features["lane_dir_vector"][0], kinematic_features["yaw"][0]
+
+    sequence_data = dict(target_agent_orientation=yaw, relevant_centerlines=None, 
+                         oracle_centerline=None, wrong_centerlines=[],
+                         kinematic_features=kinematic_functions.get_kinematic_features_row(kinematic_features))
+
+    for mode in modes_centerlines:
+        # Map features extraction
+
+        map_features, map_feature_helpers = map_features_utils_instance.compute_map_features(
+                agent_track,
+                file_id,
+                split_name,
+                obs_len,
+                obs_len + pred_len,
+                RAW_DATA_FORMAT,
+                mode,
+                avm,
+                seq_viz,
+                max_candidates=max_centerlines,
+                algorithm=algorithm
+            )
+
+        if mode == "test": # preprocess N plausible centerlines
+            relevant_centerlines_filtered = []
+
+            candidate_centerlines = map_feature_helpers["CANDIDATE_CENTERLINES"]
+            candidate_centerlines_filtered = [get_centerline_segment(relevant_centerline, first_obs, last_obs, dist_around)
+                                              for relevant_centerline in candidate_centerlines]
+
+            if seq_viz: # Plot each interpolated centerline
+                candidate_centerlines_filtered = [get_interpolated_centerline(relevant_centerline_filtered, relevant_centerline,
+                                                                              agent_xy, split_name, file_id, viz=seq_viz)
+                                                  for relevant_centerline_filtered, relevant_centerline 
+                                                  in zip(candidate_centerlines_filtered, candidate_centerlines)]
+            else:
+                candidate_centerlines_filtered = get_interpolated_centerlines(candidate_centerlines_filtered)
+
+            for index_centerline, relevant_centerline_filtered in enumerate(candidate_centerlines_filtered):
+                if relevant_centerline_filtered is None:
+                    sequence_data["wrong_centerlines"].append(file_id)
+                    continue
+
+                relevant_centerlines_filtered.append(relevant_centerline_filtered)
+
+                if index_centerline == 0 and algorithm == "map_api": 
+                    # The first centerline also corresponds to the oracle using map_api
+
+                    sequence_data["oracle_centerline"] = relevant_centerline_filtered
+
+            # Determine if there are some repeated centerlines after filtering. Take the unique
+            # elements. If after this there are less than max_centerlines, pad with zeros
+
+            aux_array = np.array(relevant_centerlines_filtered)
+            vals, idx_start, count = np.unique(aux_array, axis=0, return_counts=True, return_index=True)
+            relevant_centerlines_filtered_aux = aux_array[np.sort(idx_start),:,:]
+            
+            pad_zeros_centerlines = np.zeros((max_centerlines-relevant_centerlines_filtered_aux.shape[0],max_points,data_dim))
+            relevant_centerlines_filtered = np.vstack((relevant_centerlines_filtered_aux,pad_zeros_centerlines))
+
+            sequence_data["relevant_centerlines"] = relevant_centerlines_filtered
+
+            if SAVE_BEV_PLAUSIBLE_AREA:
+                save_plausible_area(relevant_centerlines_filtered, agent_xy, lane_dir_vector, file_id, output_dir)
+
+        elif mode == "train": # only best centerline ("oracle")
+            oracle_centerline = map_feature_helpers["ORACLE_CENTERLINE"]
+            oracle_centerline_filtered = get_centerline_segment(oracle_centerline, first_obs, last_obs, dist_around)
+            oracle_centerline_filtered = get_interpolated_centerline(oracle_centerline_filtered, oracle_centerline,
+                                                                     agent_xy, split_name, file_id, 
+                                                                     viz=seq_viz)
+            if oracle_centerline_filtered is None:
+                sequence_data["wrong_centerlines"].append(file_id)
+            else:
+                sequence_data["oracle_centerline"] = oracle_centerline_filtered
+
+    return sequence_data
+
+def get_sequence_physical_rows(index, file_id, root_file_name, split_name, output_dir):
+    """
+    Rows of the physical information (see get_sequence_centerlines) of a sequence to be written by
+    the preprocessing job: target_agent_orientation, relevant_centerlines, oracle_centerlines (only
+    if it could be computed), wrong_centerlines (file ids) and the kinematic features table 
+    (kinematic_file_ids, kinematic_features)
+    """
+
+    sequence_data = get_sequence_centerlines(index, file_id, root_file_name, split_name, output_dir)
+
+    rows = dict(target_agent_orientation=[sequence_data["target_agent_orientation"]],
+                physical_data_valid=[1],
+                wrong_centerlines=sequence_data["wrong_centerlines"],
+                kinematic_file_ids=[file_id],
+                kinematic_features=sequence_data["kinematic_features"][np.newaxis])
+    if sequence_data["relevant_centerlines"] is not None:
+        rows["relevant_centerlines"] = sequence_data["relevant_centerlines"]
+    if sequence_data["oracle_centerline"] is not None:
+        rows["oracle_centerlines"] = sequence_data["oracle_centerline"]
+
+    return rows
+
+def get_sequence_placeholder_rows(index, file_id):
+    """
+    Rows of a quarantined sequence (zeros, physical_data_valid = 0), so the outputs keep one row per
+    sequence (the dataset reads them by position). It is not added to the kinematic features table
+    """
+
+    rows = dict(target_agent_orientation=[0.0],
+                physical_data_valid=[0],
+                oracle_centerlines=np.zeros((1,max_points,data_dim)))
+    if "test" in modes_centerlines:
+        rows["relevant_centerlines"] = np.zeros((1,max_centerlines,max_points,data_dim))
+
+    return rows
+
+PHYSICAL_OUTPUTS = dict(target_agent_orientation=(np.float64,()),
+                        physical_data_valid=(np.int8,()),
+                        relevant_centerlines=(np.float64,(max_centerlines,max_points,data_dim)),
+                        oracle_centerlines=(np.float64,(max_points,data_dim)),
+                        wrong_centerlines=(np.int64,()),
+                        kinematic_file_ids=(np.int64,()),
+                        kinematic_features=(np.float64,(len(kinematic_functions.KINEMATIC_FEATURES),)))
+
 for split_name,features in splits_to_process.items():
     if features[0]:
         # Agents trajectories
@@ -135,13 +433,17 @@ for split_name,features in splits_to_process.items():
                                               class_balance=config.dataset.class_balance,
                                               obs_origin=config.hyperparameters.obs_origin,
                                               preprocess_data=True,
+                                              preprocess_workers=config.dataset.preprocess_workers,
+                                              raw_data_cache=config.dataset.raw_data_cache,
+                                              trajectory_classifier=config.dataset.trajectory_classifier,
+                                              data_container=config.dataset.data_container,
+                                              incremental_preprocessing=config.dataset.incremental_preprocessing,
                                               save_data=True)    
 
         # Most relevant lanes around the target agent
 
         if PREPROCESS_RELEVANT_CENTERLINES:
             print(f"Analyzing physical information of {split_name} split ...")
-            wrong_centerlines = []
 
             folder = os.path.join(BASE_DIR,config.dataset.path,split_name,"data")
             files, num_files = load_list_from_folder(folder)
@@ -174,15 +476,17 @@ for split_name,features in splits_to_process.items():
 
             ##############################################################################
 
-            check_every_n_files = int(len(file_id_list)*check_every)
-            print(f"Check remaining time every {check_every_n_files} files")
-            time_per_iteration = float(0)
-            aux_time = float(0)
-            
-            map_info = dict()
-            oracle_centerlines_list = []
-            relevant_centerlines_list = []
-            target_agent_orientation_list = []
+            # Incremental preprocessing: only the sequences of the container whose physical information 
+            # has not been computed yet (new or modified .csvs)
+
+            container_filename = os.path.join(BASE_DIR,config.dataset.path,split_name,
+                                              f"data_processed_{str(int(features[1]*100))}_percent.h5")
+
+            if config.dataset.incremental_preprocessing:
+                container_data = load_processed_data_from_h5(container_filename, ["num_seq_list","physical_data_valid"])
+                sequence_index = np.where(container_data["physical_data_valid"] == 0)[0]
+                file_id_list = container_data["num_seq_list"][sequence_index].tolist()
+                print("Incremental preprocessing. Num files to analyze: ", len(file_id_list))
 
             output_dir = os.path.join(BASE_DIR,f"data/datasets/argoverse/motion-forecasting/{split_name}/map_features")
 
@@ -190,511 +494,46 @@ for split_name,features in splits_to_process.items():
                 print("Create trajs folder: ", output_dir)
                 os.makedirs(output_dir) # makedirs creates intermediate folders
 
-            for i, file_id in enumerate(file_id_list):
-                # print(f"File {file_id} -> {i+1}/{len(file_id_list)}")
-
-                if file_id != -1:
-
-                    if limit_qualitative_results != -1 and i+1 > limit_qualitative_results:
-                        viz = False
-
-                    files_remaining = len(file_id_list) - (i+1)
-                    seq_path = os.path.join(root_file_name,str(file_id)+".csv")
-
-                    # Compute map features using Argoverse Forecasting Baseline algorithm
-
-                    start = time.time()
-
-                    df = pd.read_csv(seq_path, dtype={"TIMESTAMP": str})
-
-                    # Get social and map features for the agent
-
-                    agent_track = df[df["OBJECT_TYPE"] == "AGENT"].values
-                    city_name = agent_track[0,RAW_DATA_FORMAT["CITY_NAME"]]
-                    agent_xy = agent_track[:,[RAW_DATA_FORMAT["X"],RAW_DATA_FORMAT["Y"]]].astype("float")
-                    first_obs = agent_xy[0,:]
-                    last_obs = agent_xy[obs_origin-1,:]
+            # Resumable job (checkpoints in job_folder). The physical information of each sequence is
+            # streamed to job_folder (memory-mapped .npy files) and the sequences that raise an exception
+            # are quarantined
 
-                    # Filter agent's trajectory (smooth)
-
-                    vel, acc, xy_filtered, extended_xy_filtered = map_features_utils_instance.get_agent_velocity_and_acceleration(agent_xy[:obs_len,:],
-                                                                                                                                  filter=filter,
-                                                                                                                                  debug=False)
-                                                                                                        
-                    if distance_method == "CTRV":
-                        dist_around = vel * (pred_len/freq)
-                    elif distance_method == "CTRA":
-                        dist_around = vel * (pred_len/freq) + 1/2 * acc * (pred_len/freq)**2
-
-                    if dist_around < min_dist_around:
-                        dist_around = min_dist_around
-
-                    # Compute agent's orientation
+            job_folder = os.path.join(BASE_DIR,config.dataset.path,split_name,
+                                      f"data_processed_{str(int(features[1]*100))}_percent_centerlines_job")
+            params = dict(modes_centerlines=modes_centerlines, algorithm=algorithm, 
+                          first_centerline_waypoint=first_centerline_waypoint, max_points=max_points, 
+                          max_centerlines=max_centerlines, distance_method=distance_method, filter=filter)
 
-                    lane_dir_vector, yaw = map_features_utils_instance.get_yaw(xy_filtered, obs_len)
-                    target_agent_orientation_list.append(yaw)
-                    
-                    for mode in modes_centerlines:
-                        # Map features extraction
+            job = PreprocessingJob(job_folder, file_id_list,
+                                   functools.partial(get_sequence_physical_rows, root_file_name=root_file_name,
+                                                     split_name=split_name, output_dir=output_dir),
+                                   outputs=PHYSICAL_OUTPUTS, placeholder_fn=get_sequence_placeholder_rows, params=params,
+                                   num_workers=config.dataset.preprocess_workers)
+            physical_data, quarantine = job.run()
 
-                        map_features, map_feature_helpers = map_features_utils_instance.compute_map_features(
-                                agent_track,
-                                file_id,
-                                split_name,
-                                obs_len,
-                                obs_len + pred_len,
-                                RAW_DATA_FORMAT,
-                                mode,
-                                avm,
-                                viz,
-                                max_candidates=max_centerlines,
-                                algorithm=algorithm
-                            )
-                      
-                        if mode == "test": # preprocess N plausible centerlines
-
-                            start_ = time.time()
-
-                            relevant_centerlines = map_feature_helpers["CANDIDATE_CENTERLINES"]  
-
-                            seq_map_info = dict()
-                            relevant_centerlines_filtered = []                 
-
-                            for index_centerline, relevant_centerline in enumerate(relevant_centerlines):
-                                # Get index of the closest waypoint to the first observation
-                                
-                                if first_centerline_waypoint == "last_obs":
-                                    closest_wp_first, _ = map_features_utils_instance.get_closest_wp(last_obs, relevant_centerline)
-                                elif first_centerline_waypoint == "first_obs":
-                                    closest_wp_first, _ = map_features_utils_instance.get_closest_wp(first_obs, relevant_centerline)
-
-                                # Get index of the closest waypoint to the last observation + dist_around
-                            
-                                closest_wp_last, dist_array_last = map_features_utils_instance.get_closest_wp(last_obs, relevant_centerline)
-                                dist_array_last = dist_array_last[closest_wp_last:] # To determine dist around from this point
-
-                                idx, value = find_nearest(dist_array_last,dist_around)
-                                num_points = idx + (closest_wp_last - closest_wp_first)
-                                if num_points < min_points:
-                                        num_points = min_points # you must have at least 4 points to conduct a cubic interpolation
-
-                                # Determine if the centerline is inverted (this sometimes happens if the corresponding agent is
-                                # carrying a lane change maneuver): The best and most interpretable solution is if the
-                                # the end point is closer than the start point and the last observation is closer to the start
-                                # rather than the first observation
-
-                                relevant_centerline_orig = copy.deepcopy(relevant_centerline)
-                                
-                                ec = euclidean_distances(relevant_centerline[:-1,:],relevant_centerline[1:,:])
-                                indeces_rows = indeces_cols = np.arange(ec.shape[0])
-                                dist = ec[indeces_rows,indeces_cols]
-
-                                invert = False
-
-                                try:
-                                    dist_firstobs2start = np.cumsum(dist[:closest_wp_first+1])[-1]
-                                    dist_lastobs2start = np.cumsum(dist[:closest_wp_last+1])[-1]
-                                    dist_firstobs2end = np.cumsum(dist[closest_wp_first:])[-1]
-
-                                    if ((dist_lastobs2start >= dist_firstobs2start)
-                                    and ((closest_wp_first > 0 and closest_wp_first < relevant_centerline.shape[0])
-                                        or (dist_firstobs2start <= dist_firstobs2end))):
-                                        pass
-                                    else:
-                                        invert = True
-
-                                except Exception as e:
-                                    # print("e: ", e)
-                                    invert = True
-
-                                if invert:
-                                    # print("invert oracle")
-
-                                    relevant_centerline_orig = copy.deepcopy(relevant_centerline)
-                                    relevant_centerline = relevant_centerline[::-1]
-
-                                    # Repeat again the process to obtain the closest wps
-
-                                    # Get index of the closest waypoint to the first observation
-                                
-                                    closest_wp_first, _ = map_features_utils_instance.get_closest_wp(first_obs, relevant_centerline)
-
-                                    # Get index of the closest waypoint to the last observation + dist_around
-                                
-                                    closest_wp_last, dist_array_last = map_features_utils_instance.get_closest_wp(last_obs, relevant_centerline)
-                                    dist_array_last = dist_array_last[closest_wp_last:]
-
-                                    idx, value = find_nearest(dist_array_last,dist_around) # TODO: Take the next point, or an interpolated point
-                                    # between the closest and the next
-
-                                    num_points = idx + (closest_wp_last - closest_wp_first)
-                                    if num_points < min_points:
-                                        num_points = min_points # you must have at least 4 points to conduct a cubic interpolation
-
-                                # Reduce the lane to the closest N points, starting from the first observation 
-                                # (closest to current position) and ending in the closest wp assuming CTRA during pred seconds
-
-                                end_point = agent_xy[-1,:]
-
-                                if closest_wp_first+num_points+1 <= relevant_centerline.shape[0]:
-                                    relevant_centerline_filtered = relevant_centerline[closest_wp_first:closest_wp_first+num_points+1,:]
-                                else: # If we have reached the end, travel backwards 
-                                    # TODO: Interpolate frontwards
-                                    back_num_points = (closest_wp_first+num_points+1) - relevant_centerline.shape[0]
-                                    # print("back: ", back_num_points)
-                                    relevant_centerline_filtered = relevant_centerline[closest_wp_first-back_num_points:,:]
-                                
-                                if relevant_centerline_filtered.shape[0] != max_points:
-                                    try:
-                                        # start = time.time()
-
-                                        interpolated_centerline = map_features_utils_instance.interpolate_centerline(relevant_centerline_filtered,
-                                                                                                                        max_points=max_points,
-                                                                                                                        agent_xy=agent_xy,
-                                                                                                                        obs_len=obs_len,
-                                                                                                                        seq_len=obs_len+pred_len,
-                                                                                                                        split=split_name,
-                                                                                                                        seq_id=file_id,
-                                                                                                                        viz=viz)
-
-                                        # end = time.time()
-                                        # print("Time consumed by interpolation: ", end-start)
-
-                                        assert interpolated_centerline.shape[0] == max_points
-
-                                        relevant_centerlines_filtered.append(interpolated_centerline)
-
-                                        # Store oracle
-
-                                        if index_centerline == 0 and algorithm == "map_api": 
-                                            # The first centerline also corresponds to the oracle using map_api
-
-                                            oracle_centerlines_list.append(interpolated_centerline)
-
-                                    except:
-                                        # TODO: Take the closest max_points if the previous algorithm fails
-                                        
-                                        map_features_utils_instance.debug_centerline_and_agent([relevant_centerline_orig], agent_xy, obs_len, obs_len+pred_len, split_name, file_id)
-                                        pdb.set_trace()
-                                        wrong_centerlines.append(file_id)            
-                
-                                else:
-                                    # print("The algorithm has the exact number of points")
-                                    relevant_centerlines_filtered.append(relevant_centerline_filtered)            
-
-                                    # Store oracle
-
-                                    if index_centerline == 0 and algorithm == "map_api": 
-                                        # The first centerline also corresponds to the oracle using map_api
-
-                                        oracle_centerlines_list.append(relevant_centerline_filtered)
-                            
-                            # Determine if there are some repeated centerlines after filtering. Take the unique
-                            # elements. If after this there are less than max_centerlines, pad with zeros
-
-                            aux_array = np.array(relevant_centerlines_filtered)
-                            vals, idx_start, count = np.unique(aux_array, axis=0, return_counts=True, return_index=True)
-                            relevant_centerlines_filtered_aux = aux_array[np.sort(idx_start),:,:]
-                            
-                            pad_zeros_centerlines = np.zeros((max_centerlines-relevant_centerlines_filtered_aux.shape[0],max_points,data_dim))
-                            relevant_centerlines_filtered = np.vstack((relevant_centerlines_filtered_aux,pad_zeros_centerlines))
-
-                            relevant_centerlines_list.append(relevant_centerlines_filtered)
-                            seq_map_info["relevant_centerlines_filtered"] = relevant_centerlines_filtered
-
-                            fig, ax = plt.subplots(figsize=(6,6), facecolor="black")
-
-                            xmin = ymin = 50000
-                            xmax = ymax = -50000
-
-                            # Paint centerlines
-
-                            for centerline_coords in relevant_centerlines_filtered:
-                                if np.any(centerline_coords): # avoid processing padded centerlines
-                                    visualize_centerline(centerline_coords) # Uncomment this to check the start and end
-
-                                    lane_polygon = centerline_to_polygon(centerline_coords)
-
-                                    if np.min(lane_polygon[:,0]) < xmin: xmin = np.min(lane_polygon[:,0])
-                                    if np.min(lane_polygon[:,1]) < ymin: ymin = np.min(lane_polygon[:,1])
-                                    if np.max(lane_polygon[:,0]) > xmax: xmax = np.max(lane_polygon[:,0])
-                                    if np.max(lane_polygon[:,1]) > ymax: ymax = np.max(lane_polygon[:,1])
-                                                                            #"black"  
-                                    ax.fill(lane_polygon[:, 0], lane_polygon[:, 1], "white", edgecolor='white', fill=True)
-                                    ax.plot(centerline_coords[:, 0], centerline_coords[:, 1], "-", color="gray", linewidth=1.5, alpha=1.0, zorder=2)
-
-                            center_plausible_area_filtered = np.zeros((2))
-                            center_plausible_area_filtered[0] = (xmin+xmax)/2
-                            center_plausible_area_filtered[1] = (ymin+ymax)/2
-
-                            real_world_width = xmax - xmin
-                            real_world_height = ymax - ymin
-
-                            seq_map_info["center_plausible_area_filtered"] = center_plausible_area_filtered
-                            seq_map_info["real_world_width"] = real_world_width
-                            seq_map_info["real_world_height"] = real_world_height
-
-                            # circ_car = plt.Circle((center_plausible_area_filtered[0], center_plausible_area_filtered[1]), 0.2, color="cyan", fill=True)
-                            # ax.add_patch(circ_car)
-
-                            # Paint agent's orientation
-
-                            dx = lane_dir_vector[0] * 4
-                            dy = lane_dir_vector[1] * 4
-
-                            plt.xlim(xmin, xmax)
-                            plt.ylim(ymin, ymax)
-                            plt.axis("off")
-
-                            filename = os.path.join(output_dir,f"{file_id}_binary_plausible_area_filtered_gray.png")
-                            # plt.savefig(filename, bbox_inches='tight', facecolor=fig.get_facecolor(), edgecolor='none', pad_inches=0)
-                            
-                            if SAVE_BEV_PLAUSIBLE_AREA: 
-                                fig.tight_layout(pad=0)
-                                fig.canvas.draw()
-                                img_gray = cv2.cvtColor(np.asarray(fig.canvas.buffer_rgba()), cv2.COLOR_RGBA2GRAY)
-                                cv2.imwrite(filename, img_gray)
-                            # plt.close('all')
-
-                            plt.arrow(
-                                agent_xy[obs_len-1,0], # Arrow origin
-                                agent_xy[obs_len-1,1],
-                                dx, # Length of the arrow
-                                dy,
-                                color="darkmagenta",
-                                width=0.3,
-                                zorder=16,
-                            )
-
-                            if agent_xy.shape[0] == obs_len+pred_len: # train and val
-                                # Agent observation
-
-                                plt.plot(
-                                    agent_xy[:obs_len, 0],
-                                    agent_xy[:obs_len, 1],
-                                    "-",
-                                    color="b",
-                                    alpha=1,
-                                    linewidth=3,
-                                    zorder=15,
-                                )
-
-                                # Agent prediction
-
-                                plt.plot(
-                                    agent_xy[obs_len:, 0],
-                                    agent_xy[obs_len:, 1],
-                                    "-",
-                                    color="r",
-                                    alpha=1,
-                                    linewidth=3,
-                                    zorder=15,
-                                )
-
-                                final_x = agent_xy[-1, 0]
-                                final_y = agent_xy[-1, 1]
-
-                                # Final position
-
-                                plt.plot(
-                                    final_x,
-                                    final_y,
-                                    "o",
-                                    color="r",
-                                    alpha=1,
-                                    markersize=5,
-                                    zorder=15,
-                                )
-                            else: # test
-                                # Agent observation
-                                
-                                plt.plot(
-                                    agent_xy[:, 0],
-                                    agent_xy[:, 1],
-                                    "-",
-                                    color="b",
-                                    alpha=1,
-                                    linewidth=3,
-                                    zorder=15,
-                                )
-
-                                final_x = agent_xy[-1, 0]
-                                final_y = agent_xy[-1, 1]
-
-                                # Final position
-
-                                plt.plot(
-                                    final_x,
-                                    final_y,
-                                    "o",
-                                    color="b",
-                                    alpha=1,
-                                    markersize=5,
-                                    zorder=15,
-                                )
-
-                            filename = os.path.join(output_dir,f"{file_id}_binary_plausible_area_filtered_color.png")
-
-                            if HIGHLIGHT_ORACLE:
-                                lane_polygon = centerline_to_polygon(relevant_centerlines_filtered[0])
-                                ax.fill(lane_polygon[:, 0], lane_polygon[:, 1], "green", edgecolor='green', fill=True)
-                            
-                            if SAVE_BEV_PLAUSIBLE_AREA: 
-                                fig.tight_layout(pad=0)
-                                fig.canvas.draw()
-                                img_bgr = cv2.cvtColor(np.asarray(fig.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
-                                cv2.imwrite(filename, img_bgr)
-                            plt.close('all')
-
-                            # plt.xlabel("Map X")
-                            # plt.ylabel("Map Y")
-                            # plt.axis("on")
-                            # plt.title(f"Number of candidates = {len(relevant_centerlines_filtered)}")   
-                            # plt.savefig(filename, bbox_inches='tight', facecolor="white", edgecolor='none', pad_inches=0)
-
-                            end_ = time.time()
-
-                            # print("Time consumed: ", end_-start_)
-
-                            map_info[str(file_id)] = seq_map_info 
-
-                        elif mode == "train": # only best centerline ("oracle")
-                            start_ = time.time()
-
-                            oracle_centerline = map_feature_helpers["ORACLE_CENTERLINE"]                     
-
-                            # Get index of the closest waypoint to the first observation
-                            
-                            if first_centerline_waypoint == "last_obs":
-                                closest_wp_first, _ = map_features_utils_instance.get_closest_wp(last_obs, relevant_centerline)
-                            elif first_centerline_waypoint == "first_obs":
-                                closest_wp_first, _ = map_features_utils_instance.get_closest_wp(first_obs, relevant_centerline)
-                            
-                            # Get index of the closest waypoint to the last observation + dist_around
-                            
-                            closest_wp_last, dist_array_last = map_features_utils_instance.get_closest_wp(last_obs, oracle_centerline)
-                            dist_array_last = dist_array_last[closest_wp_last:] # To determine dist around from this point
-
-                            idx, value = find_nearest(dist_array_last,dist_around)
-                            num_points = idx + (closest_wp_last - closest_wp_first)
-                            if num_points < min_points:
-                                    num_points = min_points # you must have at least 4 points to conduct a cubic interpolation
-
-                            # Determine if the best oracle is inverted (this sometimes happens if the corresponding agent is
-                            # carrying a lane change maneuver): The best and most interpretable solution is if the
-                            # the end point is closer than the start point and the last observation is closer to the start
-                            # rather than the first observation
-
-                            oracle_centerline_orig = copy.deepcopy(oracle_centerline)
-                            
-                            ec = euclidean_distances(oracle_centerline[:-1,:],oracle_centerline[1:,:])
-                            indeces_rows = indeces_cols = np.arange(ec.shape[0])
-                            dist = ec[indeces_rows,indeces_cols]
-
-                            invert = False
-
-                            try:
-                                dist_firstobs2start = np.cumsum(dist[:closest_wp_first+1])[-1]
-                                dist_lastobs2start = np.cumsum(dist[:closest_wp_last+1])[-1]
-                                dist_firstobs2end = np.cumsum(dist[closest_wp_first:])[-1]
-
-                                if ((dist_lastobs2start >= dist_firstobs2start)
-                                    and ((closest_wp_first > 0 and closest_wp_first < oracle_centerline.shape[0])
-                                        or (dist_firstobs2start <= dist_firstobs2end))):
-                                    pass
-                                else:
-                                    invert = True
-
-                            except Exception as e:
-                                # print("e: ", e)
-                                invert = True
-
-                            if invert:
-                                # print("invert oracle")
-
-                                oracle_centerline_orig = copy.deepcopy(oracle_centerline)
-                                oracle_centerline = oracle_centerline[::-1]
-
-                                # Repeat again the process to obtain the closest wps
-
-                                # Get index of the closest waypoint to the first observation
-                            
-                                closest_wp_first, _ = map_features_utils_instance.get_closest_wp(first_obs, oracle_centerline)
-
-                                # Get index of the closest waypoint to the last observation + dist_around
-                            
-                                closest_wp_last, dist_array_last = map_features_utils_instance.get_closest_wp(last_obs, oracle_centerline)
-                                dist_array_last = dist_array_last[closest_wp_last:]
-
-                                idx, value = find_nearest(dist_array_last,dist_around) # TODO: Take the next point, or an interpolated point
-                                # between the closest and the next
-
-                                num_points = idx + (closest_wp_last - closest_wp_first)
-                                if num_points < min_points:
-                                    num_points = min_points # you must have at least 4 points to conduct a cubic interpolation
-
-                            # Reduce the lane to the closest N points, starting from the first observation 
-                            # (closest to current position) and ending in the closest wp assuming CTRA during pred seconds
-
-                            end_point = agent_xy[-1,:]
-
-                            if closest_wp_first+num_points+1 <= oracle_centerline.shape[0]:
-                                oracle_centerline_filtered = oracle_centerline[closest_wp_first:closest_wp_first+num_points+1,:]
-                            else: # If we have reached the end, travel backwards 
-                                    # TODO: Interpolate frontwards
-                                back_num_points = (closest_wp_first+num_points+1) - oracle_centerline.shape[0]
-                                print("back: ", back_num_points)
-                                oracle_centerline_filtered = oracle_centerline[closest_wp_first-back_num_points:,:]
-                            
-                            if oracle_centerline_filtered.shape[0] != max_points:
-                                try:
-                                    # start = time.time()
-                                    interpolated_centerline = map_features_utils_instance.interpolate_centerline(relevant_centerline_filtered,
-                                                                                                                    max_points=max_points,
-                                                                                                                    agent_xy=agent_xy,
-                                                                                                                    obs_len=obs_len,
-                                                                                                                    seq_len=obs_len+pred_len,
-                                                                                                                    split=split_name,
-                                                                                                                    seq_id=file_id,
-                                                                                                                    viz=viz)
-                                    # end = time.time()
-                                    # print("Time consumed by interpolation: ", end-start)
-
-                                    assert interpolated_centerline.shape[0] == max_points
-
-                                    oracle_centerlines_list.append(interpolated_centerline)
-                                except:
-                                    # TODO: Take the closest max_points if the previous algorithm fails
-                                    
-                                    map_features_utils_instance.debug_centerline_and_agent([oracle_centerline_orig], agent_xy, obs_len, obs_len+pred_len, split_name, file_id)
-                                    pdb.set_trace()
-                                    wrong_centerlines.append(file_id)            
-                
-                            else:
-                                # print("The algorithm has the exact number of points")
-                                oracle_centerlines_list.append(oracle_centerline_filtered)
-                                
-                            end_ = time.time()
-                            # print("Time consumed by L2 norm: ", end_-start_)
-
-                    end = time.time()
-
-                    aux_time += (end-start)
-                    time_per_iteration = aux_time/(i+1)
-                    
-                    if i % check_every_n_files == 0:
-                        print(f"Time per iteration: {time_per_iteration} s. \n \
-                                Estimated time to finish ({files_remaining} files): {round(time_per_iteration*files_remaining/60)} min")
-                        print("Wrong centerlines: ", wrong_centerlines) 
+            if len(quarantine) > 0:
+                print(f"WARNING: {len(quarantine)} quarantined sequences (placeholder rows with physical_data_valid = 0): ", 
+                      [file_id for file_id, _ in quarantine])
+
+            target_agent_orientation_array = physical_data["target_agent_orientation"]
+            physical_data_valid_array = physical_data["physical_data_valid"]
+            relevant_centerlines_array = physical_data["relevant_centerlines"]
+            oracle_centerlines_array = physical_data["oracle_centerlines"]
+            wrong_centerlines = physical_data["wrong_centerlines"].tolist()
+            print("Wrong centerlines: ", wrong_centerlines)
+
+            mode = modes_centerlines[-1]
 
             # Save only the oracle (best possible centerline) as a np.array -> num_sequences x max_points x 2 
             
-            if mode == "train":
+            if config.dataset.incremental_preprocessing:
+                print("Incremental preprocessing: the physical information is only stored in the container")
+
+            elif mode == "train":
                 filename = os.path.join(BASE_DIR,config.dataset.path,split_name,
                                         f"data_processed_{str(int(features[1]*100))}_percent",
                                         "oracle_centerlines.npy")
-                oracle_centerlines_array = np.array(oracle_centerlines_list)
-                with open(filename, 'wb') as my_file: np.save(my_file, oracle_centerlines_array)
+                save_npy(filename, oracle_centerlines_array, streamed_folder=job_folder)
 
             # Save N centerlines per sequence. Note that the number of variables per sequence may vary
             
@@ -707,8 +546,7 @@ for split_name,features in splits_to_process.items():
                 filename = os.path.join(BASE_DIR,config.dataset.path,split_name,
                                         f"data_processed_{str(int(features[1]*100))}_percent",
                                         f"relevant_centerlines_{algorithm}_{first_centerline_waypoint}_{str(max_points)}_{distance_method}_{filter}_points.npy")
-                relevant_centerlines_array = np.array(relevant_centerlines_list)
-                with open(filename, 'wb') as my_file: np.save(my_file, relevant_centerlines_array)
+                save_npy(filename, relevant_centerlines_array, streamed_folder=job_folder)
                 
                 # If method is least_squares and map_api, we assume the first centerline returned by the 
                 # algorithm will be also the oracle (most plausible)
@@ -717,16 +555,52 @@ for split_name,features in splits_to_process.items():
                     filename = os.path.join(BASE_DIR,config.dataset.path,split_name,
                                         f"data_processed_{str(int(features[1]*100))}_percent",
                                         f"oracle_centerlines_{algorithm}_{first_centerline_waypoint}_{str(max_points)}_{distance_method}_{filter}_points.npy")
-                    oracle_centerlines_array = np.array(oracle_centerlines_list)
-                    with open(filename, 'wb') as my_file: np.save(my_file, oracle_centerlines_array)
+                    save_npy(filename, oracle_centerlines_array, streamed_folder=job_folder)
+
+            # Kinematic features of the AGENT (vel, acc, yaw, yaw rate) in the last observation, so they can
+            # be read instead of recomputed
+
+            if not config.dataset.incremental_preprocessing:
+                filename = os.path.join(BASE_DIR,config.dataset.path,split_name,
+                                        f"data_processed_{str(int(features[1]*100))}_percent",
+                                        "physical_data_valid.npy")
+                save_npy(filename, physical_data["physical_data_valid"], streamed_folder=job_folder)
+
+                for key, filename in kinematic_functions.KINEMATIC_FEATURES_FILES.items():
+                    filename = os.path.join(BASE_DIR,config.dataset.path,split_name,
+                                            f"data_processed_{str(int(features[1]*100))}_percent",filename)
+                    save_npy(filename, physical_data[f"kinematic_{key}"], streamed_folder=job_folder)
+
+            # Store the physical information in the container of the split (together with the social
+            # information), so no .npy file has to be renamed to choose the centerlines variant
+
+            if config.dataset.data_container:
+                physical_data = dict()
+                if len(oracle_centerlines_array) == len(file_id_list):
+                    physical_data["oracle_centerlines"] = oracle_centerlines_array
+                if mode == "test": physical_data["relevant_centerlines"] = relevant_centerlines_array
+                physical_data["target_agent_orientation"] = target_agent_orientation_array
+                physical_data["physical_data_valid"] = physical_data_valid_array # 0: quarantined (placeholder rows)
+
+                params = dict(centerlines=dict(algorithm=algorithm, 
+                                               first_centerline_waypoint=first_centerline_waypoint,
+                                               max_points=max_points, 
+                                               max_centerlines=max_centerlines,
+                                               distance_method=distance_method, 
+                                               filter=filter))
+                if config.dataset.incremental_preprocessing: # Replace only the rows of the processed sequences
+                    replace_sequence_rows_h5(container_filename, sequence_index, physical_data, params=params)
+                else:
+                    save_processed_data_as_h5(container_filename, physical_data, params=params, mode="a")
+
+            job.cleanup()
 
             # Save the orientation of the vehicle in the last observation frame
             
             # filename = os.path.join(BASE_DIR,config.dataset.path,split_name,
             #                     f"data_processed_{str(int(features[1]*100))}_percent",
             #                     f"target_agent_orientation.npy")
-            # target_agent_orientation_array = np.array(target_agent_orientation_list)
-            # with open(filename, 'wb') as my_file: np.save(my_file, target_agent_orientation_array)
+            # save_npy(filename, target_agent_orientation_array, streamed_folder=job_folder)
 
             
             
\ No newline at end of file
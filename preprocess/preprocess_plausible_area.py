@@ -1,194 +1,185 @@
+#!/usr/bin/env python3.8
+# -*- coding: utf-8 -*-
+
+## Discretize the BEV plausible area images (preprocess_data.py) of a split into a fixed number of
+## pixel coordinates per sequence. The output is stored as fixed-shape .npy files, so the points of
+## any sequence can be read with memory mapping (dataset_utils.load_plausible_area_points)
+
 import git
 import sys
 import os
 import time
 import cv2
 import numpy as np
-import pandas as pd
 import pdb
 import math
-import matplotlib.pyplot as plt
+import functools
 
 repo = git.Repo('.', search_parent_directories=True)
 BASE_DIR = repo.working_tree_dir
 sys.path.append(BASE_DIR)
 
-import model.datasets.argoverse.dataset as dataset
-import model.datasets.argoverse.dataset_utils as dataset_utils 
-import model.datasets.argoverse.map_functions as map_functions
+import model.datasets.argoverse.dataset_utils as dataset_utils
 import model.datasets.argoverse.goal_points_functions as goal_points_functions
 
-from model.datasets.argoverse.map_functions import MapFeaturesUtils
-map_features_utils_instance = MapFeaturesUtils()
-
-def intersect2D(a, b):
-  """
-  Find row intersection between 2D numpy arrays, a and b.
-  Returns another numpy array with shared rows
-  """
-  return np.array([x for x in set(tuple(x) for x in a) & set(tuple(x) for x in b)])
+from model.datasets.argoverse.dataset_utils import PLAUSIBLE_AREA_POINTS, PLAUSIBLE_AREA_FILES
 
 # Set root_dir to the correct path to your dataset folder
 
 split_name = "train"
 split_percentage = 1.0
+start_from_percentage = 0.0
 root_dir = os.path.join(BASE_DIR,
                         f'data/datasets/argoverse/motion-forecasting/{split_name}')
 data_processed_dir = os.path.join(root_dir, f'data_processed_{str(int(split_percentage*100))}_percent')
 
-# Read all plausible areas and store in a single npy array
-
-subfolder = "map_features"
-files, num_files = dataset_utils.load_list_from_folder(os.path.join(root_dir,subfolder))
-
-file_id_list = []
-root_file_name = None
-for file_name in files:
-    if not root_file_name:
-        root_file_name = os.path.dirname(os.path.abspath(file_name))
-    if "npy" in file_name or "npz" in file_name:
-        pass
-    else:
-        file_id = int(os.path.normpath(file_name).split('/')[-1].split('_')[0])
-        file_id_list.append(file_id)
-file_id_list.sort()
-print("Num files: ", num_files)
-
 mask = 255
 rows = 400 # Default number of rows
+discretized_area_points = PLAUSIBLE_AREA_POINTS
 
-save_fig = False
-show = True
-change_img_bg = False
-
-relevant_centerlines_filtered_npz = np.load(os.path.join(data_processed_dir,"relevant_centerlines.npz"),allow_pickle=True)
-relevant_centerlines_filtered = relevant_centerlines_filtered_npz['arr_0'].item()
+num_workers = 4 # 1 -> sequential
+files_per_chunk = 100
 
-plausible_area_indeces_list = []
-
-check_every = 0.1 # (· 100) % of total files
-check_every_n_files = int(len(file_id_list)*check_every)
-print(f"Check remaining time every {check_every_n_files} files")
-time_per_iteration = float(0)
-aux_time = float(0)
+save_fig = True # Save the image of the sequences with less than discretized_area_points white pixels
+change_img_bg = False
 
-file_id_list = file_id_list[150000:]
+REAL_WORLD_SIZES = dict() # file_id -> (real_world_width, real_world_height)
 
-for i,file_id in enumerate(file_id_list):
-    # print(">>>>>> File id: ", file_id)
+def get_plausible_area_points(img_gray, num_points=discretized_area_points, color=mask):
+    """
+    Pixel coordinates (row, column) of num_points pixels of the plausible area (img_gray == color),
+    evenly spaced in raster order (top-left to bottom-right). Return a num_points x 2 int16 array
+    (padded with zeros) and the number of valid points (< num_points if the area is smaller)
+    """
 
-    start_t = time.time()
+    indeces_white = np.flatnonzero(img_gray.reshape(-1) == color)
+    num_valid = min(len(indeces_white), num_points)
 
-    files_remaining = len(file_id_list) - (i+1)
+    points = np.zeros((num_points,2), dtype=np.int16)
+    if num_valid > 0:
+        indeces_white_sub = indeces_white[np.linspace(0, len(indeces_white)-1, num_valid).astype(np.int64)]
+        points[:num_valid,0], points[:num_valid,1] = np.divmod(indeces_white_sub, img_gray.shape[1])
 
-    relevant_centerlines = relevant_centerlines_filtered[str(file_id)]
+    return points, num_valid
 
-    real_world_width = relevant_centerlines["real_world_width"]
-    real_world_height = relevant_centerlines["real_world_height"]
-    # print("RW width, height: ", real_world_width, real_world_height)
+def get_sequence_plausible_area_points(file_id, root_file_name, real_world_size):
+    """
+    Read the plausible area image of file_id, resize it to rows x cols (cols given by the real world
+    aspect ratio) and discretize it
+    """
 
-    cols = math.ceil(rows*(real_world_width/real_world_height)) 
-    scale_x = float(cols/real_world_width) # px/m
-    scale_y = float(rows/real_world_height) # px/m
-    center_px = (int(rows/2),int(cols/2))
+    real_world_width, real_world_height = real_world_size
+    cols = math.ceil(rows*(real_world_width/real_world_height))
 
     filename = os.path.join(root_file_name,f"{file_id}_binary_plausible_area_filtered.png")
     img_gray = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
-    # print("Orig shape: ", img_gray.shape)
     img_gray = cv2.resize(img_gray, dsize=(cols,rows))
 
-    discretized_area_points = 512
-
-    indeces_white = np.vstack(np.where(img_gray == 255)).T
-    # print("Ind white: ", indeces_white.shape)
-
-    try:
-        subsampling = int(math.floor(indeces_white.shape[0] / discretized_area_points))
-
-        indeces_white_sub = indeces_white[::subsampling]
-        # print("Ind white sub: ", indeces_white_sub.shape)
-        fe_x = indeces_white_sub[:,1]
-        fe_y = indeces_white_sub[:,0]
-    except:
-        pdb.set_trace()
-
-    # start = time.time()
-
-    # subsampling_rows = int(rows / 100)
-    # subsampling_cols = int(cols / 100)
-    # print("Subsampling rows, columns: ", subsampling_rows, subsampling_cols)
-    # # print("Subsampling: ", subsampling)
-
-    # total_indeces_rows = np.arange(rows)
-    # total_indeces_cols = np.arange(cols)
-
-    # print("pre rows, pre columns: ", rows, cols)
-
-    # # while(len(fe_x) < discretized_area_points):
-    # rows_subsampled = total_indeces_rows[::subsampling_rows]
-    # cols_subsampled = total_indeces_cols[::subsampling_cols]
-    # print("Rows, cols: ", len(rows_subsampled), len(cols_subsampled))
-
-    # start1 = time.time()
-    # index_pair = []
-    # for r in rows_subsampled:
-    #     for c in cols_subsampled:
-    #         pair = np.array([r,c])
-    #         index_pair.append(pair)
-    # index_pair = np.array(index_pair)
-    # end1 = time.time()
-    # # print(">> Pairs subsampled: ", end1-start1)
-
-    # start2 = time.time()
-    # arr = intersect2D(index_pair,indeces_white)
-    # end2 = time.time()
-    # # print(">> Intersect time: ", end2-start2)
-
-    # fe_x = arr[:,1]
-    # fe_y = arr[:,0]
-
-    # end = time.time()  
-    # # print("Time: ", end-start)
-
-    # # sample_index = np.random.randint(low=0,high=len(fe_x),size=discretized_area_points)
-    # # sample_index = np.sort(sample_index) # Sort indeces in order to have to pixels sorted (from top-left to bottom right)
-    # # fe_x, fe_y = fe_x[sample_index], fe_y[sample_index]
-
-    # if len(fe_x) < discretized_area_points:
-    #     subsampling = int(subsampling / 2)
-
-    if len(fe_x) < discretized_area_points:
-        print(">>>>>> File id: ", file_id)
-        img = cv2.cvtColor(img_gray, cv2.COLOR_GRAY2RGB) 
-        save_fig = True
-        show = False
-        filename2 = os.path.join(root_file_name,f"{file_id}_binary_plausible_area_filtered_discrete_bug.png")
-        goal_points_functions.plot_fepoints(img, filename2, goals_px_x=fe_x, goals_px_y=fe_y,
-                                        save_fig=save_fig, show=show, change_bg=change_img_bg)
-        pdb.set_trace()
-    plausible_area_indeces = np.vstack((fe_y,fe_x)).T
-    plausible_area_indeces_list.append(plausible_area_indeces)
-
-    end_t = time.time()
-
-    # Data aug
-
-    # limit = 4
-    # noise = np.random.randint(-limit,limit,(len(fe_x),2))
-    # fe_x = fe_x + noise[:,1]
-    # fe_y = fe_y + noise[:,0]
-
-    # fe_x = indeces[1][::subsampling]
-    # fe_y = indeces[0][::subsampling]
-
-    aux_time += (end_t-start_t)
-    time_per_iteration = aux_time/(i+1)
-
-    if i % check_every_n_files == 0:
-        print(f"Time per iteration: {time_per_iteration} s. \n \
-                Estimated time to finish ({files_remaining} files): {round(time_per_iteration*files_remaining/60)} min")
-
-plausible_area_indeces_array = np.array(plausible_area_indeces_list, dtype="object")
+    points, num_valid = get_plausible_area_points(img_gray)
 
-filename_array = os.path.join(root_dir,"map_features_indeces.npz")
-with open(filename_array, 'wb') as my_file: np.savez_compressed(my_file, plausible_area_indeces_array)
\ No newline at end of file
+    if num_valid < discretized_area_points and save_fig:
+        img = cv2.cvtColor(img_gray, cv2.COLOR_GRAY2RGB)
+        filename = os.path.join(root_file_name,f"{file_id}_binary_plausible_area_filtered_discrete_bug.png")
+        goal_points_functions.plot_fepoints(img, filename, goals_px_x=points[:num_valid,1], goals_px_y=points[:num_valid,0],
+                                            save_fig=True, show=False, change_bg=change_img_bg)
+
+    return points, num_valid
+
+def get_plausible_area_rows(index, file_id, root_file_name):
+    """
+    Rows of a sequence to be written by the preprocessing job (REAL_WORLD_SIZES is filled before
+    the job starts, so the workers inherit it)
+    """
+
+    points, num_valid = get_sequence_plausible_area_points(file_id, root_file_name, REAL_WORLD_SIZES[file_id])
+
+    return dict(points=points, num_points=num_valid)
+
+def get_output_files(file_id_list, output_folder):
+    """
+    Create (or reuse, to resume a previous run over the same sequences) the output files: file_ids
+    (num_seq), points (num_seq x discretized_area_points x 2, int16) and num_points (num_seq, int16,
+    -1 if the sequence has not been processed or has been quarantined)
+    """
+
+    output_files = {key: os.path.join(output_folder,filename) for key, filename in PLAUSIBLE_AREA_FILES.items()}
+    file_ids = np.asarray(file_id_list, dtype=np.int64)
+
+    if all(os.path.isfile(filename) for filename in output_files.values()):
+        stored_file_ids = np.load(output_files["file_ids"], mmap_mode="r")
+        stored_points = np.load(output_files["points"], mmap_mode="r")
+        if np.array_equal(stored_file_ids, file_ids) and stored_points.shape[1] == discretized_area_points:
+            return output_files # Resume
+
+    with open(output_files["file_ids"], 'wb') as my_file: np.save(my_file, file_ids)
+
+    points_memmap = np.lib.format.open_memmap(output_files["points"], mode="w+", dtype=np.int16,
+                                              shape=(len(file_ids),discretized_area_points,2))
+    num_points_memmap = np.lib.format.open_memmap(output_files["num_points"], mode="w+", dtype=np.int16,
+                                                  shape=(len(file_ids),))
+    num_points_memmap[:] = -1
+    points_memmap.flush()
+    num_points_memmap.flush()
+    del points_memmap, num_points_memmap
+
+    return output_files
+
+if __name__ == "__main__":
+    # Read all plausible areas and store them in fixed-shape arrays
+
+    subfolder = "map_features"
+    files, num_files = dataset_utils.load_list_from_folder(os.path.join(root_dir,subfolder))
+
+    file_id_list = []
+    root_file_name = None
+    for file_name in files:
+        if not root_file_name:
+            root_file_name = os.path.dirname(os.path.abspath(file_name))
+        if file_name.endswith("_binary_plausible_area_filtered.png"):
+            file_id = int(os.path.normpath(file_name).split('/')[-1].split('_')[0])
+            file_id_list.append(file_id)
+    file_id_list.sort()
+    print("Num files: ", len(file_id_list))
+
+    file_id_list = dataset_utils.apply_percentage_startfrom(file_id_list, len(file_id_list),
+                                                            split_percentage=split_percentage,
+                                                            start_from_percentage=start_from_percentage)
+
+    relevant_centerlines_filtered_npz = np.load(os.path.join(data_processed_dir,"relevant_centerlines.npz"),allow_pickle=True)
+    relevant_centerlines_filtered = relevant_centerlines_filtered_npz['arr_0'].item()
+
+    REAL_WORLD_SIZES.update({file_id: (relevant_centerlines_filtered[str(file_id)]["real_world_width"],
+                                       relevant_centerlines_filtered[str(file_id)]["real_world_height"]) 
+                             for file_id in file_id_list})
+    del relevant_centerlines_filtered
+
+    output_files = get_output_files(file_id_list, root_dir)
+
+    points_memmap = np.load(output_files["points"], mmap_mode="r+")
+    num_points_memmap = np.load(output_files["num_points"], mmap_mode="r+")
+
+    def write_sequence_rows(index, file_id, rows):
+        points_memmap[index] = rows["points"]
+        num_points_memmap[index] = rows["num_points"]
+
+    def flush_outputs():
+        points_memmap.flush()
+        num_points_memmap.flush()
+
+    # Resumable job (checkpoints in job_folder). The sequences that raise an exception (e.g. missing
+    # image) are quarantined and keep num_points = -1
+
+    job_folder = os.path.join(root_dir,"map_features_indeces_job")
+    job = dataset_utils.PreprocessingJob(job_folder, file_id_list,
+                                         functools.partial(get_plausible_area_rows, root_file_name=root_file_name),
+                                         on_result=write_sequence_rows, on_checkpoint=flush_outputs,
+                                         params=dict(rows=rows, discretized_area_points=discretized_area_points),
+                                         num_workers=num_workers, chunk_size=files_per_chunk)
+    _, quarantine = job.run()
+
+    num_points = np.asarray(num_points_memmap)
+    print("Sequences with less than {} points: {}".format(discretized_area_points,
+          np.asarray(file_id_list)[(num_points >= 0) & (num_points < discretized_area_points)].tolist()))
+    print("Quarantined sequences: ", [file_id for file_id, _ in quarantine])
+
+    job.cleanup()
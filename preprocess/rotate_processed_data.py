@@ -0,0 +1,65 @@
+#!/usr/bin/env python3.8
+# -*- coding: utf-8 -*-
+
+## Store the processed trajectories, origins and centerlines already rotated (last observation of the
+## target agent aligned with the Y-axis), so seq_collate does not have to rotate every batch
+## (dataset: apply_rotation = True and rotated_data = True). Run it again after (re)processing
+## the social or physical information of a split
+
+"""
+Created on Fri Oct 16 17:05:42 2026
+@author: Carlos Gómez-Huélamo
+"""
+
+# General purpose imports
+
+import sys
+import os
+import git
+
+# DL & Math
+
+import numpy as np
+
+# Custom imports
+
+repo = git.Repo('.', search_parent_directories=True)
+BASE_DIR = repo.working_tree_dir
+sys.path.append(BASE_DIR)
+
+from model.datasets.argoverse.dataset_utils import load_processed_files_from_npy, save_processed_data_as_h5, \
+                                                   load_processed_data_from_h5, get_rotated_data, \
+                                                   ROTATED_VARIABLES
+
+#######################################
+
+dataset_path = "data/datasets/argoverse/motion-forecasting/"
+splits_to_rotate = dict({"train":[True,1.0], # Split, Rotate, Split percentage
+                         "val":  [True,1.0],
+                         "test": [False,1.0]})
+
+data_container = False # True: .h5 container of the split, False: folder of .npy files
+
+required_variables_name_list = ROTATED_VARIABLES + ['num_objs_in_seq','target_agent_orientation']
+
+for split_name,features in splits_to_rotate.items():
+    if features[0]:
+        data_processed_folder = os.path.join(BASE_DIR,dataset_path,split_name,
+                                             f"data_processed_{str(int(features[1]*100))}_percent")
+
+        if data_container:
+            filename = data_processed_folder + ".h5"
+            print(f"Rotating {filename} ...")
+
+            processed_data_dict = load_processed_data_from_h5(filename, required_variables_name_list)
+            rotated_data_dict = get_rotated_data(processed_data_dict)
+            save_processed_data_as_h5(filename, rotated_data_dict, mode="a")
+        else:
+            print(f"Rotating {data_processed_folder} ...")
+
+            processed_data_dict = load_processed_files_from_npy(data_processed_folder, required_variables_name_list)
+            rotated_data_dict = get_rotated_data(processed_data_dict)
+
+            for key, value in rotated_data_dict.items():
+                filename = os.path.join(data_processed_folder, key + ".npy")
+                with open(filename, 'wb') as my_file: np.save(my_file, value)